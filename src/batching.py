@@ -0,0 +1,118 @@
+import logging
+import re
+from typing import Dict, List
+
+from model import Book, Section
+
+logger = logging.getLogger(__name__)
+
+# Rough output size of one page of prose.
+TOKENS_PER_PAGE = 400
+# Completion size assumed for sections without a page count.
+DEFAULT_SECTION_TOKENS = 1500
+# Sections up to this many pages may share a completion with others.
+SMALL_SECTION_PAGES = 5
+# Keep a batch's answer well inside the model's output window.
+MAX_BATCH_COMPLETION_TOKENS = 3000
+MAX_BATCH_SIZE = 8
+# Line that starts each section in a batched answer, e.g. "@@@ 1.2.3".
+MARKER = "@@@"
+
+# Anything after the path on the marker line (an echoed title) is dropped.
+_MARKER_RE = re.compile(rf"^\s*{MARKER}\s*(\d+(?:\.\d+)*)[^\n]*$", re.MULTILINE)
+
+
+def expected_completion_tokens(section: Section) -> int:
+    if section.pages:
+        return section.pages * TOKENS_PER_PAGE
+    return DEFAULT_SECTION_TOKENS
+
+
+def is_batchable(section: Section) -> bool:
+    return bool(section.path) and (section.pages or 0) <= SMALL_SECTION_PAGES
+
+
+def plan_batches(
+    sections: List[Section],
+    max_completion_tokens: int = MAX_BATCH_COMPLETION_TOKENS,
+    max_batch_size: int = MAX_BATCH_SIZE,
+) -> List[List[Section]]:
+    """Group small neighbouring sections into batches by estimated tokens.
+
+    Sections keep their outline order, so a batch usually shares its chapter
+    and subchapter context. Large sections, and sections without a path to
+    address them by, get a batch of their own.
+    """
+    batches: List[List[Section]] = []
+    current: List[Section] = []
+    current_tokens = 0
+    for section in sections:
+        tokens = expected_completion_tokens(section)
+        if not is_batchable(section):
+            batches.append([section])
+            continue
+        if current and (
+            current_tokens + tokens > max_completion_tokens
+            or len(current) >= max_batch_size
+        ):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(section)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def batch_prompt(book: Book, sections: List[Section]) -> str:
+    """Build one prompt asking for several sections, each behind a marker.
+
+    Chapter and subchapter context is only repeated when it changes.
+    """
+    lines = [
+        f"You are writing the book '{book.title}' ({book.subtitle}).",
+        "Write the full text of each of the following sections. Start each "
+        f"section with a line containing only its marker, e.g. '{MARKER} 1.2.3', "
+        "followed by the section text. Answer with nothing else.",
+    ]
+    last_chapter = last_subchapter = None
+    for section in sections:
+        subchapter = section.subchapter
+        chapter = subchapter.chapter
+        lines.append("")
+        if chapter is not last_chapter:
+            lines.append(f"Chapter: {chapter.title} - {chapter.description}")
+            last_chapter = chapter
+        if subchapter is not last_subchapter:
+            lines.append(f"Subchapter: {subchapter.title} - {subchapter.description}")
+            last_subchapter = subchapter
+        pages = f" (about {section.pages} pages)" if section.pages else ""
+        lines.append(
+            f"{MARKER} {section.path}: '{section.title}' - "
+            f"{section.description}{pages}"
+        )
+    return "\n".join(lines)
+
+
+def split_batch_response(text: str, sections: List[Section]) -> Dict[int, str]:
+    """Split a batched answer into section texts by their markers.
+
+    Returns:
+        Dict[int, str]: Text per section id. Sections whose marker is
+        missing or whose text is empty are left out, so the caller can
+        fall back to individual requests for them.
+    """
+    by_path = {section.path: section.id for section in sections}
+    matches = list(_MARKER_RE.finditer(text))
+    parts: Dict[int, str] = {}
+    for match, following in zip(matches, matches[1:] + [None]):
+        section_id = by_path.get(match.group(1))
+        end = following.start() if following else len(text)
+        body = text[match.end() : end].strip()
+        if section_id is not None and body:
+            parts[section_id] = body
+    if len(parts) < len(sections):
+        logger.warning(
+            f"Batched answer covered {len(parts)} of {len(sections)} sections"
+        )
+    return parts
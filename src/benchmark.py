@@ -0,0 +1,529 @@
+"""End-to-end throughput benchmark against the local fake OpenAI server.
+
+Runs outline -> tree -> DB -> content for one book and reports latencies
+and throughput, so changes to the pipeline can be compared in numbers:
+
+    python benchmark.py --chapters 10 --latency 0.3 --concurrency 8
+
+With --startup it measures a cold start of the GUI server instead: import
+time, time until the server answers, and first page latency. With
+--conversions it times the in-memory outline conversions for an outline of
+--nodes chapters, subchapters and sections, and with --formats it compares
+the outline formats of outline_format.py on the fake server's outline.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from dataclasses import asdict, dataclass
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+OUTLINE_ATTEMPTS = 3
+# Outline request without format instructions; each format adds its own.
+FORMAT_PROMPT = (
+    "Can you give the chapters, subchapters and sections for a book about how "
+    "to be a tech consultant?"
+)
+# Share of the answer kept to test the recovery of truncated outlines.
+TRUNCATE_AT = 0.8
+# Subchapters and sections per chapter of the generated conversion outline.
+CONVERSION_SHAPE = (10, 24)
+CONVERSION_REPEAT = 5
+STARTUP_PORT = 8090
+STARTUP_TIMEOUT = 60
+# Runs in a fresh interpreter; reports the import time of gui.py on stdout.
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+import gui
+print(f"import {time.perf_counter() - start}", flush=True)
+from nicegui import ui
+ui.run(port={port}, reload=False, show=False, storage_secret="benchmark")
+"""
+
+
+@dataclass
+class BenchmarkReport:
+    sections: int
+    outline_ttfb: float
+    outline_first_node: float
+    outline_seconds: float
+    outline_tokens_per_second: float
+    tree_ms: float
+    db_rows: int
+    db_rows_per_second: float
+    content_seconds: float
+    content_requests: int
+    content_errors: int
+    sections_per_minute: float
+    tokens_per_second: float
+    latency_p50: float
+    latency_p95: float
+    latency_p99: float
+
+
+@dataclass
+class StartupReport:
+    import_seconds: float
+    ready_seconds: float
+    first_page_ms: float
+    second_page_ms: float
+    # HTTP statuses of /metrics when ready and of the two /login renders
+    ready_status: int
+    first_page_status: int
+    second_page_status: int
+
+    @property
+    def ok(self) -> bool:
+        """Whether every response was a success or a redirect."""
+        statuses = (self.ready_status, self.first_page_status, self.second_page_status)
+        return all(200 <= status < 400 for status in statuses)
+
+
+@dataclass
+class FormatReport:
+    format: str
+    output_chars: int
+    output_tokens: int
+    seconds: float
+    first_node: float
+    nodes: int
+    truncated_nodes: int
+
+
+@dataclass
+class ConversionReport:
+    nodes: int
+    build_ms: float
+    tree_ms: float
+    pydantic_ms: float
+    rows_ms: float
+    lookup_us: float
+    rollup_us: float
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile, `q` between 0 and 100."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+async def run_benchmark(
+    config,
+    concurrency: int = 8,
+    batch_small_sections: bool = True,
+    port: int = 0,
+) -> BenchmarkReport:
+    """Run the whole pipeline once against a fake server built from `config`.
+
+    Uses the database and completion cache of the working directory, so run
+    it in an empty one (see `main`).
+    """
+    import openai
+
+    from fake_openai import FakeServer, start_server
+    from generation import generate_book_content
+    from importer import import_outline
+    from llm import astream_completion, close_async_client, estimate_tokens
+    from outline import chapters_to_tree
+    from outline_format import DEFAULT_FORMAT, get_format
+
+    server = FakeServer(config)
+    runner = await start_server(server, port=port)
+    bound_port = runner.addresses[0][1]
+    openai.api_base = f"http://127.0.0.1:{bound_port}/v1"
+    openai.api_key = "fake"
+    # The outline is asked for and read as run_outline_job does
+    outline_format = get_format(DEFAULT_FORMAT)
+    prompt = f"{FORMAT_PROMPT}\n\n{outline_format.instructions}"
+    try:
+        for attempt in range(1, OUTLINE_ATTEMPTS + 1):
+            start = time.perf_counter()
+            first_token = first_node = None
+            parser = outline_format.stream_parser()
+            try:
+                async for token in astream_completion(prompt, use_cache=False):
+                    first_token = first_token or time.perf_counter()
+                    if parser.feed(token) and first_node is None:
+                        first_node = time.perf_counter()
+                break
+            except openai.error.OpenAIError:
+                # Injected errors; the outline is needed for the rest of the run
+                if attempt == OUTLINE_ATTEMPTS:
+                    raise
+        outline_seconds = time.perf_counter() - start
+        outline = outline_format.decode(parser.text)
+
+        tree_start = time.perf_counter()
+        chapters_to_tree(outline)
+        tree_ms = (time.perf_counter() - tree_start) * 1000
+
+        imported = import_outline(outline)
+        server.records.clear()
+
+        content_start = time.perf_counter()
+        written = await generate_book_content(
+            imported.book_id,
+            concurrency=concurrency,
+            requests_per_minute=10**6,
+            tokens_per_minute=10**9,
+            batch_small_sections=batch_small_sections,
+        )
+        content_seconds = time.perf_counter() - content_start
+    finally:
+        await close_async_client()
+        await runner.cleanup()
+
+    ok = [record for record in server.records if record.status == 200]
+    completion_tokens = sum(record.completion_tokens for record in ok)
+    latencies = [record.latency for record in ok]
+    return BenchmarkReport(
+        sections=written,
+        outline_ttfb=(first_token or start) - start,
+        outline_first_node=(first_node or start) - start,
+        outline_seconds=outline_seconds,
+        outline_tokens_per_second=estimate_tokens(parser.text) / outline_seconds,
+        tree_ms=tree_ms,
+        db_rows=imported.rows,
+        db_rows_per_second=imported.rows_per_second,
+        content_seconds=content_seconds,
+        content_requests=len(server.records),
+        content_errors=len(server.records) - len(ok),
+        sections_per_minute=written / content_seconds * 60,
+        tokens_per_second=completion_tokens / content_seconds,
+        latency_p50=percentile(latencies, 50),
+        latency_p95=percentile(latencies, 95),
+        latency_p99=percentile(latencies, 99),
+    )
+
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    """Tokens of `text`, counted with the optional `tiktoken` package.
+
+    Falls back to `llm.estimate_tokens`, which undercounts punctuation-heavy
+    text such as JSON.
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        from llm import estimate_tokens
+
+        return estimate_tokens(text)
+    return len(tiktoken.encoding_for_model(model).encode(text))
+
+
+async def measure_formats(config, port: int = 0) -> List[FormatReport]:
+    """Stream the outline of `config` once in every outline format.
+
+    The fake server streams a fixed number of characters per token
+    interval, so `seconds` follows the size of the answer; the token count
+    is what the API would bill and take time for.
+    """
+    import openai
+
+    from fake_openai import FakeServer, start_server
+    from llm import astream_completion, close_async_client
+    from outline_format import FORMATS
+    from outline_index import OutlineIndex
+
+    server = FakeServer(config)
+    runner = await start_server(server, port=port)
+    openai.api_base = f"http://127.0.0.1:{runner.addresses[0][1]}/v1"
+    openai.api_key = "fake"
+    reports = []
+    try:
+        for name, outline_format in FORMATS.items():
+            prompt = f"{FORMAT_PROMPT}\n\n{outline_format.instructions}"
+            parser = outline_format.stream_parser()
+            start = time.perf_counter()
+            first_node = None
+            async for token in astream_completion(prompt, use_cache=False):
+                if parser.feed(token) and first_node is None:
+                    first_node = time.perf_counter() - start
+            seconds = time.perf_counter() - start
+            text = parser.text
+            truncated = outline_format.decode(text[: int(len(text) * TRUNCATE_AT)])
+            reports.append(
+                FormatReport(
+                    format=name,
+                    output_chars=len(text),
+                    output_tokens=count_tokens(text),
+                    seconds=seconds,
+                    first_node=first_node or seconds,
+                    nodes=len(OutlineIndex.from_compact(outline_format.decode(text))),
+                    truncated_nodes=len(OutlineIndex.from_compact(truncated)),
+                )
+            )
+    finally:
+        await close_async_client()
+        await runner.cleanup()
+    return reports
+
+
+def format_formats_report(reports: List[FormatReport]) -> str:
+    lines = []
+    for report in reports:
+        lines.append(
+            f"{report.format + ':':14}{report.output_tokens} tokens "
+            f"({report.output_chars} chars), {report.seconds:.2f}s, "
+            f"first node after {report.first_node * 1000:.0f} ms, "
+            f"{report.nodes} nodes, {report.truncated_nodes} from "
+            f"{TRUNCATE_AT:.0%} of the answer"
+        )
+    return "\n".join(lines)
+
+
+def format_report(report: BenchmarkReport) -> str:
+    return "\n".join(
+        [
+            f"Outline:  {report.outline_seconds:.2f}s total, "
+            f"{report.outline_ttfb * 1000:.0f} ms to first token, "
+            f"{report.outline_first_node * 1000:.0f} ms to first node, "
+            f"{report.outline_tokens_per_second:.0f} tokens/s",
+            f"Tree:     {report.tree_ms:.1f} ms",
+            f"Database: {report.db_rows} rows, {report.db_rows_per_second:.0f} rows/s",
+            f"Content:  {report.sections} sections in {report.content_seconds:.2f}s "
+            f"({report.sections_per_minute:.0f} sections/min, "
+            f"{report.tokens_per_second:.0f} tokens/s), "
+            f"{report.content_requests} requests, {report.content_errors} errors",
+            f"Latency:  p50 {report.latency_p50 * 1000:.0f} ms, "
+            f"p95 {report.latency_p95 * 1000:.0f} ms, "
+            f"p99 {report.latency_p99 * 1000:.0f} ms",
+        ]
+    )
+
+
+def _best_ms(function, repeat: int) -> float:
+    """Fastest of `repeat` runs of `function`, in milliseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def measure_conversions(
+    nodes: int = 10_000, repeat: int = CONVERSION_REPEAT
+) -> ConversionReport:
+    """Time building an `OutlineIndex` and converting it to each shape.
+
+    The outline comes from the fake server, with about `nodes` chapters,
+    subchapters and sections in total. The tree is timed as the app builds
+    it, straight from the parsed outline with `chapters_to_tree`.
+    """
+    from fake_openai import FakeConfig, FakeServer
+    from outline import chapters_to_tree
+    from outline_index import CHAPTER, SECTION, SUBCHAPTER, OutlineIndex
+
+    subchapters, sections = CONVERSION_SHAPE
+    per_chapter = 1 + subchapters + subchapters * sections
+    config = FakeConfig(
+        chapters=max(round(nodes / per_chapter), 1),
+        subchapters=subchapters,
+        sections=sections,
+        seed=0,
+    )
+    outline = FakeServer(config).outline()
+    index = OutlineIndex.from_compact(outline)
+    ids = list(index.ids)
+
+    def lookups() -> None:
+        for node_id in ids:
+            index.row(node_id)
+
+    def rollups() -> None:
+        for row in range(len(index)):
+            index.total_pages(row)
+
+    def rows() -> None:
+        parent_ids = {node_id: row for row, node_id in enumerate(ids)}
+        index.to_rows(CHAPTER, 1)
+        index.to_rows(SUBCHAPTER, 1, "chapter_id", parent_ids)
+        index.to_rows(SECTION, 1, "subchapter_id", parent_ids)
+
+    index.total_pages()  # the running sum is built once per change
+    return ConversionReport(
+        nodes=len(index),
+        build_ms=_best_ms(lambda: OutlineIndex.from_compact(outline), repeat),
+        tree_ms=_best_ms(lambda: chapters_to_tree(outline), repeat),
+        pydantic_ms=_best_ms(index.to_pydantic, repeat),
+        rows_ms=_best_ms(rows, repeat),
+        lookup_us=_best_ms(lookups, repeat) * 1000 / len(ids),
+        rollup_us=_best_ms(rollups, repeat) * 1000 / len(ids),
+    )
+
+
+def format_conversion_report(report: ConversionReport) -> str:
+    return (
+        f"Outline:  {report.nodes} nodes, "
+        f"build {report.build_ms:.1f} ms, "
+        f"tree {report.tree_ms:.1f} ms, "
+        f"pydantic {report.pydantic_ms:.1f} ms, "
+        f"rows {report.rows_ms:.1f} ms, "
+        f"lookup {report.lookup_us:.2f} us, "
+        f"rollup {report.rollup_us:.2f} us"
+    )
+
+
+def _get(url: str) -> Tuple[int, float]:
+    """Fetch `url` and return its HTTP status and the time in milliseconds.
+
+    Error statuses are returned rather than raised, as the server answered.
+    """
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=STARTUP_TIMEOUT) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        logger.warning(f"{url} answered {e.code}")
+        status = e.code
+    return status, (time.perf_counter() - start) * 1000
+
+
+def measure_startup(port: int = STARTUP_PORT) -> StartupReport:
+    """Start the GUI server in a new process and time its cold start.
+
+    `ready_seconds` runs from process start until /metrics answers; the
+    page timings are for the first and second render of /login. The
+    statuses are recorded too, see `StartupReport.ok`.
+    """
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-c", STARTUP_SCRIPT.replace("{port}", str(port))],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    try:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError("GUI server exited during startup")
+            if time.perf_counter() - start > STARTUP_TIMEOUT:
+                raise TimeoutError("GUI server did not start")
+            try:
+                ready_status, _ = _get(f"http://127.0.0.1:{port}/metrics")
+                break
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        ready_seconds = time.perf_counter() - start
+        first_page_status, first_page_ms = _get(f"http://127.0.0.1:{port}/login")
+        second_page_status, second_page_ms = _get(f"http://127.0.0.1:{port}/login")
+    finally:
+        process.terminate()
+        output, _ = process.communicate(timeout=STARTUP_TIMEOUT)
+    import_seconds = next(
+        float(line.split()[1])
+        for line in output.splitlines()
+        if line.startswith("import ")
+    )
+    return StartupReport(
+        import_seconds,
+        ready_seconds,
+        first_page_ms,
+        second_page_ms,
+        ready_status,
+        first_page_status,
+        second_page_status,
+    )
+
+
+def format_startup_report(report: StartupReport) -> str:
+    text = (
+        f"Startup:  import {report.import_seconds:.2f}s, "
+        f"ready after {report.ready_seconds:.2f}s, "
+        f"first page {report.first_page_ms:.0f} ms, "
+        f"second page {report.second_page_ms:.0f} ms"
+    )
+    if not report.ok:
+        text += (
+            f"\nFAILED:   /metrics answered {report.ready_status}, /login "
+            f"{report.first_page_status} and {report.second_page_status}"
+        )
+    return text
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from fake_openai import FakeConfig
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--no-batching", action="store_true")
+    parser.add_argument(
+        "--startup", action="store_true", help="Measure the GUI cold start instead"
+    )
+    parser.add_argument(
+        "--conversions",
+        action="store_true",
+        help="Time the outline conversions instead",
+    )
+    parser.add_argument("--nodes", type=int, default=10_000)
+    parser.add_argument(
+        "--formats", action="store_true", help="Compare the outline formats instead"
+    )
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument(
+        "--workdir", help="Directory for the database and cache (default: a temp dir)"
+    )
+    defaults = FakeConfig()
+    for name, value in vars(defaults).items():
+        parser.add_argument(
+            f"--{name.replace('_', '-')}",
+            type=type(value) if value is not None else int,
+            default=value,
+        )
+    args = parser.parse_args(argv)
+    config = FakeConfig(**{name: getattr(args, name) for name in vars(defaults)})
+    logging.basicConfig(level=logging.WARNING)
+
+    # content.db and the completion cache live in the working directory; a
+    # fresh one keeps runs comparable and the real data untouched
+    os.chdir(args.workdir or tempfile.mkdtemp(prefix="nicewritter-bench-"))
+    if args.formats:
+        report = asyncio.run(measure_formats(config))
+        text = format_formats_report(report)
+    elif args.conversions:
+        report = measure_conversions(args.nodes)
+        text = format_conversion_report(report)
+    elif args.startup:
+        report = measure_startup()
+        text = format_startup_report(report)
+    else:
+        report = asyncio.run(
+            run_benchmark(config, args.concurrency, not args.no_batching)
+        )
+        text = format_report(report)
+    if args.json:
+        text = json.dumps(
+            (
+                [asdict(item) for item in report]
+                if isinstance(report, list)
+                else asdict(report)
+            ),
+            indent=2,
+        )
+    print(text)
+    if args.startup and not report.ok:
+        # Timings of error pages are not page latencies
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
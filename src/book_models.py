@@ -0,0 +1,35 @@
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+class Section(BaseModel):
+    id: str
+    title: Optional[str] = None
+    description: Optional[str] = None
+    content: Optional[str] = None
+    pages: Optional[int] = None
+
+
+class Subchapter(BaseModel):
+    id: str
+    title: Optional[str] = None
+    description: Optional[str] = None
+    pages: Optional[int] = None
+    sections: List[Section]
+
+
+class Chapter(BaseModel):
+    id: str
+    title: Optional[str] = None
+    description: str
+    pages: Optional[int] = None
+    subchapters: List[Subchapter]
+
+
+class Book(BaseModel):
+    id: str
+    title: Optional[str] = None
+    description: str
+    pages: Optional[int] = None
+    chapters: List[Chapter]
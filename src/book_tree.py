@@ -0,0 +1,155 @@
+import collections
+import copy
+import logging
+from typing import Dict, List, Optional
+
+from nicegui import events, ui
+
+from model import Chapter, Section, Session, Subchapter
+from tree_patch import patch_tree
+
+logger = logging.getLogger(__name__)
+
+# Children lists kept per client after their node collapses.
+CACHE_SIZE = 32
+PLACEHOLDER_SUFFIX = "-loading"
+# Node kinds (the prefix of their ids) from the top of the tree down.
+DEPTHS = {"chapter": 0, "subchapter": 1, "section": 2}
+
+
+class LazyBookTree:
+    """`ui.tree` over a stored book that loads children on expand.
+
+    Only the chapters are sent on the first render. Expanding a chapter or
+    subchapter queries its direct children (without section content) and
+    patches them in; collapsing drops them again and keeps the last
+    `cache_size` children lists around, so the page payload and server
+    memory do not grow with the size of the book.
+    """
+
+    def __init__(
+        self,
+        book_id: int,
+        cache_size: int = CACHE_SIZE,
+    ) -> None:
+        self.book_id = book_id
+        self.cache_size = cache_size
+        self._cache: collections.OrderedDict = collections.OrderedDict()
+        self._index: Dict[str, dict] = {}
+        self._loaded: set = set()
+        self.nodes = self._chapter_nodes()
+        self.tree = ui.tree(
+            copy.deepcopy(self.nodes), label_key="label", on_expand=self._on_expand
+        )
+        self.tree.add_slot(
+            "default-body",
+            '<span :props="props">Description: "{{ props.node.description }}"</span>',
+        )
+
+    def _node(self, kind: str, row, label: str, leaf: bool = False) -> dict:
+        node = {
+            "id": f"{kind}-{row.id}",
+            "label": label,
+            "description": f"{row.title} - {row.description}",
+        }
+        if not leaf:
+            # Placeholder child so the node can be expanded before it is loaded
+            node["children"] = [_placeholder(node["id"])]
+        self._index[node["id"]] = node
+        return node
+
+    def _chapter_nodes(self) -> List[dict]:
+        with Session() as session:
+            rows = (
+                session.query(Chapter.id, Chapter.title, Chapter.description)
+                .filter(Chapter.book_id == self.book_id)
+                .order_by(Chapter.sort_key, Chapter.id)
+                .all()
+            )
+        return [self._node("chapter", row, str(i)) for i, row in enumerate(rows, 1)]
+
+    def _fetch_children(self, node: dict) -> Optional[List[dict]]:
+        kind, _, pk = node["id"].partition("-")
+        if kind == "chapter":
+            model, parent, child_kind, leaf = (
+                Subchapter,
+                Subchapter.chapter_id,
+                "subchapter",
+                False,
+            )
+        elif kind == "subchapter":
+            model, parent, child_kind, leaf = (
+                Section,
+                Section.subchapter_id,
+                "section",
+                True,
+            )
+        else:
+            return None
+        with Session() as session:
+            rows = (
+                session.query(model.id, model.title, model.description)
+                .filter(parent == int(pk))
+                .order_by(model.sort_key, model.id)
+                .all()
+            )
+        return [
+            self._node(child_kind, row, f"{node['label']}.{i}", leaf)
+            for i, row in enumerate(rows, 1)
+        ]
+
+    def _load(self, key: str) -> None:
+        node = self._index.get(key)
+        if node is None or "children" not in node:
+            return
+        children = self._cache.pop(key, None)
+        if children is None:
+            children = self._fetch_children(node)
+            logger.debug(f"Loaded {len(children or [])} children of {key}")
+        else:
+            for child in children:
+                self._index[child["id"]] = child
+        node["children"] = children or []
+        self._loaded.add(key)
+
+    def _unload(self, key: str) -> None:
+        self._loaded.discard(key)
+        node = self._index.get(key)
+        if node is None:
+            return
+        children = node["children"]
+        for child in children:
+            self._forget(child)
+        node["children"] = [_placeholder(key)]
+        self._cache[key] = children
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _forget(self, node: dict) -> None:
+        self._index.pop(node["id"], None)
+        self._loaded.discard(node["id"])
+        if node.get("children"):
+            for child in node["children"]:
+                self._forget(child)
+            node["children"] = [_placeholder(node["id"])]
+
+    async def _on_expand(self, e: events.ValueChangeEventArguments) -> None:
+        expanded = set(e.value)
+        for key in list(self._loaded - expanded):
+            self._unload(key)
+        # Parents first, so their children are indexed when those load
+        for key in sorted(expanded - self._loaded, key=_depth):
+            self._load(key)
+        await patch_tree(self.tree, self.nodes)
+
+
+def _depth(key: str) -> int:
+    return DEPTHS.get(key.partition("-")[0], len(DEPTHS))
+
+
+def _placeholder(parent_id: str) -> dict:
+    return {
+        "id": parent_id + PLACEHOLDER_SUFFIX,
+        "label": "...",
+        "description": "Loading",
+    }
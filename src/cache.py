@@ -0,0 +1,179 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = "completion_cache.db"
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Access times of cache hits are kept in memory and written in one commit
+# once this many are pending or the oldest is this many seconds old.
+ACCESS_FLUSH_SIZE = 100
+ACCESS_FLUSH_INTERVAL = 30
+
+
+def make_key(
+    model: str,
+    system_message: Optional[str],
+    prompt: str,
+    temperature: float,
+    presence_penalty: float,
+) -> str:
+    """Hash the request parameters that determine a completion."""
+    payload = json.dumps(
+        [model, system_message, prompt, temperature, presence_penalty],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """Disk-backed completion cache with LRU eviction and optional TTL.
+
+    Entries live in a small SQLite file, so they survive restarts. When the
+    stored responses exceed `max_bytes`, the least recently used ones are
+    evicted. A hit only reads from the file; its access time is written
+    later with others, so serving from the cache does not commit.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_PATH,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        ttl: Optional[float] = None,
+    ) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Access times not yet written, by key
+        self._accessed: Dict[str, float] = {}
+        self._accessed_since: Optional[float] = None
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS completions_accessed "
+            "ON completions (accessed)"
+        )
+        self._size = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM completions"
+        ).fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached completion for `key`, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, size, created FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl is not None and now - row[2] > self.ttl:
+                self._conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self._size -= row[1]
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            if not self._accessed:
+                self._accessed_since = now
+            self._accessed[key] = now
+            if (
+                len(self._accessed) >= ACCESS_FLUSH_SIZE
+                or now - self._accessed_since >= ACCESS_FLUSH_INTERVAL
+            ):
+                self._flush_accessed()
+                self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, value: str) -> None:
+        """Store a completion and evict least recently used entries if needed."""
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            old = self._conn.execute(
+                "SELECT size FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if old is not None:
+                self._size -= old[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self._accessed.pop(key, None)
+            self._size += size
+            self._evict()
+            self._conn.commit()
+
+    def _flush_accessed(self) -> None:
+        if self._accessed:
+            self._conn.executemany(
+                "UPDATE completions SET accessed = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in self._accessed.items()],
+            )
+            self._accessed.clear()
+
+    def flush(self) -> None:
+        """Write the pending access times of cache hits."""
+        with self._lock:
+            self._flush_accessed()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        if self._size > self.max_bytes:
+            # Evict by the latest access times
+            self._flush_accessed()
+        while self._size > self.max_bytes:
+            row = self._conn.execute(
+                "SELECT key, size FROM completions ORDER BY accessed LIMIT 1"
+            ).fetchone()
+            if row is None:
+                break
+            self._conn.execute("DELETE FROM completions WHERE key = ?", (row[0],))
+            self._size -= row[1]
+            logger.debug(f"Evicted cached completion {row[0]}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM completions")
+            self._conn.commit()
+            self._accessed.clear()
+            self._size = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM completions").fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries[0],
+            "bytes": self._size,
+        }
+
+
+_cache: Optional[CompletionCache] = None
+
+
+def get_cache() -> CompletionCache:
+    """Return the process-wide completion cache, opening it on first use."""
+    global _cache
+    if _cache is None:
+        _cache = CompletionCache()
+    return _cache
+
+
+def flush_cache() -> None:
+    """Write the pending access times of the process-wide cache, if open."""
+    if _cache is not None:
+        _cache.flush()
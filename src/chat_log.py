@@ -0,0 +1,154 @@
+import collections
+import html
+import logging
+from typing import Deque, MutableMapping, Tuple
+
+from nicegui import events, ui
+
+from conversation import get_messages
+
+logger = logging.getLogger(__name__)
+
+# Messages rendered at once: on the first render and per scroll load.
+PAGE_SIZE = 20
+# Most messages that exist as elements; the ones farthest from the view go.
+MAX_RENDERED = 60
+# Scroll position (0 = top, 1 = bottom) that loads the next page.
+LOAD_THRESHOLD = 0.1
+SCROLL_THROTTLE = 0.2
+
+
+def set_message_text(message: ui.chat_message, text: str) -> None:
+    """Replace the text of a rendered chat message in place."""
+    message._props["text"] = [html.escape(text).replace("\n", "<br />")]
+    message.update()
+
+
+class ChatLog:
+    """Scrollable chat history that renders a window of the conversation.
+
+    New messages are appended as single elements instead of rebuilding the
+    log. Scrolling to the top loads the previous `page_size` messages, and
+    scrolling back down the next ones; at most `max_rendered` messages exist
+    as elements, so updates cost the same in long and new conversations.
+    Messages are addressed by their number in the conversation (see
+    `conversation.add_message`).
+    """
+
+    def __init__(
+        self,
+        conversation: MutableMapping,
+        page_size: int = PAGE_SIZE,
+        max_rendered: int = MAX_RENDERED,
+    ) -> None:
+        self.conversation = conversation
+        self.page_size = page_size
+        self.max_rendered = max(max_rendered, 2 * page_size)
+        # Rendered messages in order, as (number, element)
+        self._rendered: Deque[Tuple[int, ui.chat_message]] = collections.deque()
+        self.scroll_area = ui.scroll_area()
+        self.scroll_area.on(
+            "scroll",
+            self._on_scroll,
+            args=["verticalPercentage"],
+            throttle=SCROLL_THROTTLE,
+        )
+        with self.scroll_area:
+            self.container = ui.column().classes("w-full items-stretch")
+        self.show_latest()
+
+    @property
+    def start(self) -> int:
+        """Number of the first rendered message."""
+        return self._rendered[0][0] if self._rendered else self.conversation["count"]
+
+    @property
+    def end(self) -> int:
+        """Number after the last rendered message."""
+        return self._rendered[-1][0] + 1 if self._rendered else self.start
+
+    def _render(self, name: str, text: str) -> ui.chat_message:
+        with self.container:
+            return ui.chat_message(text=text, name=name, sent=name == "You")
+
+    def show_latest(self) -> None:
+        """Render the last page of the conversation and scroll to it."""
+        self.container.clear()
+        self._rendered.clear()
+        count = self.conversation["count"]
+        for number, name, text in get_messages(
+            self.conversation, count - self.page_size, count
+        ):
+            self._rendered.append((number, self._render(name, text)))
+        self.scroll_to_bottom()
+
+    def append(self, number: int, name: str, text: str) -> None:
+        """Render a message that was just added to the conversation."""
+        if self._rendered and self.end < number:
+            # Scrolled up into the history: jump back to the latest messages
+            self.show_latest()
+        if not self._rendered or self.end == number:
+            self._rendered.append((number, self._render(name, text)))
+        while len(self._rendered) > self.max_rendered:
+            self.container.remove(self._rendered.popleft()[1])
+        self.scroll_to_bottom()
+
+    def update(self, number: int, text: str) -> None:
+        """Replace the text of a message, such as a streaming reply.
+
+        Messages that are not rendered are left alone; they are read from
+        the conversation when scrolled to.
+        """
+        for rendered, message in reversed(self._rendered):
+            if rendered == number:
+                set_message_text(message, text)
+                return
+            if rendered < number:
+                return
+
+    def load_older(self) -> int:
+        """Render the page before the first rendered message.
+
+        Returns:
+            int: Number of messages loaded.
+        """
+        start = self.start
+        page = get_messages(self.conversation, start - self.page_size, start)
+        loaded = []
+        for index, (number, name, text) in enumerate(page):
+            message = self._render(name, text)
+            message.move(self.container, target_index=index)
+            loaded.append((number, message))
+        self._rendered.extendleft(reversed(loaded))
+        while len(self._rendered) > self.max_rendered:
+            self.container.remove(self._rendered.pop()[1])
+        if page:
+            # Keep the previously first message about where it was
+            self.scroll_area.scroll_to(percent=len(page) / len(self._rendered))
+        return len(page)
+
+    def load_newer(self) -> int:
+        """Render the page after the last rendered message.
+
+        Returns:
+            int: Number of messages loaded.
+        """
+        end = self.end
+        page = get_messages(self.conversation, end, end + self.page_size)
+        for number, name, text in page:
+            self._rendered.append((number, self._render(name, text)))
+        while len(self._rendered) > self.max_rendered:
+            self.container.remove(self._rendered.popleft()[1])
+        if page:
+            self.scroll_area.scroll_to(percent=1 - len(page) / len(self._rendered))
+        return len(page)
+
+    def scroll_to_bottom(self) -> None:
+        self.scroll_area.scroll_to(percent=1)
+
+    def _on_scroll(self, e: events.GenericEventArguments) -> None:
+        position = e.args["verticalPercentage"]
+        if position <= LOAD_THRESHOLD:
+            self.load_older()
+        elif position >= 1 - LOAD_THRESHOLD and self.end < self.conversation["count"]:
+            self.load_newer()
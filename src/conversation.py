@@ -0,0 +1,223 @@
+import logging
+import time
+from typing import Dict, Iterable, List, MutableMapping, Optional, Tuple
+
+from llm import CHARS_PER_TOKEN, aget_completion, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Key of the conversation in a user's storage (app.storage.user).
+STORAGE_KEY = "conversation"
+# Most tokens of summary and earlier turns sent along with a new question.
+CONTEXT_TOKENS = 3000
+# Earlier turns kept word for word; older ones are folded into the summary.
+WINDOW_MESSAGES = 12
+WINDOW_TOKENS = 2500
+# Upper bound of the rolling summary of the folded turns.
+SUMMARY_TOKENS = 300
+# Messages kept for display, independent of what is sent to the model.
+HISTORY_LIMIT = 200
+# Conversations untouched for this many seconds are dropped.
+IDLE_TIMEOUT = 24 * 60 * 60
+EVICTION_INTERVAL = 10 * 60
+
+SYSTEM_MESSAGE = (
+    "You are a helpful assistant for writing books. The conversation so far "
+    "is given as a transcript; answer the last message of the User."
+)
+SUMMARY_PROMPT = """Summarize this conversation between a User and an \
+Assistant in at most {words} words. Keep names, decisions, open questions and \
+facts the User gave; leave out pleasantries.
+
+Summary so far:
+{summary}
+
+New messages:
+{transcript}"""
+
+_LABELS = {"user": "User", "assistant": "Assistant"}
+# Storages holding a conversation, by id, for `evict_idle_conversations`.
+_storages: Dict[int, MutableMapping] = {}
+
+
+def get_conversation(storage: MutableMapping) -> MutableMapping:
+    """Conversation state of one user, created in `storage` if missing.
+
+    The state is plain JSON so it can live in `app.storage.user`:
+    "summary" of the folded turns, "turns" in the window as [role, text],
+    the latest "history" of displayed messages as [name, text], the
+    "count" of messages displayed so far and the time it was last
+    "updated".
+    """
+    if STORAGE_KEY not in storage:
+        storage[STORAGE_KEY] = {
+            "summary": "",
+            "turns": [],
+            "history": [],
+            "count": 0,
+            "updated": time.time(),
+        }
+    _storages[id(storage)] = storage
+    return storage[STORAGE_KEY]
+
+
+def _line(role: str, text: str) -> str:
+    return f"{_LABELS[role]}: {text}"
+
+
+def build_prompt(
+    conversation: MutableMapping,
+    question: str,
+    context_tokens: int = CONTEXT_TOKENS,
+) -> Tuple[str, str]:
+    """Prompt and system message for the next question.
+
+    The summary goes into the system message, followed by as many of the
+    latest turns as fit into `context_tokens`.
+
+    Returns:
+        tuple: The prompt and the system message.
+    """
+    system_message = SYSTEM_MESSAGE
+    if conversation["summary"]:
+        system_message += (
+            f"\n\nSummary of the earlier conversation:\n{conversation['summary']}"
+        )
+    budget = context_tokens - estimate_tokens(system_message)
+    budget -= estimate_tokens(question)
+    lines: List[str] = []
+    for role, text in reversed(conversation["turns"]):
+        line = _line(role, text)
+        budget -= estimate_tokens(line)
+        if budget < 0:
+            break
+        lines.append(line)
+    if not lines and not conversation["summary"]:
+        return question, system_message
+    lines.reverse()
+    lines.append(_line("user", question))
+    return "\n\n".join(lines), system_message
+
+
+def add_turn(conversation: MutableMapping, question: str, reply: str) -> None:
+    """Record a question and its reply for the next prompts."""
+    conversation["turns"] = list(conversation["turns"]) + [
+        ["user", question],
+        ["assistant", reply],
+    ]
+    conversation["updated"] = time.time()
+
+
+def add_message(conversation: MutableMapping, name: str, text: str) -> int:
+    """Append a message to the displayed history.
+
+    Returns:
+        int: Number of the message within the whole conversation; it stays
+        valid when older messages leave the history.
+    """
+    history = conversation["history"]
+    history.append([name, text])
+    del history[:-HISTORY_LIMIT]
+    conversation["count"] += 1
+    conversation["updated"] = time.time()
+    return conversation["count"] - 1
+
+
+def update_message(conversation: MutableMapping, number: int, text: str) -> None:
+    """Replace the text of a displayed message, if it is still kept."""
+    index = number - (conversation["count"] - len(conversation["history"]))
+    if index >= 0:
+        conversation["history"][index] = [conversation["history"][index][0], text]
+
+
+def get_messages(
+    conversation: MutableMapping, start: int, end: int
+) -> List[Tuple[int, str, str]]:
+    """Kept messages numbered from `start` up to `end`, as (number, name, text)."""
+    history = conversation["history"]
+    first = conversation["count"] - len(history)
+    return [
+        (number, *history[number - first])
+        for number in range(max(start, first), min(end, conversation["count"]))
+    ]
+
+
+def overflow(
+    conversation: MutableMapping,
+    window_messages: int = WINDOW_MESSAGES,
+    window_tokens: int = WINDOW_TOKENS,
+) -> int:
+    """Number of oldest turns that no longer fit into the window."""
+    turns = conversation["turns"]
+    tokens = sum(estimate_tokens(_line(role, text)) for role, text in turns)
+    count = 0
+    while count < len(turns) and (
+        len(turns) - count > window_messages or tokens > window_tokens
+    ):
+        tokens -= estimate_tokens(_line(*turns[count]))
+        count += 1
+    return count
+
+
+async def compact(
+    conversation: MutableMapping,
+    window_messages: int = WINDOW_MESSAGES,
+    window_tokens: int = WINDOW_TOKENS,
+    summary_tokens: int = SUMMARY_TOKENS,
+) -> bool:
+    """Fold the turns that left the window into the rolling summary.
+
+    The turns are dropped even if the summary cannot be written, so the
+    state stays bounded; the summary is cut to `summary_tokens`.
+
+    Returns:
+        bool: Whether any turns were folded.
+    """
+    count = overflow(conversation, window_messages, window_tokens)
+    if not count:
+        return False
+    folded = conversation["turns"][:count]
+    transcript = "\n\n".join(_line(role, text) for role, text in folded)
+    prompt = SUMMARY_PROMPT.format(
+        words=summary_tokens * 3 // 4,
+        summary=conversation["summary"] or "(none)",
+        transcript=transcript,
+    )
+    try:
+        summary = await aget_completion(prompt, temperature=0)
+    except Exception as e:
+        logger.warning(f"Could not summarize {count} chat messages: {e}")
+    else:
+        conversation["summary"] = summary.strip()[: summary_tokens * CHARS_PER_TOKEN]
+    # The window may have grown while the summary was written
+    conversation["turns"] = list(conversation["turns"])[count:]
+    return True
+
+
+def evict_idle_conversations(
+    storages: Optional[Iterable[MutableMapping]] = None,
+    idle_timeout: float = IDLE_TIMEOUT,
+    now: Optional[float] = None,
+) -> int:
+    """Drop the conversations of users idle for more than `idle_timeout`.
+
+    Args:
+        storages (Iterable[MutableMapping], optional): User storages to look
+            at. Defaults to every storage `get_conversation` was called with.
+
+    Returns:
+        int: Number of conversations dropped.
+    """
+    now = time.time() if now is None else now
+    storages = list(_storages.values()) if storages is None else list(storages)
+    evicted = 0
+    for storage in storages:
+        conversation = storage.get(STORAGE_KEY)
+        if conversation and now - conversation["updated"] > idle_timeout:
+            del storage[STORAGE_KEY]
+            evicted += 1
+        if STORAGE_KEY not in storage:
+            _storages.pop(id(storage), None)
+    if evicted:
+        logger.info(f"Dropped {evicted} idle conversations")
+    return evicted
@@ -0,0 +1,223 @@
+import html
+import logging
+import re
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional
+
+from sqlalchemy import literal, null, select, union_all
+
+from model import Book, Chapter, Section, SectionBody, Session, Subchapter, inflate_text
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched from the database at a time; only these are held in memory.
+BATCH_SIZE = 50
+# Bytes per chunk of a streamed download.
+CHUNK_SIZE = 64 * 1024
+
+HTML_STYLE = """body { max-width: 48rem; margin: 2rem auto; padding: 0 1rem;
+  font-family: Georgia, serif; line-height: 1.6; }
+nav ul { list-style: none; padding-left: 1.2rem; }
+nav a { text-decoration: none; }
+h1, h2, h3, h4 { font-family: sans-serif; }
+.description { font-style: italic; color: #555; }"""
+
+
+@dataclass
+class OutlineEntry:
+    """Chapter (level 1), subchapter (2) or section (3) in reading order."""
+
+    level: int
+    path: str
+    title: Optional[str]
+    description: Optional[str]
+    content: Optional[str] = None
+
+    @property
+    def anchor(self) -> str:
+        return "s-" + self.path.replace(".", "-")
+
+    @property
+    def heading(self) -> str:
+        return f"{self.path} {self.title or ''}".strip()
+
+
+def _level_query(model, level: int, book_id: int, with_content: bool):
+    columns = [
+        literal(level).label("level"),
+        model.path,
+        model.sort_key,
+        model.title,
+        model.description,
+    ]
+    if model is Section and with_content:
+        query = select(*columns, SectionBody.data).outerjoin(
+            SectionBody, SectionBody.section_id == Section.id
+        )
+    else:
+        query = select(*columns, null().label("data"))
+    return query.where(model.book_id == book_id)
+
+
+def iter_outline(
+    book_id: int, with_content: bool = False, batch_size: int = BATCH_SIZE
+) -> Iterator[OutlineEntry]:
+    """Chapters, subchapters and sections of a book in reading order.
+
+    One query over all three levels, ordered by sort key and fetched
+    `batch_size` rows at a time; section bodies are decompressed one by one
+    as they are yielded, so memory does not grow with the book.
+    """
+    query = union_all(
+        _level_query(Chapter, 1, book_id, with_content),
+        _level_query(Subchapter, 2, book_id, with_content),
+        _level_query(Section, 3, book_id, with_content),
+    ).order_by("sort_key")
+    with Session() as session:
+        result = session.execute(query.execution_options(yield_per=batch_size))
+        for row in result:
+            yield OutlineEntry(
+                level=row.level,
+                path=row.path,
+                title=row.title,
+                description=row.description,
+                content=inflate_text(row.data),
+            )
+
+
+def _get_book(book_id: int) -> Book:
+    with Session() as session:
+        book = session.get(Book, book_id)
+        if book is None:
+            raise ValueError(f"Book {book_id} not found")
+        session.expunge(book)
+    return book
+
+
+def export_markdown(book_id: int) -> Iterator[str]:
+    """Stream a book as Markdown: title, table of contents, then the text.
+
+    Headings are numbered with the outline ids and carry an anchor that the
+    table of contents links to.
+
+    Raises:
+        ValueError: If the book does not exist.
+    """
+    book = _get_book(book_id)
+    yield f"# {book.title or 'Untitled'}\n\n"
+    if book.subtitle:
+        yield f"*{book.subtitle}*\n\n"
+
+    yield "## Contents\n\n"
+    for entry in iter_outline(book_id):
+        indent = "  " * (entry.level - 1)
+        yield f"{indent}- [{entry.heading}](#{entry.anchor})\n"
+    yield "\n"
+
+    for entry in iter_outline(book_id, with_content=True):
+        yield f'<a id="{entry.anchor}"></a>\n\n'
+        yield f"{'#' * (entry.level + 1)} {entry.heading}\n\n"
+        if entry.description and entry.level < 3:
+            yield f"*{entry.description}*\n\n"
+        if entry.content:
+            yield entry.content.strip() + "\n\n"
+
+
+def _paragraphs(text: str) -> Iterator[str]:
+    for paragraph in re.split(r"\n\s*\n", text.strip()):
+        if paragraph.strip():
+            yield "<p>" + html.escape(paragraph).replace("\n", "<br>") + "</p>\n"
+
+
+def export_html(book_id: int) -> Iterator[str]:
+    """Stream a book as a single HTML file with a linked table of contents.
+
+    Raises:
+        ValueError: If the book does not exist.
+    """
+    book = _get_book(book_id)
+    title = html.escape(book.title or "Untitled")
+    yield (
+        '<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+        f"<title>{title}</title>\n<style>\n{HTML_STYLE}\n</style>\n"
+        "</head>\n<body>\n"
+    )
+    yield f"<h1>{title}</h1>\n"
+    if book.subtitle:
+        yield f'<p class="description">{html.escape(book.subtitle)}</p>\n'
+
+    # Nested lists: open one per level down, close one per level up
+    yield "<nav>\n<h2>Contents</h2>\n"
+    depth = 0
+    for entry in iter_outline(book_id):
+        if entry.level > depth:
+            yield "<ul>\n" * (entry.level - depth)
+        else:
+            yield "</li>\n" + "</ul>\n</li>\n" * (depth - entry.level)
+        depth = entry.level
+        link = f'<a href="#{entry.anchor}">{html.escape(entry.heading)}</a>'
+        yield f"<li>{link}"
+    yield "</li>\n</ul>\n" * depth
+    yield "</nav>\n"
+
+    for entry in iter_outline(book_id, with_content=True):
+        tag = f"h{entry.level + 1}"
+        yield f'<{tag} id="{entry.anchor}">{html.escape(entry.heading)}</{tag}>\n'
+        if entry.description and entry.level < 3:
+            yield f'<p class="description">{html.escape(entry.description)}</p>\n'
+        if entry.content:
+            yield from _paragraphs(entry.content)
+    yield "</body>\n</html>\n"
+
+
+@dataclass
+class ExportFormat:
+    exporter: Callable[[int], Iterator[str]]
+    media_type: str
+    extension: str
+
+
+FORMATS: Dict[str, ExportFormat] = {
+    "markdown": ExportFormat(export_markdown, "text/markdown; charset=utf-8", "md"),
+    "html": ExportFormat(export_html, "text/html; charset=utf-8", "html"),
+}
+
+
+def export_filename(book_id: int, format: str) -> str:
+    """Download file name, e.g. "book-3.md"."""
+    return f"book-{book_id}.{FORMATS[format].extension}"
+
+
+def stream_export(
+    book_id: int, format: str, chunk_size: int = CHUNK_SIZE
+) -> Iterator[bytes]:
+    """Export as UTF-8, joined into chunks of about `chunk_size` bytes.
+
+    For streamed responses, which would otherwise send every heading and
+    paragraph on its own.
+    """
+    buffer: List[bytes] = []
+    size = 0
+    for chunk in FORMATS[format].exporter(book_id):
+        data = chunk.encode("utf-8")
+        buffer.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield b"".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def write_export(book_id: int, format: str, path: str) -> int:
+    """Write an export to `path` as it is generated.
+
+    Returns:
+        int: Number of characters written.
+    """
+    written = 0
+    with open(path, "w", encoding="utf-8") as file:
+        for chunk in FORMATS[format].exporter(book_id):
+            file.write(chunk)
+            written += len(chunk)
+    return written
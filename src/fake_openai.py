@@ -0,0 +1,296 @@
+"""Local stand-in for the OpenAI chat completions endpoint.
+
+Serves canned outlines and section texts with configurable latency,
+streaming speed and error rate, so the generation pipeline can run and be
+measured offline. Point the client at it with:
+
+    python fake_openai.py --port 8765
+    export OPENAI_API_BASE=http://127.0.0.1:8765/v1
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import re
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from aiohttp import web
+
+from llm import estimate_tokens
+from outline_format import FORMATS
+
+logger = logging.getLogger(__name__)
+
+LOREM = (
+    "consulting client delivery architecture roadmap stakeholder budget "
+    "migration cloud platform team process value risk contract workshop "
+    "estimate backlog release review strategy code example refactor"
+).split()
+# Characters per streamed chunk, about one token.
+CHUNK_CHARS = 4
+# Section marker of batched prompts, as in batching.MARKER (not imported, so
+# the server does not open the book database).
+MARKER = "@@@"
+
+_PAGES_RE = re.compile(r"about (\d+) pages")
+# Section lines of a batched prompt (see batching.batch_prompt).
+_BATCH_RE = re.compile(
+    rf"^{MARKER} (\d+(?:\.\d+)*):.*?(?:about (\d+) pages\))?$", re.MULTILINE
+)
+
+
+@dataclass
+class FakeConfig:
+    """How the fake server behaves.
+
+    Latency is the time to the first byte (or the whole answer when not
+    streaming) and is drawn per request from `latency_distribution`:
+    "fixed" always waits `latency`, "uniform" between 0 and twice `latency`,
+    and "lognormal" has median `latency` and spread `latency_sigma`, which
+    gives the long tail real APIs show.
+    """
+
+    latency: float = 0.5
+    latency_distribution: str = "lognormal"
+    latency_sigma: float = 0.5
+    # Seconds between streamed chunks, and per token of non-streamed answers.
+    token_interval: float = 0.005
+    error_rate: float = 0.0
+    chapters: int = 10
+    subchapters: int = 4
+    sections: int = 5
+    section_pages: int = 2
+    words_per_page: int = 100
+    seed: Optional[int] = None
+
+
+@dataclass
+class RequestRecord:
+    kind: str
+    stream: bool
+    status: int
+    started: float
+    first_byte: float
+    finished: float
+    prompt_tokens: int
+    completion_tokens: int
+
+    @property
+    def latency(self) -> float:
+        return self.finished - self.started
+
+    @property
+    def time_to_first_byte(self) -> float:
+        return self.first_byte - self.started
+
+
+@dataclass
+class FakeServer:
+    config: FakeConfig = field(default_factory=FakeConfig)
+    records: List[RequestRecord] = field(default_factory=list)
+
+    def __post_init__(self) -> None:
+        self._random = random.Random(self.config.seed)
+
+    def delay(self) -> float:
+        config = self.config
+        if config.latency_distribution == "fixed":
+            return config.latency
+        if config.latency_distribution == "uniform":
+            return self._random.uniform(0, 2 * config.latency)
+        if config.latency_distribution == "lognormal":
+            return config.latency * self._random.lognormvariate(0, config.latency_sigma)
+        raise ValueError(f"Unknown latency distribution: {config.latency_distribution}")
+
+    def outline(self) -> dict:
+        """Canned outline in the compact `bt`/`cs`/`ss`/`scs` format."""
+        config = self.config
+        section_pages = config.section_pages
+        return {
+            "bt": "The Tech Consultant's Guide",
+            "ss": "From Code to Consulting",
+            "cs": [
+                {
+                    "cn": cn,
+                    "ct": f"Chapter {cn}",
+                    "cd": self.words(12),
+                    "cp": config.subchapters * config.sections * section_pages,
+                    "ss": [
+                        {
+                            "scn": scn,
+                            "sct": f"Subchapter {cn}.{scn}",
+                            "scd": self.words(10),
+                            "scp": config.sections * section_pages,
+                            "scs": [
+                                {
+                                    "sn": sn,
+                                    "st": f"Section {cn}.{scn}.{sn}",
+                                    "sd": self.words(8),
+                                    "sp": section_pages,
+                                }
+                                for sn in range(1, config.sections + 1)
+                            ],
+                        }
+                        for scn in range(1, config.subchapters + 1)
+                    ],
+                }
+                for cn in range(1, config.chapters + 1)
+            ],
+        }
+
+    def words(self, count: int) -> str:
+        return " ".join(self._random.choice(LOREM) for _ in range(count))
+
+    def section_text(self, pages: int) -> str:
+        return self.words(max(pages, 1) * self.config.words_per_page)
+
+    def answer(self, prompt: str) -> tuple:
+        """Pick the canned answer for a prompt.
+
+        Outline prompts with the instructions of an outline format are
+        answered in that format.
+
+        Returns:
+            tuple: Kind of request ("outline", "batch" or "section") and text.
+        """
+        batch = _BATCH_RE.findall(prompt)
+        if batch:
+            parts = [
+                f"{MARKER} {path}\n"
+                + self.section_text(int(pages or self.config.section_pages))
+                for path, pages in batch
+            ]
+            return "batch", "\n\n".join(parts)
+        for outline_format in FORMATS.values():
+            if outline_format.instructions in prompt:
+                return "outline", outline_format.encode(self.outline())
+        if "json" in prompt.lower():
+            return "outline", json.dumps(self.outline(), indent=2)
+        match = _PAGES_RE.search(prompt)
+        pages = int(match.group(1)) if match else self.config.section_pages
+        return "section", self.section_text(pages)
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        stream = bool(body.get("stream"))
+        prompt = "\n".join(m.get("content") or "" for m in body.get("messages", []))
+        kind, text = self.answer(prompt)
+        record = RequestRecord(
+            kind=kind,
+            stream=stream,
+            status=200,
+            started=time.perf_counter(),
+            first_byte=0.0,
+            finished=0.0,
+            prompt_tokens=estimate_tokens(prompt),
+            completion_tokens=estimate_tokens(text),
+        )
+        self.records.append(record)
+        await asyncio.sleep(self.delay())
+
+        if self._random.random() < self.config.error_rate:
+            record.status = self._random.choice([429, 500, 503])
+            record.completion_tokens = 0
+            record.first_byte = record.finished = time.perf_counter()
+            return web.json_response(
+                {
+                    "error": {
+                        "message": "Fake server error",
+                        "type": "server_error",
+                        "code": None,
+                    }
+                },
+                status=record.status,
+            )
+
+        model = body.get("model", "gpt-3.5-turbo")
+        if not stream:
+            # A non-streamed answer takes as long as streaming it would
+            await asyncio.sleep(self.config.token_interval * record.completion_tokens)
+            record.first_byte = record.finished = time.perf_counter()
+            return web.json_response(
+                {
+                    "id": f"fake-{len(self.records)}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": text},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": record.prompt_tokens,
+                        "completion_tokens": record.completion_tokens,
+                        "total_tokens": record.prompt_tokens + record.completion_tokens,
+                    },
+                }
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        record.first_byte = time.perf_counter()
+        for start in range(0, len(text), CHUNK_CHARS):
+            chunk = {
+                "id": f"fake-{len(self.records)}",
+                "object": "chat.completion.chunk",
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": text[start : start + CHUNK_CHARS]},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if self.config.token_interval:
+                await asyncio.sleep(self.config.token_interval)
+        done = {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        await response.write(f"data: {json.dumps(done)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        record.finished = time.perf_counter()
+        return response
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        return app
+
+
+async def start_server(
+    server: FakeServer, host: str = "127.0.0.1", port: int = 8765
+) -> web.AppRunner:
+    """Serve `server` in the running event loop; stop it with `cleanup()`."""
+    runner = web.AppRunner(server.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Fake OpenAI server listening on http://{host}:{port}/v1")
+    return runner
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    defaults = FakeConfig()
+    for name, value in vars(defaults).items():
+        parser.add_argument(
+            f"--{name.replace('_', '-')}",
+            type=type(value) if value is not None else int,
+            default=value,
+        )
+    args = parser.parse_args()
+    config = FakeConfig(**{name: getattr(args, name) for name in vars(defaults)})
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(FakeServer(config).app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+import asyncio
+import collections
+import hashlib
+import logging
+import time
+from typing import Callable, List, Optional, Tuple
+
+from batching import (
+    batch_prompt,
+    expected_completion_tokens,
+    plan_batches,
+    split_batch_response,
+)
+from llm import aget_completion, estimate_tokens
+from metrics import DB_SAVE_SECONDS
+from model import Book, Section, Session, load_book
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Sliding-window limiter for requests and tokens per minute.
+
+    Callers `await acquire(tokens)` before each request; the call returns as
+    soon as both budgets for the last 60 seconds allow it.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int = 3500,
+        tokens_per_minute: int = 90000,
+        window: float = 60.0,
+    ) -> None:
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window = window
+        self._events: collections.deque = collections.deque()
+        self._tokens_in_window = 0
+        self._lock = asyncio.Lock()
+
+    def _expire(self, now: float) -> None:
+        while self._events and now - self._events[0][0] >= self.window:
+            _, tokens = self._events.popleft()
+            self._tokens_in_window -= tokens
+
+    async def acquire(self, tokens: int) -> None:
+        """Wait until a request of `tokens` tokens fits in the window."""
+        # A single oversized request must still be able to go through.
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._expire(now)
+                if (
+                    len(self._events) < self.requests_per_minute
+                    and self._tokens_in_window + tokens <= self.tokens_per_minute
+                ):
+                    self._events.append((now, tokens))
+                    self._tokens_in_window += tokens
+                    return
+                await asyncio.sleep(self._events[0][0] + self.window - now)
+
+
+def section_prompt(book: Book, section: Section) -> str:
+    """Build the content prompt for one section with its outline context."""
+    subchapter = section.subchapter
+    chapter = subchapter.chapter
+    return (
+        f"You are writing the book '{book.title}' ({book.subtitle}).\n"
+        f"Chapter: {chapter.title} - {chapter.description}\n"
+        f"Subchapter: {subchapter.title} - {subchapter.description}\n\n"
+        f"Write the full text of the section '{section.title}': "
+        f"{section.description}\n"
+        "Answer only with the section text."
+    )
+
+
+def section_fingerprint(
+    book: Book, section: Section, system_message: Optional[str] = None
+) -> str:
+    """Hash everything the content of a section is generated from.
+
+    The single-section prompt holds the prompt template, the section's own
+    title and description and its book, chapter and subchapter context, so
+    a change to any of them or to the persona changes the fingerprint. It is
+    the same whether the section is generated alone or in a batch.
+    """
+    digest = hashlib.sha256()
+    digest.update((system_message or "").encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(section_prompt(book, section).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def is_stale(
+    book: Book, section: Section, system_message: Optional[str] = None
+) -> bool:
+    """Whether a section has no content or content from different inputs.
+
+    Content written before fingerprints were recorded counts as stale.
+    """
+    return not section.content_size or section.content_fingerprint != (
+        section_fingerprint(book, section, system_message)
+    )
+
+
+def pending_sections(
+    book: Book,
+    overwrite: bool = False,
+    rebuild: bool = False,
+    system_message: Optional[str] = None,
+) -> List[Section]:
+    """Walk Book -> Chapter -> Subchapter -> Section in outline order.
+
+    Selects the sections without content, all sections with `overwrite`, or
+    the stale ones (see `is_stale`) with `rebuild`.
+    """
+    return [
+        section
+        for chapter in book.chapters
+        for subchapter in chapter.subchapters
+        for section in subchapter.sections
+        if overwrite
+        or not section.content_size
+        or (rebuild and is_stale(book, section, system_message))
+    ]
+
+
+def count_pending_sections(
+    book_id: int,
+    rebuild: bool = False,
+    system_message: Optional[str] = None,
+) -> Tuple[int, int]:
+    """Dry run of `generate_book_content`: how many sections it would write.
+
+    Only the outline is loaded, not the section content.
+
+    Returns:
+        Tuple[int, int]: Pending sections and total sections of the book.
+    """
+    with Session() as session:
+        book = load_book(session, book_id)
+        sections = [
+            section
+            for chapter in book.chapters
+            for subchapter in chapter.subchapters
+            for section in subchapter.sections
+        ]
+        pending = pending_sections(book, rebuild=rebuild, system_message=system_message)
+    return len(pending), len(sections)
+
+
+async def generate_book_content(
+    book_id: int,
+    system_message: Optional[str] = None,
+    concurrency: int = 8,
+    requests_per_minute: int = 3500,
+    tokens_per_minute: int = 90000,
+    overwrite: bool = False,
+    on_section_done: Optional[Callable[[Section], None]] = None,
+    batch_small_sections: bool = True,
+    rebuild: bool = False,
+) -> int:
+    """Fill `Section.content` for a whole book with bounded concurrency.
+
+    Requests for many sections are in flight at once, limited by
+    `concurrency` and by the requests/tokens per minute budget. Each result is
+    committed as soon as it arrives, so a partial run keeps its progress.
+
+    The run uses its own session, so it can go on in the background while
+    clients read the book.
+
+    Args:
+        book_id (int): Book to generate content for.
+        system_message (str, optional): Persona sent with every request.
+        concurrency (int): Maximum number of requests in flight.
+        requests_per_minute (int): Request budget per minute.
+        tokens_per_minute (int): Token budget (prompt + completion) per minute.
+        overwrite (bool): Regenerate sections that already have content.
+        on_section_done (callable, optional): Called with each saved section.
+        batch_small_sections (bool): Ask for several small sections in one
+            completion (see `batching.plan_batches`), falling back to single
+            requests for any section the batched answer misses.
+        rebuild (bool): Also regenerate sections whose inputs changed since
+            their content was written (see `section_fingerprint`).
+
+    Returns:
+        int: Number of sections written.
+    """
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    semaphore = asyncio.Semaphore(concurrency)
+    session = Session(expire_on_commit=False)
+    book = load_book(session, book_id)
+    sections = pending_sections(book, overwrite, rebuild, system_message)
+    if batch_small_sections:
+        batches = plan_batches(sections)
+    else:
+        batches = [[section] for section in sections]
+    logger.info(
+        f"Generating {len(sections)} sections for book {book_id} "
+        f"in {len(batches)} requests"
+    )
+    start = time.monotonic()
+
+    async def complete(prompt: str, completion_tokens: int) -> str:
+        async with semaphore:
+            budget = estimate_tokens(prompt) + completion_tokens
+            if system_message:
+                budget += estimate_tokens(system_message)
+            await limiter.acquire(budget)
+            return await aget_completion(prompt, system_message)
+
+    def save(section: Section, content: str) -> None:
+        with DB_SAVE_SECONDS.time(operation="section"):
+            section.content = content
+            section.content_fingerprint = section_fingerprint(
+                book, section, system_message
+            )
+            session.commit()
+        if on_section_done:
+            on_section_done(section)
+
+    async def generate_one(section: Section) -> int:
+        try:
+            content = await complete(
+                section_prompt(book, section), expected_completion_tokens(section)
+            )
+        except Exception:
+            logger.exception(f"Failed to generate section {section.id}")
+            return 0
+        save(section, content)
+        return 1
+
+    async def generate(batch: List[Section]) -> int:
+        if len(batch) == 1:
+            return await generate_one(batch[0])
+        try:
+            answer = await complete(
+                batch_prompt(book, batch),
+                sum(expected_completion_tokens(section) for section in batch),
+            )
+            parts = split_batch_response(answer, batch)
+        except Exception:
+            logger.exception(f"Failed to generate batch of {len(batch)} sections")
+            parts = {}
+        for section in batch:
+            if section.id in parts:
+                save(section, parts[section.id])
+        missing = [section for section in batch if section.id not in parts]
+        retried = await asyncio.gather(*(generate_one(s) for s in missing))
+        return len(batch) - len(missing) + sum(retried)
+
+    try:
+        results = await asyncio.gather(*(generate(batch) for batch in batches))
+    finally:
+        session.close()
+    written = sum(results)
+    logger.info(
+        f"Wrote {written}/{len(sections)} sections in {time.monotonic() - start:.1f}s"
+    )
+    return written
@@ -5,21 +5,44 @@ Please see the `OAuth2 example at FastAPI <https://fastapi.tiangolo.com/tutorial
 use the great `Authlib package <https://docs.authlib.org/en/v0.13/client/starlette.html#using-fastapi>`_ to implement a classing real authentication system.
 Here we just demonstrate the NiceGUI integration.
 """
-import json
+import asyncio
 import time
-from fastapi.responses import RedirectResponse
-from typing import List, Tuple
-
-from langchain.chains import ConversationChain
-from langchain.chat_models import ChatOpenAI
+from fastapi import HTTPException
+from fastapi.responses import PlainTextResponse, RedirectResponse, StreamingResponse
 
 from nicegui import app, ui, Client
-from dotenv import load_dotenv, find_dotenv
-import requests
-
+from nicegui import globals as nicegui_globals
 # from src.llm import get_completion
-from llm import get_completion
-import os
+from book_tree import LazyBookTree
+from cache import flush_cache
+from chat_log import ChatLog
+from conversation import (
+    EVICTION_INTERVAL,
+    add_message,
+    add_turn,
+    build_prompt,
+    compact,
+    evict_idle_conversations,
+    get_conversation,
+    update_message,
+)
+from export import FORMATS, export_filename, stream_export
+from generation import count_pending_sections
+from jobs import (
+    FAILED,
+    SUCCEEDED,
+    enqueue_job,
+    start_workers,
+    stop_workers,
+    subscribe,
+)
+from llm import astream_completion, close_async_client
+import metrics
+from model import Book, Session
+from search import highlight_snippet, search_sections
+from outline import OutlineTreeBuilder, chapters_to_tree
+from outline_format import DEFAULT_FORMAT, FORMATS as OUTLINE_FORMATS
+from tree_patch import patch_tree
 import logging
 from logger import initialize_logger
 
@@ -28,27 +51,12 @@ logger = logging.getLogger(__name__)
 # in reality users passwords would obviously need to be hashed
 passwords = {"m": "p", "user2": "pass2"}
 
-_ = load_dotenv(find_dotenv())  # read local .env file
-
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "not-set")
-
-llm = ConversationChain(
-    llm=ChatOpenAI(model_name="gpt-3.5-turbo", openai_api_key=OPENAI_API_KEY)
-)
-
-messages: List[Tuple[str, str, str]] = []
-thinking: bool = False
-
-
-@ui.refreshable
-async def chat_messages() -> None:
-    for name, text in messages:
-        ui.chat_message(text=text, name=name, sent=name == "You")
-    if thinking:
-        ui.spinner(size="3rem").classes("self-center")
-    await ui.run_javascript(
-        "window.scrollTo(0, document.body.scrollHeight)", respond=False
-    )
+# Minimum seconds between two UI updates of a streaming reply (~20 fps).
+STREAM_UPDATE_INTERVAL = 0.05
+# Keep full prompts and responses out of the request path: log records go
+# through a queue to a background thread, and long payloads are cut.
+LOG_MESSAGE_LENGTH = 2000
+LOG_LEVELS = {"openai": logging.WARNING, "urllib3": logging.WARNING}
 
 
 @ui.page("/")
@@ -61,6 +69,7 @@ def main_page() -> None:
             # on_click=lambda: (app.storage.user.clear(), ui.open("/login"))
             on_click=lambda: ui.open("/page_layout")
         ).props("outline round icon=logout")
+        ui.button(on_click=lambda: ui.open("/chat")).props("outline round icon=chat")
 
 
 @ui.page("/login")
@@ -84,6 +93,136 @@ def login() -> None:
         ui.button("Log in", on_click=try_login)
 
 
+@ui.page("/chat")
+async def chat_page(client: Client):
+    if not app.storage.user.get("authenticated", False):
+        return RedirectResponse("/login")
+    conversation = get_conversation(app.storage.user)
+    thinking = False
+
+    async def send() -> None:
+        nonlocal thinking
+        question = text.value
+        if thinking or not question.strip():
+            return
+        text.value = ""
+        prompt, system_message = build_prompt(conversation, question)
+        thinking = True
+        chat_log.append(add_message(conversation, "You", question), "You", question)
+        spinner.set_visibility(True)
+
+        reply = None
+        reply_text = ""
+        last_update = 0.0
+        try:
+            async for token in astream_completion(prompt, system_message):
+                reply_text += token
+                if reply is None:
+                    # First token: swap the spinner for the in-progress message
+                    spinner.set_visibility(False)
+                    reply = add_message(conversation, "Bot", "")
+                    chat_log.append(reply, "Bot", "")
+                now = time.monotonic()
+                if now - last_update >= STREAM_UPDATE_INTERVAL:
+                    chat_log.update(reply, reply_text)
+                    last_update = now
+        finally:
+            thinking = False
+            spinner.set_visibility(False)
+            if reply is None:
+                reply = add_message(conversation, "Bot", reply_text)
+                chat_log.append(reply, "Bot", reply_text)
+            else:
+                update_message(conversation, reply, reply_text)
+                chat_log.update(reply, reply_text)
+            add_turn(conversation, question, reply_text)
+        # Keeps the next prompt bounded; the reply is already on screen
+        await compact(conversation)
+
+    await client.connected()
+    with ui.column().classes("w-full max-w-2xl mx-auto items-stretch"):
+        chat_log = ChatLog(conversation)
+        chat_log.scroll_area.style("height: calc(100vh - 10rem)")
+        spinner = ui.spinner(size="3rem").classes("self-center")
+        spinner.set_visibility(False)
+    with ui.footer().classes("bg-white"), ui.column().classes(
+        "w-full max-w-3xl mx-auto my-6"
+    ):
+        text = (
+            ui.input(placeholder="message")
+            .props("rounded outlined input-class=mx-3")
+            .classes("w-full self-center")
+            .on("keydown.enter", send)
+        )
+
+
+@ui.page("/book/{book_id}")
+def book_page(book_id: int):
+    if not app.storage.user.get("authenticated", False):
+        return RedirectResponse("/login")
+    with Session() as session:
+        book = session.get(Book, book_id)
+    if book is None:
+        ui.label("Book not found").classes("text-2xl")
+        return
+    ui.label(book.title).classes("text-2xl")
+    ui.label(book.subtitle or "")
+    with ui.row():
+        for format in FORMATS:
+            ui.link(f"Export {format}", f"/book/{book_id}/export/{format}")
+    LazyBookTree(book_id)
+
+
+@app.get("/book/{book_id}/export/{format}")
+def export_book(book_id: int, format: str):
+    if not app.storage.user.get("authenticated", False):
+        return RedirectResponse("/login")
+    if format not in FORMATS:
+        raise HTTPException(404, f"Unknown export format: {format}")
+    with Session() as session:
+        if session.get(Book, book_id) is None:
+            raise HTTPException(404, "Book not found")
+    # The generator runs in a worker thread and reads the book as it is sent
+    return StreamingResponse(
+        stream_export(book_id, format),
+        media_type=FORMATS[format].media_type,
+        headers={
+            "Content-Disposition": (
+                f'attachment; filename="{export_filename(book_id, format)}"'
+            )
+        },
+    )
+
+
+@ui.page("/search")
+def search_page():
+    if not app.storage.user.get("authenticated", False):
+        return RedirectResponse("/login")
+
+    def run_search():
+        results.clear()
+        started = time.perf_counter()
+        hits = search_sections(
+            query.value,
+            book_id=int(book_id.value) if book_id.value else None,
+            chapter=chapter.value or None,
+        )
+        elapsed = (time.perf_counter() - started) * 1000
+        with results:
+            ui.label(f"{len(hits)} matches in {elapsed:.1f} ms")
+            for hit in hits:
+                with ui.card().classes("w-full"):
+                    ui.link(f"{hit.path} {hit.title}", f"/book/{hit.book_id}")
+                    ui.html(highlight_snippet(hit.snippet))
+
+    with ui.row().classes("items-center"):
+        query = ui.input("Search").on("keydown.enter", run_search)
+        book_id = ui.number("Book", format="%d")
+        chapter = ui.input("Chapter")
+        ui.button("Search", on_click=run_search)
+    results = ui.column().classes("w-full")
+
+
 @ui.page("/page_layout")
 async def page_layout(client: Client):
     if not app.storage.user.get("authenticated", False):
@@ -129,28 +268,20 @@ async def page_layout(client: Client):
             "with aproximately 500 pages \n",
         ),
     ).style("width: 80%")
+    sel_format = ui.select(
+        list(OUTLINE_FORMATS),
+        label="Outline format:",
+        value=DEFAULT_FORMAT,
+        on_change=lambda e: txt_formatting.set_value(
+            OUTLINE_FORMATS[e.value].instructions
+        ),
+    )
     txt_formatting = ui.textarea(
         label="Structure:",
-        value=(
-            "---\n"
-            "The answer should be given in json format, "
-            "using double quotes as delimiters \n"
-            "with only the json content and nothing else, \n"
-            "with the fields: \n"
-            "\bbook_title as `bt`, subtitle as `ss`, "
-            "chapters as `cs` (as a array), "
-            "chapter_number as `cn`, chapter_title as `ct`, "
-            "chapter_description as `cd`, chapter_pages as `cp`, "
-            "subchapters as ss (as a array), "
-            "subchapter_number(int) as `scn`, "
-            "subchapter_title as `sct`, subchapter_description as `scd`, "
-            "subchapter_pages as `scp`, sections (as a array) as `scs`,"
-            "section_number(int) as `sn`, section_title as `st`, "
-            "section_description as `sd`, section_pages as `sp`"
-        ),
+        value=OUTLINE_FORMATS[DEFAULT_FORMAT].instructions,
     ).style("width: 80%")
 
-    def get_chapters():
+    def get_chapters(regenerate: bool = False) -> int:
         # return {
         #     "bt": "Book Title",
         #     "st": "Subtitle",
@@ -193,122 +324,29 @@ async def page_layout(client: Client):
         #     ],
         # }
 
-        response = """
-        {
-  "bt": "The Tech Consultant's Guide to Success",
-  "ss": "A Comprehensive Handbook for Business and Technology Professionals",
-  "cs": [
-    {
-      "cn": 1,
-      "ct": "Introduction to Tech Consulting",
-      "cd": "An overview of the tech consulting industry and the skills required to succeed.",
-      "cp": 20,
-      "ss": [
-        {
-          "scn": 1,
-          "sct": "Defining Tech Consulting",
-          "scd": "What is tech consulting and why is it important?",
-          "scp": 10,
-          "scs": [
-            {
-              "sn": 1,
-              "st": "The Role of the Tech Consultant",
-              "sd": "A detailed look at the responsibilities and expectations of a tech consultant.",
-              "sp": 5
-            },
-            {
-              "sn": 2,
-              "st": "The Benefits of Tech Consulting",
-              "sd": "Exploring the advantages of a career in tech consulting.",
-              "sp": 5
-            }
-          ]
-        },
-        {
-          "scn": 2,
-          "sct": "Essential Skills for Tech Consultants",
-          "scd": "A breakdown of the most important skills for success in tech consulting.",
-          "scp": 10,
-          "scs": [
-            {
-              "sn": 1,
-              "st": "Technical Expertise",
-              "sd": "Why a strong technical foundation is critical for tech consultants.",
-              "sp": 5
-            },
-            {
-              "sn": 2,
-              "st": "Communication Skills",
-              "sd": "How to effectively communicate with clients and team members.",
-              "sp": 5
-            }
-          ]
-        }
-      ]
-    
-  }
-]
-}
-"""
-        re = requests.get("http://ifconfig.me")
+        # Offline: run fake_openai.py and set OPENAI_API_BASE to its URL
         message_openai = f"{txt_who.value}\n\n{txt_structure.value}\n\n{txt_formatting.value}"
         logger.debug(f"Sending message: {message_openai}")
 
-        response2 = get_completion(message_openai)
-        logger.debug(f"Got response: {response}")
-        # try:
-        return json.loads(response)
+        # The outline is streamed, parsed and saved by a background job
+        return enqueue_job(
+            "outline",
+            {
+                "prompt": message_openai,
+                "format": sel_format.value,
+                "regenerate": regenerate,
+            },
+            book_id=book_id,
+        )
         # except Exception as e:
         #     print(e)
         #     return {"cs": []}
 
-    def chapters_to_tree(chapters):
-        logger.debug("Converting chapters to tree")
-        chapters_tree = []
-        for chapter in chapters["cs"]:
-            chapter_node = {
-                "id": str(chapter["cn"]),
-                # "description": chapter["ct"],
-                "description": (
-                    f"{chapter['ct']} - {chapter['cd']} " f"({chapter['cp']})"
-                ),
-                "children": [],
-            }
-            if chapter["ss"]:
-                for subchapter in chapter["ss"]:
-                    subchapter_node = {
-                        "id": str(chapter["cn"]) + "." + str(subchapter["scn"]),
-                        # "description": subchapter["sct"],
-                        "description": (
-                            f"{subchapter['sct']} - {subchapter['scd']} "
-                            f"({subchapter['scp']})"
-                        ),
-                        "children": [],
-                    }
-
-                    if subchapter["scs"]:
-                        for section in subchapter["scs"]:
-                            section_node = {
-                                "id": f"{chapter['cn']}.{subchapter['scn']}.{section['sn']}",
-                                "description": (
-                                    f"{section['st']} - {section['sd']} "
-                                    f"({section['sp']})"
-                                ),
-                            }
-                            subchapter_node["children"].append(section_node)
-                    chapter_node["children"].append(subchapter_node)
-            chapters_tree.append(chapter_node)
-        return [
-            {
-                "id": str(chapters["bt"]),
-                "description": chapters["ss"],
-                "children": chapters_tree,
-            }
-        ]
+    book_tree = None
+    book_id = None
 
-    def update_tree():
+    async def update_tree(regenerate: bool = False):
         print("Building the Book!")
-        tree_container.clear()
         logger.info("Building the Book!")
         ui.notify("Building the Book!")
         # message = f"{txt_who.value}\n\n{txt_structure.value}\n\n{txt_formatting.value}"
@@ -317,203 +355,169 @@ async def page_layout(client: Client):
         # print(response)
         logger.debug("Getting chapters")
 
-        logger.debug("This is the one that works")
-        working_tree_array = [
-            {
-                "id": "The Tech Consultant's Guide: From Code to Consulting",
-                "description": "A Practical Handbook for Aspiring Tech Consultants",
-                "children": [
-                    {
-                        "id": "1",
-                        "description": "Introduction to Tech Consulting - An overview of the tech consulting industry, the skills required, and the opportunities available. (20)",
-                        "children": [
-                            {
-                                "id": "1.1",
-                                "description": "What is Tech Consulting? - A definition of tech consulting and its role in the modern business world. (10)",
-                                "children": [
-                                    {
-                                        "id": "1.1.1",
-                                        "description": "The History of Tech Consulting - A brief look at the evolution of tech consulting and its impact on the industry. (5)",
-                                    },
-                                    {
-                                        "id": "1.1.2",
-                                        "description": "The Benefits of Tech Consulting - An exploration of the advantages of hiring a tech consultant for your business. (5)",
-                                    },
-                                ],
-                            },
-                            {
-                                "id": "1.2",
-                                "description": "The Skills Required for Tech Consulting - An examination of the key skills and competencies needed to succeed as a tech consultant. (10)",
-                                "children": [
-                                    {
-                                        "id": "1.2.1",
-                                        "description": "Technical Skills - A discussion of the technical skills required for tech consulting, including programming languages, software development tools, and data analysis techniques. (5)",
-                                    },
-                                    {
-                                        "id": "1.2.2",
-                                        "description": "Soft Skills - An exploration of the soft skills that are essential for success in tech consulting, such as communication, problem-solving, and teamwork. (5)",
-                                    },
-                                ],
-                            },
-                        ],
-                    },
-                    {
-                        "id": "2",
-                        "description": "Building Your Tech Consulting Business - A guide to starting and growing your own tech consulting business, including marketing, sales, and client management. (100)",
-                        "children": [
-                            {
-                                "id": "2.1",
-                                "description": "Setting Up Your Business - A step-by-step guide to setting up your tech consulting business, including legal and financial considerations. (20)",
-                                "children": [
-                                    {
-                                        "id": "2.1.1",
-                                        "description": "Choosing a Business Structure - An overview of the different legal structures available for your tech consulting business, and the pros and cons of each. (5)",
-                                    },
-                                    {
-                                        "id": "2.1.2",
-                                        "description": "Managing Your Finances - A guide to managing your finances as a tech consultant, including budgeting, invoicing, and taxes. (5)",
-                                    },
-                                    {
-                                        "id": "2.1.3",
-                                        "description": "Marketing Your Business - A crash course in marketing for tech consultants, including branding, social media, and content creation. (10)",
-                                    },
-                                ],
-                            },
-                            {
-                                "id": "2.2",
-                                "description": "Finding and Managing Clients - A comprehensive guide to finding and managing clients as a tech consultant, including sales techniques, client communication, and project management. (80)",
-                                "children": [
-                                    {
-                                        "id": "2.2.1",
-                                        "description": "Sales Techniques for Tech Consultants - An overview of the sales process for tech consultants, including prospecting, lead generation, and closing deals. (20)",
-                                    },
-                                    {
-                                        "id": "2.2.2",
-                                        "description": "Client Communication and Management - A guide to communicating effectively with clients and managing their expectations throughout the project lifecycle. (30)",
-                                    },
-                                    {
-                                        "id": "2.2.3",
-                                        "description": "Project Management for Tech Consultants - An introduction to project management principles and techniques for tech consultants, including agile methodologies and project planning tools. (30)",
-                                    },
-                                ],
-                            },
-                        ],
-                    },
-                    {
-                        "id": "3",
-                        "description": "Advanced Tech Consulting Techniques - A deep dive into advanced tech consulting techniques, including data analysis, machine learning, and cloud computing. (200)",
-                        "children": [
-                            {
-                                "id": "3.1",
-                                "description": "Data Analysis for Tech Consultants - An in-depth look at data analysis techniques for tech consultants, including data visualization, statistical analysis, and predictive modeling. (50)",
-                                "children": [
-                                    {
-                                        "id": "3.1.1",
-                                        "description": "Data Visualization Techniques - An exploration of the different data visualization tools and techniques available for tech consultants, including charts, graphs, and dashboards. (20)",
-                                    },
-                                    {
-                                        "id": "3.1.2",
-                                        "description": "Statistical Analysis for Tech Consultants - A guide to statistical analysis techniques for tech consultants, including hypothesis testing, regression analysis, and variance analysis. (20)",
-                                    },
-                                    {
-                                        "id": "3.1.3",
-                                        "description": "Predictive Modeling for Tech Consultants - An introduction to predictive modeling techniques for tech consultants, including machine learning algorithms and data mining tools. (10)",
-                                    },
-                                ],
-                            },
-                            {
-                                "id": "3.2",
-                                "description": "Cloud Computing for Tech Consultants - A guide to cloud computing technologies and their applications for tech consultants, including infrastructure as a service, platform as a service, and software as a service. (50)",
-                                "children": [
-                                    {
-                                        "id": "3.2.1",
-                                        "description": "Infrastructure as a Service - An overview of infrastructure as a service (IaaS) and its applications for tech consultants, including cloud storage, virtual machines, and networking. (20)",
-                                    },
-                                    {
-                                        "id": "3.2.2",
-                                        "description": "Platform as a Service - A guide to platform as a service (PaaS) and its applications for tech consultants, including cloud development platforms and database services. (20)",
-                                    },
-                                    {
-                                        "id": "3.2.3",
-                                        "description": "Software as a Service - An introduction to software as a service (SaaS) and its applications for tech consultants, including cloud-based productivity tools and enterprise software solutions. (10)",
-                                    },
-                                ],
-                            },
-                            {
-                                "id": "3.3",
-                                "description": "Emerging Technologies for Tech Consultants - A look at emerging technologies that are shaping the future of tech consulting, including blockchain, artificial intelligence, and the internet of things. (100)",
-                                "children": [
-                                    {
-                                        "id": "3.3.1",
-                                        "description": "Blockchain for Tech Consultants - An overview of blockchain technology and its applications for tech consultants, including smart contracts, decentralized applications, and cryptocurrency. (30)",
-                                    },
-                                    {
-                                        "id": "3.3.2",
-                                        "description": "Artificial Intelligence for Tech Consultants - A guide to artificial intelligence technologies and their applications for tech consultants, including natural language processing, computer vision, and machine learning. (30)",
-                                    },
-                                    {
-                                        "id": "3.3.3",
-                                        "description": "The Internet of Things for Tech Consultants - An introduction to the internet of things (IoT) and its applications for tech consultants, including smart homes, connected cars, and industrial automation. (40)",
-                                    },
-                                ],
-                            },
-                        ],
-                    },
-                ],
-            }
-        ]
-
-        # chapters_raw = get_chapters()
-        # tree_array = chapters_to_tree(chapters_raw)
-        tree_array = ""
-
-        def print_dict_types(d, key=None, level=0):
-            indent = "-" * level
-            logger.debug(f"{indent}Key: {key}, Type: {type(d)}")
-            if isinstance(d, dict):
-                for k, v in d.items():
-                    print_dict_types(v, k, level + 1)
-            elif isinstance(d, list):
-                for i, item in enumerate(d):
-                    print_dict_types(item, i, level + 1)
-
-        # print_dict_types(tree_array)
-        logger.debug(f"Tree Array\n\n\n {tree_array}\n\n\n")
-        logger.debug(f"Working Tree Array\n\n\n {working_tree_array}\n\n\n")
-        logger.debug(f"tree array type: {type(tree_array)}")
-        try:
-            logger.debug(f"tree array and childs type: {type(tree_array[0])}")
-        except Exception:
-            pass
-        logger.debug("Tree arrary done")
-        # time.sleep(1)
-        with tree_container:
-            logger.debug("with tree_container")
-            global book_tree
-            book_tree = ui.tree(
-                working_tree_array,
-                label_key="id",
-            ).add_slot(
-                "default-body",
-                '<span :props="props">Description: "{{ props.node.description }}"</span>',
-            )
-            logger.debug("Did it show? The tree?")
+        job_id = get_chapters(regenerate)
+        app.storage.user["outline_job"] = job_id
+        follow_outline(job_id)
 
         # book_tree = None
         # entire_answer_container.clear()
         # with entire_answer_container:
         #     ui.label(response)
 
+    def follow_outline(job_id: int) -> None:
+        """Grow the tree from the nodes streamed by an outline job."""
+        nonlocal book_tree
+        if book_tree is None:
+            with tree_container:
+                book_tree = ui.tree([], label_key="id")
+                book_tree.add_slot(
+                    "default-body",
+                    '<span :props="props">Description: "{{ props.node.description }}"</span>',
+                )
+        builder = OutlineTreeBuilder()
+        last_update = 0.0
+
+        async def on_outline(status, event):
+            nonlocal book_id, last_update
+            if book_tree.is_deleted:
+                unsubscribe()
+                return
+            outline_label.text = f"Outline job {status.id}: {status.state}"
+            if event:
+                builder.apply(event["nodes"])
+                now = time.monotonic()
+                if now - last_update >= STREAM_UPDATE_INTERVAL:
+                    # Overlay the partial outline; nodes not streamed yet stay
+                    await patch_tree(book_tree, builder.nodes, prune=False)
+                    last_update = now
+            elif status.state == SUCCEEDED:
+                book_id = status.result["book_id"]
+                tree_array = chapters_to_tree(status.result["outline"])
+                logger.debug(f"Tree Array\n\n\n {tree_array}\n\n\n")
+                await patch_tree(book_tree, tree_array)
+                logger.debug("Did it show? The tree?")
+            elif status.state == FAILED:
+                with client:
+                    ui.notify(f"Outline failed: {status.error}", color="negative")
+
+        unsubscribe = subscribe(job_id, on_outline)
+
+    def follow_content(job_id: int) -> None:
+        """Show the progress of a content job."""
+
+        def on_content(status, event):
+            if content_progress.is_deleted:
+                unsubscribe()
+                return
+            content_label.text = (
+                f"Content job {status.id}: {status.state} "
+                f"({status.progress_done}/{status.progress_total} sections)"
+            )
+            if status.progress_total:
+                content_progress.value = status.progress_done / status.progress_total
+            if status.state == FAILED:
+                with client:
+                    ui.notify(f"Writing failed: {status.error}", color="negative")
+
+        unsubscribe = subscribe(job_id, on_content)
+
     def expand_all():
-        book_tree.tree.expand_all()
+        if book_tree is None:
+            return
+        book_tree.expand()
+
+    def write_book():
+        if book_id is None:
+            ui.notify("Build the chapters first", color="warning")
+            return
+        job_id = enqueue_job(
+            "content", {"system_message": txt_who.value}, book_id=book_id
+        )
+        app.storage.user["content_job"] = job_id
+        follow_content(job_id)
+
+    def rebuild_book():
+        if book_id is None:
+            ui.notify("Build the chapters first", color="warning")
+            return
+        # Dry run first, so the cost is known before any call is made
+        stale, total = count_pending_sections(
+            book_id, rebuild=True, system_message=txt_who.value
+        )
+        if not stale:
+            ui.notify(f"All {total} sections are up to date")
+            return
+
+        def confirm():
+            dialog.close()
+            job_id = enqueue_job(
+                "content",
+                {"system_message": txt_who.value, "rebuild": True},
+                book_id=book_id,
+            )
+            app.storage.user["content_job"] = job_id
+            follow_content(job_id)
+
+        with ui.dialog() as dialog, ui.card():
+            ui.label(f"{stale} of {total} sections are stale. Rebuild them?")
+            with ui.row():
+                ui.button("Rebuild", on_click=confirm)
+                ui.button("Cancel", on_click=dialog.close)
+        dialog.open()
 
     ui.button("Expand All", on_click=expand_all)
     ui.button("Build Chapters!", on_click=update_tree)
+    # The same prompts give the cached outline; this asks for a new one
+    ui.button("Regenerate Chapters", on_click=lambda: update_tree(regenerate=True))
+    ui.button("Write Book", on_click=write_book)
+    ui.button("Rebuild Book", on_click=rebuild_book)
+    outline_label = ui.label()
+    content_label = ui.label()
+    content_progress = ui.linear_progress(value=0, show_value=False)
     tree_container = ui.row()
 
+    # Pick up the jobs of this user again after a reload or reconnect
+    if app.storage.user.get("outline_job"):
+        follow_outline(app.storage.user["outline_job"])
+    if app.storage.user.get("content_job"):
+        follow_content(app.storage.user["content_job"])
+
     # entire_answer_container = ui.row()
 
 
+def active_clients() -> int:
+    clients = nicegui_globals.clients.values()
+    return sum(client.has_socket_connection for client in clients)
+
+
+metrics.Gauge(
+    "nicegui_active_clients", "Connected NiceGUI clients.", function=active_clients
+)
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+async def evict_conversations() -> None:
+    """Drop the chat memory of idle users now and then."""
+    while True:
+        await asyncio.sleep(EVICTION_INTERVAL)
+        evict_idle_conversations()
+
+
+app.on_startup(start_workers)
+app.on_startup(evict_conversations)
+app.on_shutdown(stop_workers)
+app.on_shutdown(close_async_client)
+app.on_shutdown(flush_cache)
+
 if __name__ in {"__main__", "__mp_main__"}:
+    initialize_logger(
+        "",
+        use_queue=True,
+        max_message_length=LOG_MESSAGE_LENGTH,
+        levels=LOG_LEVELS,
+    )
     ui.run(storage_secret="THIS_NEEDS_TO_BE_CHANGED", port=81)
-    logger = initialize_logger(__name__)
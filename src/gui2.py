@@ -1,5 +1,4 @@
-from typing import Optional
-from pydantic import BaseModel
+from book_models import Book, Chapter, Section, Subchapter
 from logger import initialize_logger
 import logging
 from nicegui import app, ui, Client
@@ -7,38 +6,6 @@ from nicegui import app, ui, Client
 logger = logging.getLogger(__name__)
 
 
-class Section(BaseModel):
-    id: str
-    title: Optional[str]
-    description: Optional[str]
-    content: Optional[str]
-    pages: Optional[int]
-
-
-class Subchapter(BaseModel):
-    id: str
-    title: Optional[str]
-    description: Optional[str]
-    pages: Optional[int]
-    sections: list[Section]
-
-
-class Chapter(BaseModel):
-    id: str
-    title: Optional[str]
-    description: str
-    pages: Optional[int]
-    subchapters: list[Subchapter]
-
-
-class Book(BaseModel):
-    id: str
-    title: Optional[str]
-    description: str
-    pages: Optional[int]
-    chapters: list[Chapter]
-
-
 book = Book(
     id="The Tech Consultant's Guide: From Code to Consulting",
     description="A Practical Handbook for Aspiring Tech Consultants",
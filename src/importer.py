@@ -0,0 +1,142 @@
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert
+
+from metrics import DB_SAVE_SECONDS
+from model import Book, Chapter, Section, SectionBody, Subchapter, session_scope
+from outline_index import CHAPTER, SECTION, SUBCHAPTER, OutlineIndex
+
+logger = logging.getLogger(__name__)
+
+# Ids per DELETE statement, well below SQLite's limit on bound parameters.
+DELETE_BATCH_SIZE = 500
+
+
+@dataclass
+class ImportResult:
+    book_id: int
+    rows: int
+    seconds: float
+    deleted: int = 0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else float("inf")
+
+
+def _upsert(session, model, rows: List[dict]) -> None:
+    """Insert `rows` in one executemany, updating rows whose path exists."""
+    if not rows:
+        return
+    stmt = insert(model)
+    stmt = stmt.on_conflict_do_update(
+        # The unique (book_id, path) index of every outline table
+        index_elements=["book_id", "path"],
+        set_={
+            "title": stmt.excluded.title,
+            "description": stmt.excluded.description,
+            "pages": stmt.excluded.pages,
+        },
+    )
+    session.execute(stmt, rows)
+
+
+def _ids_by_path(session, model, book_id: int) -> Dict[str, int]:
+    return dict(
+        session.execute(
+            select(model.path, model.id).where(model.book_id == book_id)
+        ).all()
+    )
+
+
+def _delete_missing(session, model, book_id: int, rows: List[dict]) -> int:
+    """Delete the rows of `model` in the book whose path is not in `rows`."""
+    paths = {row["path"] for row in rows}
+    stale = [
+        row_id
+        for path, row_id in _ids_by_path(session, model, book_id).items()
+        if path not in paths
+    ]
+    for start in range(0, len(stale), DELETE_BATCH_SIZE):
+        batch = stale[start : start + DELETE_BATCH_SIZE]
+        if model is Section:
+            # Bulk deletes skip the ORM cascade to the bodies
+            session.execute(
+                delete(SectionBody).where(SectionBody.section_id.in_(batch))
+            )
+        session.execute(delete(model).where(model.id.in_(batch)))
+    return len(stale)
+
+
+def import_outline(
+    outline: dict,
+    book_id: Optional[int] = None,
+) -> ImportResult:
+    """Write a parsed compact outline into the database in one transaction.
+
+    Chapters, subchapters and sections are bulk upserted level by level,
+    matched on their outline path (e.g. "1.2.3"), so importing into an existing
+    book updates titles, descriptions and pages and keeps generated content.
+    Rows of the book that are not in the new outline are deleted, with the
+    content of their sections.
+
+    Args:
+        outline (dict): Outline with the `bt`/`cs`/`ss`/`scs` keys.
+        book_id (int, optional): Existing book to upsert into. A new book is
+            created when omitted.
+
+    Returns:
+        ImportResult: Book id, number of rows written and deleted, and
+        elapsed time.
+    """
+    start = time.perf_counter()
+    index = OutlineIndex.from_compact(outline)
+    with session_scope() as session:
+        book = session.get(Book, book_id) if book_id is not None else None
+        if book is None:
+            book = Book(id=book_id)
+            session.add(book)
+        book.title = index.title
+        book.subtitle = index.subtitle
+        session.flush()
+
+        chapter_rows = index.to_rows(CHAPTER, book.id)
+        _upsert(session, Chapter, chapter_rows)
+        subchapter_rows = index.to_rows(
+            SUBCHAPTER, book.id, "chapter_id", _ids_by_path(session, Chapter, book.id)
+        )
+        _upsert(session, Subchapter, subchapter_rows)
+        section_rows = index.to_rows(
+            SECTION,
+            book.id,
+            "subchapter_id",
+            _ids_by_path(session, Subchapter, book.id),
+        )
+        _upsert(session, Section, section_rows)
+        # Children first, so no row is left pointing to a deleted parent
+        deleted = sum(
+            _delete_missing(session, model, book.id, rows)
+            for model, rows in (
+                (Section, section_rows),
+                (Subchapter, subchapter_rows),
+                (Chapter, chapter_rows),
+            )
+        )
+        book_id = book.id
+
+    result = ImportResult(
+        book_id=book_id,
+        rows=1 + len(chapter_rows) + len(subchapter_rows) + len(section_rows),
+        seconds=time.perf_counter() - start,
+        deleted=deleted,
+    )
+    DB_SAVE_SECONDS.observe(result.seconds, operation="import_outline")
+    logger.info(
+        f"Imported {result.rows} rows into book {result.book_id}, deleted "
+        f"{result.deleted} ({result.rows_per_second:.0f} rows/s)"
+    )
+    return result
@@ -0,0 +1,528 @@
+import asyncio
+import datetime
+import functools
+import inspect
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import or_, update
+
+from generation import count_pending_sections, generate_book_content
+from importer import import_outline
+from llm import astream_completion
+from metrics import JOB_RETRIES
+from model import Job, Section, Session, session_scope
+from outline_format import get_format
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+WORKERS = 2
+MAX_ATTEMPTS = 3
+# Seconds before the first retry; doubled on every further attempt.
+RETRY_DELAY = 10.0
+# Seconds an idle worker sleeps before looking for due jobs again.
+POLL_INTERVAL = 1.0
+# Seconds between heartbeats of running jobs. A running job without a
+# heartbeat for LEASE_TIMEOUT seconds belongs to a process that is gone.
+HEARTBEAT_INTERVAL = 10.0
+LEASE_TIMEOUT = 60.0
+
+
+@dataclass
+class JobStatus:
+    id: int
+    kind: str
+    state: str
+    book_id: Optional[int]
+    progress_done: int
+    progress_total: int
+    attempts: int
+    error: Optional[str]
+    result: Optional[dict]
+
+    @property
+    def finished(self) -> bool:
+        return self.state in FINISHED_STATES
+
+
+# Called with the job status and an event published by the job (or None for
+# a plain status change); may return an awaitable.
+Listener = Callable[[JobStatus, Optional[dict]], Optional[Awaitable[None]]]
+
+_handlers: Dict[str, Callable[["JobContext"], Awaitable[Optional[dict]]]] = {}
+_listeners: Dict[int, List[Listener]] = {}
+# Events published by running jobs, replayed to late subscribers.
+_events: Dict[int, List[dict]] = {}
+# Pending coroutines returned by listeners, kept so they are not collected.
+_listener_tasks: set = set()
+_pool: Optional["WorkerPool"] = None
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.utcnow()
+
+
+def _status(job: Job) -> JobStatus:
+    return JobStatus(
+        id=job.id,
+        kind=job.kind,
+        state=job.state,
+        book_id=job.book_id,
+        progress_done=job.progress_done,
+        progress_total=job.progress_total,
+        attempts=job.attempts,
+        error=job.error,
+        result=job.result,
+    )
+
+
+def job_handler(kind: str):
+    """Register the coroutine function that runs jobs of `kind`."""
+
+    def register(handler):
+        _handlers[kind] = handler
+        return handler
+
+    return register
+
+
+def enqueue_job(
+    kind: str,
+    payload: Optional[dict] = None,
+    book_id: Optional[int] = None,
+    max_attempts: int = MAX_ATTEMPTS,
+) -> int:
+    """Store a new job and wake up the worker pool.
+
+    Args:
+        kind (str): Registered job kind, e.g. "outline" or "content".
+        payload (dict, optional): JSON-serializable job arguments.
+        book_id (int, optional): Book the job works on.
+        max_attempts (int): Attempts before the job is marked failed.
+
+    Returns:
+        int: Id of the queued job.
+    """
+    if kind not in _handlers:
+        raise ValueError(f"Unknown job kind: {kind}")
+    with session_scope() as session:
+        job = Job(
+            kind=kind,
+            state=QUEUED,
+            payload=payload or {},
+            book_id=book_id,
+            max_attempts=max_attempts,
+            created_at=_now(),
+            run_after=_now(),
+        )
+        session.add(job)
+        session.flush()
+        job_id = job.id
+    logger.info(f"Queued {kind} job {job_id}")
+    if _pool is not None:
+        _pool.wake()
+    return job_id
+
+
+def get_job(job_id: int) -> Optional[JobStatus]:
+    with Session() as session:
+        job = session.get(Job, job_id)
+        return _status(job) if job is not None else None
+
+
+def cancel_job(job_id: int) -> bool:
+    """Cancel a queued or running job.
+
+    Returns:
+        bool: Whether the job was still unfinished.
+    """
+    with session_scope() as session:
+        cancelled = session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.state.in_([QUEUED, RUNNING]))
+            .values(state=CANCELLED, finished_at=_now())
+        ).rowcount
+    if not cancelled:
+        return False
+    if _pool is not None:
+        _pool.cancel(job_id)
+    _notify(job_id)
+    return True
+
+
+def subscribe(job_id: int, listener: Listener) -> Callable[[], None]:
+    """Call `listener` on every progress update of a job.
+
+    The listener is called right away with the current status and any
+    events the job published so far, so pages opened while a job runs
+    catch up with it.
+
+    Returns:
+        Callable[[], None]: Function that removes the listener again.
+    """
+    _listeners.setdefault(job_id, []).append(listener)
+    status = get_job(job_id)
+    if status is not None:
+        _call(listener, status, None)
+        for event in list(_events.get(job_id, [])):
+            _call(listener, status, event)
+
+    def unsubscribe() -> None:
+        listeners = _listeners.get(job_id, [])
+        if listener in listeners:
+            listeners.remove(listener)
+        if not listeners:
+            _listeners.pop(job_id, None)
+
+    return unsubscribe
+
+
+def _call(listener: Listener, status: JobStatus, event: Optional[dict]) -> None:
+    try:
+        result = listener(status, event)
+        if inspect.isawaitable(result):
+            task = asyncio.ensure_future(result)
+            _listener_tasks.add(task)
+            task.add_done_callback(functools.partial(_listener_done, status.id))
+    except Exception:
+        logger.exception(f"Listener of job {status.id} failed")
+
+
+def _listener_done(job_id: int, task: asyncio.Future) -> None:
+    _listener_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Listener of job {job_id} failed", exc_info=task.exception())
+
+
+def _notify(job_id: int, event: Optional[dict] = None) -> None:
+    listeners = list(_listeners.get(job_id, []))
+    if not listeners:
+        return
+    status = get_job(job_id)
+    if status is None:
+        return
+    for listener in listeners:
+        _call(listener, status, event)
+
+
+class JobContext:
+    """What a running job sees: its arguments and a way to report progress."""
+
+    def __init__(self, job: Job) -> None:
+        self.id = job.id
+        self.kind = job.kind
+        self.payload = job.payload or {}
+        self.book_id = job.book_id
+        self.attempt = job.attempts
+        self.progress_done = job.progress_done
+        self.progress_total = job.progress_total
+
+    def progress(self, done: int, total: Optional[int] = None) -> None:
+        """Store the progress counters and tell the subscribers."""
+        self.progress_done = done
+        if total is not None:
+            self.progress_total = total
+        with session_scope() as session:
+            session.execute(
+                update(Job)
+                .where(Job.id == self.id)
+                .values(
+                    progress_done=self.progress_done,
+                    progress_total=self.progress_total,
+                    book_id=self.book_id,
+                )
+            )
+        _notify(self.id)
+
+    def publish(self, event: dict) -> None:
+        """Send an event, such as streamed outline nodes, to subscribers."""
+        _events.setdefault(self.id, []).append(event)
+        _notify(self.id, event)
+
+
+def _claim_next_job() -> Optional[JobContext]:
+    """Mark the oldest due queued job as running and return it.
+
+    The state is switched with a conditional UPDATE, so a job is only ever
+    claimed by one worker even if several processes share the database;
+    the claiming pool keeps its heartbeat fresh while it runs.
+    """
+    with session_scope() as session:
+        candidates = (
+            session.query(Job.id)
+            .filter(Job.state == QUEUED, Job.run_after <= _now())
+            .order_by(Job.run_after, Job.id)
+            .limit(4)
+            .all()
+        )
+        for (job_id,) in candidates:
+            claimed = session.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.state == QUEUED)
+                .values(
+                    state=RUNNING,
+                    attempts=Job.attempts + 1,
+                    started_at=_now(),
+                    heartbeat_at=_now(),
+                    error=None,
+                )
+            ).rowcount
+            if claimed:
+                return JobContext(session.get(Job, job_id))
+    return None
+
+
+def _requeue(*conditions) -> int:
+    # The attempt is not counted, as the job did not fail
+    with session_scope() as session:
+        return session.execute(
+            update(Job)
+            .where(Job.state == RUNNING, *conditions)
+            .values(state=QUEUED, attempts=Job.attempts - 1, run_after=_now())
+        ).rowcount
+
+
+def requeue_interrupted_jobs(lease_timeout: float = LEASE_TIMEOUT) -> int:
+    """Put jobs left running by a crashed process back in the queue.
+
+    Only jobs without a heartbeat for `lease_timeout` seconds are taken;
+    jobs that workers in other processes are still running keep theirs
+    fresh and are left alone.
+    """
+    cutoff = _now() - datetime.timedelta(seconds=lease_timeout)
+    count = _requeue(or_(Job.heartbeat_at.is_(None), Job.heartbeat_at < cutoff))
+    if count:
+        logger.warning(f"Requeued {count} interrupted jobs")
+    return count
+
+
+def _touch_jobs(job_ids: List[int]) -> None:
+    with session_scope() as session:
+        session.execute(
+            update(Job)
+            .where(Job.id.in_(job_ids), Job.state == RUNNING)
+            .values(heartbeat_at=_now())
+        )
+
+
+class WorkerPool:
+    """Asyncio workers that run queued jobs from the `jobs` table.
+
+    Job state lives in the database, so a job outlives the page that queued
+    it. Jobs still running when the pool stops go back to the queue; those
+    of a crashed process are requeued once their heartbeat is older than
+    `lease_timeout`. Either way they continue from their last saved
+    progress.
+    """
+
+    def __init__(
+        self,
+        size: int = WORKERS,
+        poll_interval: float = POLL_INTERVAL,
+        heartbeat_interval: float = HEARTBEAT_INTERVAL,
+        lease_timeout: float = LEASE_TIMEOUT,
+    ):
+        self.size = size
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.lease_timeout = lease_timeout
+        self._workers: List[asyncio.Task] = []
+        self._running: Dict[int, asyncio.Task] = {}
+        self._cancelled: set = set()
+        self._wakeup = asyncio.Event()
+
+    def start(self) -> None:
+        requeue_interrupted_jobs(self.lease_timeout)
+        self._workers = [asyncio.ensure_future(self._work(n)) for n in range(self.size)]
+        self._workers.append(asyncio.ensure_future(self._heartbeat()))
+        logger.info(f"Started {self.size} job workers")
+
+    async def stop(self) -> None:
+        """Stop the workers and put the jobs they were running back in the queue."""
+        running = list(self._running)
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if running:
+            count = _requeue(Job.id.in_(running))
+            logger.info(f"Requeued {count} running jobs")
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                if self._running:
+                    _touch_jobs(list(self._running))
+                requeue_interrupted_jobs(self.lease_timeout)
+            except Exception:
+                logger.exception("Failed to update job heartbeats")
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    def cancel(self, job_id: int) -> None:
+        task = self._running.get(job_id)
+        if task is not None:
+            self._cancelled.add(job_id)
+            task.cancel()
+
+    async def _work(self, worker: int) -> None:
+        while True:
+            try:
+                ctx = _claim_next_job()
+            except Exception:
+                logger.exception("Failed to claim a job")
+                ctx = None
+            if ctx is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            logger.info(f"Worker {worker} runs {ctx.kind} job {ctx.id}")
+            handler = _handlers.get(ctx.kind)
+            if handler is None:
+                _fail(ctx, ValueError(f"Unknown job kind: {ctx.kind}"))
+                continue
+            task = asyncio.ensure_future(handler(ctx))
+            self._running[ctx.id] = task
+            _notify(ctx.id)
+            try:
+                result = await task
+            except asyncio.CancelledError:
+                if ctx.id not in self._cancelled:
+                    # The worker itself is stopping; `stop` requeues the job
+                    raise
+                self._cancelled.discard(ctx.id)
+                logger.info(f"Cancelled {ctx.kind} job {ctx.id}")
+            except Exception as e:
+                logger.exception(f"{ctx.kind} job {ctx.id} failed")
+                _fail(ctx, e)
+            else:
+                _finish(ctx, result)
+            finally:
+                self._running.pop(ctx.id, None)
+            _notify(ctx.id)
+            _events.pop(ctx.id, None)
+
+
+def _finish(ctx: JobContext, result: Optional[dict]) -> None:
+    with session_scope() as session:
+        session.execute(
+            update(Job)
+            .where(Job.id == ctx.id, Job.state == RUNNING)
+            .values(
+                state=SUCCEEDED,
+                result=result,
+                book_id=ctx.book_id,
+                finished_at=_now(),
+            )
+        )
+
+
+def _fail(ctx: JobContext, error: Exception) -> None:
+    with session_scope() as session:
+        job = session.get(Job, ctx.id)
+        if job.state != RUNNING:
+            return
+        job.error = f"{type(error).__name__}: {error}"
+        job.book_id = ctx.book_id
+        if job.attempts < job.max_attempts:
+            job.state = QUEUED
+            job.run_after = _now() + datetime.timedelta(
+                seconds=RETRY_DELAY * 2 ** (job.attempts - 1)
+            )
+            JOB_RETRIES.inc(kind=job.kind)
+            logger.info(f"Retrying job {ctx.id} after {job.run_after}")
+        else:
+            job.state = FAILED
+            job.finished_at = _now()
+
+
+def start_workers(size: int = WORKERS) -> None:
+    """Start the shared worker pool (call from `app.on_startup`)."""
+    global _pool
+    if _pool is None:
+        _pool = WorkerPool(size)
+        _pool.start()
+
+
+async def stop_workers() -> None:
+    global _pool
+    if _pool is not None:
+        await _pool.stop()
+        _pool = None
+
+
+@job_handler("outline")
+async def run_outline_job(ctx: JobContext) -> dict:
+    """Stream an outline, publishing nodes as they arrive, and store it.
+
+    Payload: `prompt`, `format`, the name of the outline format the prompt
+    asks for (see outline_format.FORMATS), and optional `system_message`.
+    The same prompt is answered from the completion cache unless the
+    payload sets `regenerate`. The outline is upserted into `ctx.book_id`
+    when set, otherwise into a new book.
+    """
+    _events.pop(ctx.id, None)
+    outline_format = get_format(ctx.payload["format"])
+    parser = outline_format.stream_parser()
+    async for token in astream_completion(
+        ctx.payload["prompt"],
+        ctx.payload.get("system_message"),
+        use_cache=True,
+        refresh=ctx.payload.get("regenerate", False),
+    ):
+        events = parser.feed(token)
+        if events:
+            ctx.publish({"nodes": events})
+    outline = outline_format.decode(parser.text)
+    imported = import_outline(outline, ctx.book_id)
+    ctx.book_id = imported.book_id
+    ctx.progress(imported.rows, imported.rows)
+    return {"book_id": imported.book_id, "rows": imported.rows, "outline": outline}
+
+
+@job_handler("content")
+async def run_content_job(ctx: JobContext) -> dict:
+    """Write the sections of `ctx.book_id` that have no content yet.
+
+    With `rebuild` in the payload, sections whose inputs changed since they
+    were written are regenerated too, and nothing else.
+
+    Every section is committed as soon as it is written, so a retried or
+    requeued job resumes after the last completed section. Sections that
+    still fail make the attempt fail, and the next attempt picks them up.
+
+    Payload: optional `system_message`, `concurrency` and `rebuild`.
+    """
+    system_message = ctx.payload.get("system_message")
+    rebuild = ctx.payload.get("rebuild", False)
+    pending, total = count_pending_sections(ctx.book_id, rebuild, system_message)
+    ctx.progress(total - pending, total)
+
+    def on_section_done(section: Section) -> None:
+        ctx.progress(ctx.progress_done + 1)
+
+    await generate_book_content(
+        ctx.book_id,
+        system_message=system_message,
+        concurrency=ctx.payload.get("concurrency", 8),
+        on_section_done=on_section_done,
+        rebuild=rebuild,
+    )
+    if ctx.progress_done < total:
+        raise RuntimeError(
+            f"{total - ctx.progress_done} of {total} sections are still missing"
+        )
+    return {"book_id": ctx.book_id, "sections": total}
@@ -1,9 +1,68 @@
-from typing import Optional
+import asyncio
+import functools
+import os
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+import aiohttp
 import openai
 import logging
+from dotenv import find_dotenv, load_dotenv
+
+from cache import get_cache, make_key
+from metrics import (
+    LLM_RETRIES,
+    LLM_TIME_TO_FIRST_TOKEN,
+    record_llm_call,
+    record_llm_tokens,
+)
 
 logger = logging.getLogger(__name__)
 
+# Shared async client settings. The pool is sized a bit above the concurrency
+# limit so that keep-alive connections can be reused between requests.
+MAX_CONCURRENT_REQUESTS = 8
+POOL_SIZE = 16
+KEEPALIVE_TIMEOUT = 30
+DEFAULT_TIMEOUT = 120
+# Rough OpenAI heuristic, good enough for budgeting requests.
+CHARS_PER_TOKEN = 4
+DEFAULT_API_BASE = "https://api.openai.com/v1"
+# Requests failing with one of these are re-sent up to MAX_RETRIES times,
+# waiting RETRY_DELAY seconds and doubling it after every attempt.
+MAX_RETRIES = 2
+RETRY_DELAY = 1.0
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    openai.error.Timeout,
+    openai.error.RateLimitError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+)
+
+_session: Optional[aiohttp.ClientSession] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+# Upstream calls in flight by completion key, shared by identical requests.
+_inflight: Dict[str, asyncio.Task] = {}
+_settings_loaded = False
+
+
+def load_settings() -> None:
+    """Read `.env` into the environment and configure the OpenAI client.
+
+    Runs on the first completion call rather than at import, so importing
+    this module stays cheap. Values set in code (e.g. `openai.api_base` by
+    the benchmark) are left alone.
+    """
+    global _settings_loaded
+    if _settings_loaded:
+        return
+    load_dotenv(find_dotenv(usecwd=True))
+    if openai.api_key is None:
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+    if os.getenv("OPENAI_API_BASE") and openai.api_base == DEFAULT_API_BASE:
+        openai.api_base = os.environ["OPENAI_API_BASE"]
+    _settings_loaded = True
+
 
 def get_completion(
     prompt: str,
@@ -11,6 +70,7 @@ def get_completion(
     model: str = "gpt-3.5-turbo",
     temperature: float = 0.5,
     presence_penalty: float = 0,
+    use_cache: Optional[bool] = None,
 ) -> str:
     """Get the completion from the OpenAI API.
 
@@ -25,41 +85,376 @@ def get_completion(
             Positive values penalize new tokens based on whether they appear in
             the text so far, increasing the model's likelihood to talk about new
             topics.
+        use_cache (bool, optional): Serve and store the completion in the
+            disk cache. Defaults to on only at temperature 0, where the same
+            request should give the same answer; pass False to always send
+            a fresh request.
 
     Returns:
         str: Completion from the OpenAI API.
     """
-    if not 0 <= temperature <= 2:
-        raise ValueError("Temperature must be between 0 and 2.")
-    if not -2 <= presence_penalty <= 2:
-        raise ValueError("Presence penalty must be between -2 and 2.")
-    logger.info(f"Prompt: {prompt}")
-    response = _make_openai_request(
-        prompt, system_message, model, temperature, presence_penalty
-    )
+    _validate_params(temperature, presence_penalty)
+    load_settings()
+    logger.debug("Prompt: %s", prompt)
+    start = time.perf_counter()
+    key = make_key(model, system_message, prompt, temperature, presence_penalty)
+    use_cache = _cache_enabled(use_cache, temperature)
+    if use_cache:
+        cached = get_cache().get(key)
+        if cached is not None:
+            logger.debug("Response served from cache")
+            record_llm_call(model, "completion", "hit", "ok", _since(start))
+            return cached
+    try:
+        response = _make_openai_request(
+            prompt, system_message, model, temperature, presence_penalty
+        )
+    except Exception as e:
+        record_llm_call(model, "completion", "miss", _outcome(e), _since(start))
+        raise
     response_text = response.choices[0].message["content"]
-    logger.info(f"Response: {response_text}")
+    logger.debug("Response: %s", response_text)
+    _record_usage(response, model, prompt, system_message, response_text)
+    record_llm_call(model, "completion", "miss", "ok", _since(start))
+    if use_cache:
+        get_cache().set(key, response_text)
     return response_text
 
 
-def _make_openai_request(
+async def aget_completion(
+    prompt: str,
+    system_message: Optional[str] = None,
+    model: str = "gpt-3.5-turbo",
+    temperature: float = 0.5,
+    presence_penalty: float = 0,
+    timeout: float = DEFAULT_TIMEOUT,
+    use_cache: Optional[bool] = None,
+) -> str:
+    """Async counterpart of `get_completion`.
+
+    The request goes through a shared, keep-alive connection pool and waits
+    for a free slot if `MAX_CONCURRENT_REQUESTS` calls are already running,
+    so it never blocks the event loop. Identical requests made while one is
+    in flight share its upstream call and get the same result or error;
+    cancelling one caller does not cancel the call for the others.
+
+    Args:
+        prompt (str): Prompt to send to the API.
+        system_message (str, optional): System message to add before the prompt.
+        model (str, optional): OpenAI model. Defaults to "gpt-3.5-turbo".
+        temperature (float): Sampling temperature between 0 and 2.
+        presence_penalty (float): Presence penalty between -2.0 and 2.0.
+        timeout (float): Timeout for each attempt in seconds.
+        use_cache (bool, optional): Serve and store the completion in the
+            disk cache; by default only at temperature 0.
+
+    Returns:
+        str: Completion from the OpenAI API.
+    """
+    _validate_params(temperature, presence_penalty)
+    load_settings()
+    logger.debug("Prompt: %s", prompt)
+    start = time.perf_counter()
+    key = make_key(model, system_message, prompt, temperature, presence_penalty)
+    use_cache = _cache_enabled(use_cache, temperature)
+    if use_cache:
+        cached = get_cache().get(key)
+        if cached is not None:
+            logger.debug("Response served from cache")
+            record_llm_call(model, "completion", "hit", "ok", _since(start))
+            return cached
+    task = _inflight.get(key)
+    cache = "shared" if task is not None else "miss"
+    if task is None:
+        task = asyncio.ensure_future(
+            _afetch_completion(
+                key,
+                prompt,
+                system_message,
+                model,
+                temperature,
+                presence_penalty,
+                timeout,
+                use_cache,
+            )
+        )
+        _inflight[key] = task
+        task.add_done_callback(functools.partial(_forget_inflight, key))
+    else:
+        logger.info("Sharing identical in-flight request")
+    try:
+        response_text = await asyncio.shield(task)
+    except BaseException as e:
+        record_llm_call(model, "completion", cache, _outcome(e), _since(start))
+        raise
+    record_llm_call(model, "completion", cache, "ok", _since(start))
+    return response_text
+
+
+async def _afetch_completion(
+    key: str,
     prompt: str,
     system_message: Optional[str],
     model: str,
     temperature: float,
     presence_penalty: float,
-) -> dict:
-    """Make request to OpenAI API."""
+    timeout: float,
+    use_cache: bool,
+) -> str:
+    response = await _amake_openai_request(
+        prompt, system_message, model, temperature, presence_penalty, timeout
+    )
+    response_text = response.choices[0].message["content"]
+    logger.debug("Response: %s", response_text)
+    _record_usage(response, model, prompt, system_message, response_text)
+    if use_cache:
+        get_cache().set(key, response_text)
+    return response_text
+
+
+def _forget_inflight(key: str, task: asyncio.Task) -> None:
+    if _inflight.get(key) is task:
+        del _inflight[key]
+    if not task.cancelled():
+        # Mark the error as retrieved even if every caller went away
+        task.exception()
+
+
+async def astream_completion(
+    prompt: str,
+    system_message: Optional[str] = None,
+    model: str = "gpt-3.5-turbo",
+    temperature: float = 0.5,
+    presence_penalty: float = 0,
+    timeout: float = DEFAULT_TIMEOUT,
+    use_cache: Optional[bool] = None,
+    refresh: bool = False,
+) -> AsyncIterator[str]:
+    """Stream the completion from the OpenAI API token by token.
+
+    Takes the same arguments as `aget_completion`. A cached completion is
+    yielded as a single chunk; a fresh one is stored in the cache once the
+    stream has been fully consumed. With `refresh`, the cached completion is
+    skipped and the fresh one replaces it. Only opening the stream is
+    retried; an error after the first token is raised to the caller.
+
+    Yields:
+        str: Pieces of the completion as they arrive.
+    """
+    _validate_params(temperature, presence_penalty)
+    load_settings()
+    logger.debug("Prompt: %s", prompt)
+    start = time.perf_counter()
+    key = make_key(model, system_message, prompt, temperature, presence_penalty)
+    use_cache = _cache_enabled(use_cache, temperature)
+    if use_cache and not refresh:
+        cached = get_cache().get(key)
+        if cached is not None:
+            logger.debug("Response served from cache")
+            record_llm_call(model, "stream", "hit", "ok", _since(start))
+            yield cached
+            return
+    openai.aiosession.set(_get_session())
+    parts = []
+    outcome = "ok"
+    try:
+        async with _get_semaphore():
+            response = await _aretry(
+                model,
+                functools.partial(
+                    openai.ChatCompletion.acreate,
+                    model=model,
+                    messages=_build_messages(prompt, system_message),
+                    temperature=temperature,
+                    presence_penalty=presence_penalty,
+                    request_timeout=timeout,
+                    stream=True,
+                ),
+            )
+            async for chunk in response:
+                token = chunk.choices[0].delta.get("content")
+                if token:
+                    if not parts:
+                        LLM_TIME_TO_FIRST_TOKEN.observe(_since(start), model=model)
+                    parts.append(token)
+                    yield token
+    except BaseException as e:
+        # Includes GeneratorExit when the consumer stops reading early
+        outcome = _outcome(e)
+        raise
+    finally:
+        record_llm_call(model, "stream", "miss", outcome, _since(start))
+        if parts:
+            _record_usage(None, model, prompt, system_message, "".join(parts))
+    response_text = "".join(parts)
+    logger.debug("Response: %s", response_text)
+    if use_cache:
+        get_cache().set(key, response_text)
+
+
+async def close_async_client() -> None:
+    """Close the shared connection pool, e.g. on application shutdown."""
+    global _session, _semaphore
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+    _semaphore = None
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens in `text` without a tokenizer."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _cache_enabled(use_cache: Optional[bool], temperature: float) -> bool:
+    return temperature == 0 if use_cache is None else use_cache
+
+
+def _since(start: float) -> float:
+    return time.perf_counter() - start
+
+
+def _outcome(error: BaseException) -> str:
+    if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+        return "cancelled"
+    if isinstance(error, (asyncio.TimeoutError, openai.error.Timeout)):
+        return "timeout"
+    return "error"
+
+
+def _record_usage(
+    response: Optional[dict],
+    model: str,
+    prompt: str,
+    system_message: Optional[str],
+    response_text: str,
+) -> None:
+    """Count tokens from the API usage report, or estimate them without one."""
+    usage = response.get("usage") if response is not None else None
+    if usage:
+        record_llm_tokens(model, usage["prompt_tokens"], usage["completion_tokens"])
+        return
+    prompt_tokens = estimate_tokens(prompt)
+    if system_message:
+        prompt_tokens += estimate_tokens(system_message)
+    record_llm_tokens(model, prompt_tokens, estimate_tokens(response_text))
+
+
+def _validate_params(temperature: float, presence_penalty: float) -> None:
+    if not 0 <= temperature <= 2:
+        raise ValueError("Temperature must be between 0 and 2.")
+    if not -2 <= presence_penalty <= 2:
+        raise ValueError("Presence penalty must be between -2 and 2.")
+
+
+def _build_messages(prompt: str, system_message: Optional[str]) -> list:
     messages = []
     if system_message:
         messages.append({"role": "system", "content": system_message})
     messages.append({"role": "user", "content": prompt})
+    return messages
 
-    response = openai.ChatCompletion.create(
-        model=model,
-        messages=messages,
-        temperature=temperature,
-        presence_penalty=presence_penalty,
-    )
-    logger.debug(f"OpenAI response: {response}")
+
+def _make_openai_request(
+    prompt: str,
+    system_message: Optional[str],
+    model: str,
+    temperature: float,
+    presence_penalty: float,
+) -> dict:
+    """Make request to OpenAI API, retrying transient errors."""
+    attempt = 0
+    while True:
+        try:
+            response = openai.ChatCompletion.create(
+                model=model,
+                messages=_build_messages(prompt, system_message),
+                temperature=temperature,
+                presence_penalty=presence_penalty,
+            )
+            break
+        except RETRYABLE_ERRORS as e:
+            delay = _retry_delay(model, attempt, e)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+    logger.debug("OpenAI response: %s", response)
     return response
+
+
+def _get_session() -> aiohttp.ClientSession:
+    """Return the shared aiohttp session, creating it on first use."""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=POOL_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT
+        )
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return _semaphore
+
+
+async def _amake_openai_request(
+    prompt: str,
+    system_message: Optional[str],
+    model: str,
+    temperature: float,
+    presence_penalty: float,
+    timeout: float,
+) -> dict:
+    """Make async request to OpenAI API over the shared session."""
+    # openai reads the session from a context variable; setting it here only
+    # affects the current task.
+    openai.aiosession.set(_get_session())
+    async with _get_semaphore():
+        response = await _aretry(
+            model,
+            functools.partial(
+                openai.ChatCompletion.acreate,
+                model=model,
+                messages=_build_messages(prompt, system_message),
+                temperature=temperature,
+                presence_penalty=presence_penalty,
+                request_timeout=timeout,
+            ),
+        )
+    logger.debug("OpenAI response: %s", response)
+    return response
+
+
+async def _aretry(model: str, request: Callable[[], Awaitable[Any]]) -> Any:
+    """Await `request()`, re-sending it after transient errors.
+
+    The caller's concurrency slot is kept while backing off, so a rate
+    limit slows the other requests down too.
+    """
+    attempt = 0
+    while True:
+        try:
+            return await request()
+        except RETRYABLE_ERRORS as e:
+            delay = _retry_delay(model, attempt, e)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+def _retry_delay(model: str, attempt: int, error: Exception) -> Optional[float]:
+    """Count a retry and return how long to wait, or None to give up."""
+    if attempt >= MAX_RETRIES:
+        return None
+    delay = RETRY_DELAY * 2**attempt
+    LLM_RETRIES.inc(model=model)
+    logger.warning(
+        f"Retrying {model} request in {delay:g}s after "
+        f"{type(error).__name__}: {error}"
+    )
+    return delay
@@ -1,22 +1,95 @@
+import atexit
+import copy
+import datetime
+import json
 import logging
 import logging.handlers
 import os
+import queue
+import random
+from typing import Dict, Optional, Union
+
+# Listeners of queue-based loggers by logger name, stopped on re-initialization
+# and at exit so queued records are flushed.
+_listeners: Dict[str, logging.handlers.QueueListener] = {}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc
+            ).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge the arguments now, as they may change before the listener
+        # thread gets to them. The queue stays in-process, so exc_info is kept
+        # for the output formatters.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class PayloadFilter(logging.Filter):
+    """Shorten log messages longer than `max_length` characters.
+
+    A `sample_rate` share of the long messages is kept in full, so complete
+    payloads can still be inspected now and then.
+    """
+
+    def __init__(self, max_length: int, sample_rate: float = 0.0) -> None:
+        super().__init__()
+        self.max_length = max_length
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = record.getMessage()
+        if len(message) <= self.max_length:
+            return True
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True
+        record.msg = (
+            f"{message[: self.max_length]}"
+            f"... [{len(message) - self.max_length} chars truncated]"
+        )
+        record.args = None
+        return True
 
 
 def initialize_logger(
     log_name: str,
-    log_level: int = logging.DEBUG,
+    log_level: int = logging.INFO,
     log_format: str = "%(asctime)s [%(levelname)s] %(message)s",
     file_format: str = "%(asctime)s [%(levelname)s] %(name)s: %(message)s",
     log_directory: str = "./logs",
     max_bytes: int = 10 * 1024 * 1024,
     backup_count: int = 5,
+    use_queue: bool = False,
+    json_format: bool = False,
+    max_message_length: Optional[int] = None,
+    sample_rate: float = 0.0,
+    levels: Optional[Dict[str, Union[int, str]]] = None,
 ) -> logging.Logger:
     """
     Initializes a logger with a file handler that rotates based on file size.
     Args:
         log_name (str):
-            The name of the logger.
+            The name of the logger; "" configures the root logger, so the
+            module loggers (llm, generation, ...) are included.
         log_level (int):
             The logging level for the logger (default: logging.INFO).
         log_format (str):
@@ -31,6 +104,21 @@ def initialize_logger(
             The maximum size of each log file in bytes (default: 10MB).
         backup_count (int):
             The number of backup log files to keep (default: 5).
+        use_queue (bool):
+            Only put records on a queue in the calling thread and write them
+            to the console and file from a background listener thread, so
+            logging does not block the event loop (default: False).
+        json_format (bool):
+            Write one JSON object per line instead of the text formats
+            (default: False).
+        max_message_length (int, optional):
+            Truncate messages longer than this many characters, such as full
+            prompts and responses (default: no limit).
+        sample_rate (float):
+            Share of the over-long messages that is kept in full
+            (default: 0.0).
+        levels (dict, optional):
+            Levels of other loggers by name, e.g. {"openai": "WARNING"}.
     Returns:
         logging.Logger: A configured instance of the Python logging.Logger class.
     """
@@ -38,17 +126,25 @@ def initialize_logger(
     # Create a new logger with the specified name and level
     logger = logging.getLogger(log_name)
     logger.setLevel(log_level)
+    for name, level in (levels or {}).items():
+        logging.getLogger(name).setLevel(level)
 
     # Remove any existing handlers from the logger
-    for handler in logger.handlers:
+    for handler in list(logger.handlers):
         logger.removeHandler(handler)
+    listener = _listeners.pop(log_name, None)
+    if listener is not None:
+        listener.stop()
 
+    handlers = []
     # Configure a console handler with the specified log format
     console_handler = logging.StreamHandler()
     console_handler.setLevel(log_level)
-    console_formatter = logging.Formatter(log_format)
+    console_formatter = (
+        JsonFormatter() if json_format else logging.Formatter(log_format)
+    )
     console_handler.setFormatter(console_formatter)
-    logger.addHandler(console_handler)
+    handlers.append(console_handler)
 
     if log_directory:
         # Ensure the log directory exists
@@ -57,13 +153,41 @@ def initialize_logger(
         # Configure a file handler with the
         # specified log format and rotation settings
         file_handler = logging.handlers.RotatingFileHandler(
-            os.path.join(log_directory, f"{log_name}.log"),
+            os.path.join(log_directory, f"{log_name or 'root'}.log"),
             maxBytes=max_bytes,
             backupCount=backup_count,
         )
         file_handler.setLevel(log_level)
-        file_formatter = logging.Formatter(file_format)
+        file_formatter = (
+            JsonFormatter() if json_format else logging.Formatter(file_format)
+        )
         file_handler.setFormatter(file_formatter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
+
+    if use_queue:
+        # The calling thread only queues the record; the listener thread
+        # formats it and does the I/O
+        queue_handler = _QueueHandler(queue.SimpleQueue())
+        listener = logging.handlers.QueueListener(
+            queue_handler.queue, *handlers, respect_handler_level=True
+        )
+        listener.start()
+        _listeners[log_name] = listener
+        handlers = [queue_handler]
+
+    for handler in handlers:
+        if max_message_length is not None:
+            handler.addFilter(PayloadFilter(max_message_length, sample_rate))
+        logger.addHandler(handler)
 
     return logger
+
+
+def stop_listeners() -> None:
+    """Flush and stop the background threads of queue-based loggers."""
+    while _listeners:
+        _, listener = _listeners.popitem()
+        listener.stop()
+
+
+atexit.register(stop_listeners)
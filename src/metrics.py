@@ -0,0 +1,238 @@
+import abc
+import bisect
+import contextlib
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Request latencies in seconds, from cache hits to long completions.
+LATENCY_BUCKETS = (0.005, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+DB_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+# USD per 1K prompt and completion tokens; unknown models are not priced.
+PRICES_PER_1K_TOKENS = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+}
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(abc.ABC):
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abc.abstractmethod
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        """Yields `(suffix, labels, value)` for every exposed series."""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield "", _format_labels(self.labelnames, key), value
+
+
+class Gauge(_Metric):
+    """Gauge set by the caller, or read from `function` at scrape time."""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        function: Optional[Callable[[], float]] = None,
+    ):
+        super().__init__(name, help)
+        self.function = function
+        self._value = 0.0
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def samples(self):
+        yield "", "", self.function() if self.function else self._value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: counts per bucket (last one is +Inf), sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                key, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe the duration of the `with` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(
+                (key, (list(counts), total[0]))
+                for key, (counts, total) in self._values.items()
+            )
+        names = self.labelnames + ("le",)
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", _format_labels(
+                    names, key + (_format_value(bound),)
+                ), cumulative
+            labels = _format_labels(self.labelnames, key)
+            yield "_sum", labels, total
+            yield "_count", labels, cumulative
+
+
+LLM_REQUESTS = Counter(
+    "llm_requests_total",
+    "Completion calls by model, call type, cache result and outcome.",
+    ("model", "call", "cache", "outcome"),
+)
+LLM_LATENCY = Histogram(
+    "llm_request_duration_seconds",
+    "Wall time of completion calls as seen by the caller.",
+    ("model", "call", "cache"),
+)
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    "llm_time_to_first_token_seconds",
+    "Time until the first streamed token of fresh completions.",
+    ("model",),
+)
+LLM_PROMPT_TOKENS = Counter(
+    "llm_prompt_tokens_total", "Prompt tokens sent upstream.", ("model",)
+)
+LLM_COMPLETION_TOKENS = Counter(
+    "llm_completion_tokens_total", "Completion tokens received.", ("model",)
+)
+LLM_COST = Counter(
+    "llm_cost_usd_total",
+    "Estimated spend from PRICES_PER_1K_TOKENS.",
+    ("model",),
+)
+LLM_RETRIES = Counter(
+    "llm_retries_total",
+    "Completion requests re-sent after a timeout, rate limit or connection error.",
+    ("model",),
+)
+JOB_RETRIES = Counter(
+    "job_retries_total", "Failed job attempts that were requeued.", ("kind",)
+)
+DB_SAVE_SECONDS = Histogram(
+    "db_save_duration_seconds",
+    "Time to write generated data to the database.",
+    ("operation",),
+    buckets=DB_BUCKETS,
+)
+
+
+def record_llm_call(
+    model: str, call: str, cache: str, outcome: str, seconds: float
+) -> None:
+    """Count a completion call and observe its wall time.
+
+    Args:
+        model (str): Requested model.
+        call (str): "completion" or "stream".
+        cache (str): "hit", "miss", or "shared" for a call that joined an
+            identical one in flight.
+        outcome (str): "ok", "error", "timeout" or "cancelled".
+        seconds (float): Wall time of the call.
+    """
+    LLM_REQUESTS.inc(model=model, call=call, cache=cache, outcome=outcome)
+    LLM_LATENCY.observe(seconds, model=model, call=call, cache=cache)
+
+
+def record_llm_tokens(model: str, prompt_tokens: int, completion_tokens: int) -> None:
+    """Count the tokens and the estimated cost of one upstream call."""
+    LLM_PROMPT_TOKENS.inc(prompt_tokens, model=model)
+    LLM_COMPLETION_TOKENS.inc(completion_tokens, model=model)
+    prices = PRICES_PER_1K_TOKENS.get(model)
+    if prices:
+        LLM_COST.inc(
+            (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1000,
+            model=model,
+        )
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
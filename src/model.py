@@ -1,11 +1,161 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, create_engine
+import logging
+import zlib
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from sqlalchemy import (
+    JSON,
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    create_engine,
+    event,
+)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, selectinload
 from sqlalchemy.orm import sessionmaker
 
-engine = create_engine("sqlite:///content.db")
-Session = sessionmaker(bind=engine)
-session = Session()
+logger = logging.getLogger(__name__)
+
+DATABASE_PATH = "content.db"
+# Milliseconds a connection waits for a lock before raising "database is locked".
+BUSY_TIMEOUT = 5000
+POOL_SIZE = 10
+MAX_OVERFLOW = 20
+COMPRESSION_LEVEL = 6
+# Digits per level in `sort_key`, so that "0002" sorts before "0010".
+SORT_KEY_WIDTH = 4
+
+
+def _configure_sqlite(dbapi_connection, connection_record) -> None:
+    """Set up every new connection for concurrent readers and one writer.
+
+    WAL lets readers proceed while a writer saves generated content, and
+    synchronous=NORMAL is durable enough in WAL mode while avoiding an fsync
+    per commit.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT}")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+    # Used by the full-text index to read compressed section bodies
+    dbapi_connection.create_function("inflate_text", 1, inflate_text)
+
+
+def deflate_text(text: str) -> bytes:
+    return zlib.compress(text.encode("utf-8"), COMPRESSION_LEVEL)
+
+
+def inflate_text(data: Optional[bytes]) -> Optional[str]:
+    if data is None:
+        return None
+    return zlib.decompress(data).decode("utf-8")
+
+
+_engine = None
+_initialized = False
+_async_engine = None
+_async_session_factory = None
+
+
+def get_engine():
+    """Return the engine, created on first use.
+
+    Nothing touches the database at import time; the tables and the search
+    index are created by `init_db` when the first session is opened.
+    """
+    global _engine
+    if _engine is None:
+        _engine = create_engine(
+            f"sqlite:///{DATABASE_PATH}",
+            connect_args={"check_same_thread": False, "timeout": BUSY_TIMEOUT / 1000},
+            pool_size=POOL_SIZE,
+            max_overflow=MAX_OVERFLOW,
+        )
+        event.listen(_engine, "connect", _configure_sqlite)
+    return _engine
+
+
+def init_db() -> None:
+    """Create or upgrade the tables and the search index, once per process."""
+    global _initialized
+    if _initialized:
+        return
+    engine = get_engine()
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        _upgrade_schema(connection)
+    _create_search_index(engine)
+    _initialized = True
+
+
+class _LazySessionmaker(sessionmaker):
+    """`sessionmaker` that sets up the engine and schema on first use."""
+
+    def __call__(self, **kwargs):
+        if self.kw.get("bind") is None:
+            init_db()
+            self.configure(bind=get_engine())
+        return super().__call__(**kwargs)
+
+
+Session = _LazySessionmaker()
+
+
+@contextmanager
+def session_scope() -> Iterator:
+    """Provide a short-lived session that commits on success.
+
+    Use one per request or task instead of sharing a session:
+
+        with session_scope() as session:
+            session.add(book)
+    """
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def get_async_engine():
+    """Return the async engine, created on first use.
+
+    Requires the optional `aiosqlite` package.
+    """
+    global _async_engine
+    if _async_engine is None:
+        from sqlalchemy.ext.asyncio import create_async_engine
+
+        _async_engine = create_async_engine(
+            f"sqlite+aiosqlite:///{DATABASE_PATH}",
+            connect_args={"timeout": BUSY_TIMEOUT / 1000},
+        )
+        event.listen(_async_engine.sync_engine, "connect", _configure_sqlite)
+    return _async_engine
+
+
+def async_session():
+    """Return a new `AsyncSession` bound to the async engine."""
+    global _async_session_factory
+    init_db()
+    if _async_session_factory is None:
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+
+        _async_session_factory = async_sessionmaker(
+            get_async_engine(), expire_on_commit=False
+        )
+    return _async_session_factory()
+
 
 Base = declarative_base()
 
@@ -19,13 +169,23 @@ class Book(Base):
     description = Column(String)
     short_description = Column(String)
 
-    chapters = relationship("Chapter", back_populates="book")
+    chapters = relationship(
+        "Chapter", back_populates="book", order_by="Chapter.sort_key"
+    )
 
 
 class Chapter(Base):
     __tablename__ = "chapters"
+    __table_args__ = (
+        Index("ix_chapters_book_path", "book_id", "path", unique=True),
+        Index("ix_chapters_book_sort_key", "book_id", "sort_key"),
+    )
 
     id = Column(Integer, primary_key=True)
+    number = Column(Integer)
+    path = Column(String)
+    sort_key = Column(String)
+    pages = Column(Integer)
     title = Column(String)
     subtitle = Column(String)
     description = Column(String)
@@ -33,35 +193,335 @@ class Chapter(Base):
 
     book_id = Column(Integer, ForeignKey("books.id"))
     book = relationship("Book", back_populates="chapters")
-    subchapters = relationship("Subchapter", back_populates="chapter")
+    subchapters = relationship(
+        "Subchapter", back_populates="chapter", order_by="Subchapter.sort_key"
+    )
 
 
 class Subchapter(Base):
     __tablename__ = "subchapters"
+    __table_args__ = (
+        Index("ix_subchapters_book_path", "book_id", "path", unique=True),
+        Index("ix_subchapters_book_sort_key", "book_id", "sort_key"),
+    )
 
     id = Column(Integer, primary_key=True)
+    number = Column(Integer)
+    path = Column(String)
+    sort_key = Column(String)
+    pages = Column(Integer)
     title = Column(String)
     subtitle = Column(String)
     description = Column(String)
     short_description = Column(String)
 
+    book_id = Column(Integer, ForeignKey("books.id"))
     chapter_id = Column(Integer, ForeignKey("chapters.id"))
     chapter = relationship("Chapter", back_populates="subchapters")
-    sections = relationship("Section", back_populates="subchapter")
+    sections = relationship(
+        "Section", back_populates="subchapter", order_by="Section.sort_key"
+    )
 
 
 class Section(Base):
     __tablename__ = "sections"
+    __table_args__ = (
+        Index("ix_sections_book_path", "book_id", "path", unique=True),
+        Index("ix_sections_book_sort_key", "book_id", "sort_key"),
+    )
 
     id = Column(Integer, primary_key=True)
+    number = Column(Integer)
+    path = Column(String)
+    sort_key = Column(String)
+    pages = Column(Integer)
     title = Column(String)
     subtitle = Column(String)
     description = Column(String)
     short_description = Column(String)
-    content = Column(String)
+    # Length of the uncompressed content, so outline views can tell which
+    # sections are written without loading the body.
+    content_size = Column(Integer)
+    # Hash of the inputs the content was generated from (see
+    # generation.section_fingerprint), to find sections that need a rebuild.
+    content_fingerprint = Column(String)
 
+    book_id = Column(Integer, ForeignKey("books.id"))
     subchapter_id = Column(Integer, ForeignKey("subchapters.id"))
     subchapter = relationship("Subchapter", back_populates="sections")
+    body = relationship(
+        "SectionBody", uselist=False, cascade="all, delete-orphan", lazy="select"
+    )
+
+    @property
+    def content(self) -> Optional[str]:
+        """Section text, decompressed from `section_bodies` on access."""
+        if self.body is None:
+            return None
+        return inflate_text(self.body.data)
+
+    @content.setter
+    def content(self, value: Optional[str]) -> None:
+        if value is None:
+            self.body = None
+            self.content_size = None
+            self.content_fingerprint = None
+            return
+        if self.body is None:
+            self.body = SectionBody(data=deflate_text(value))
+        else:
+            self.body.data = deflate_text(value)
+        self.content_size = len(value)
+
+
+class SectionBody(Base):
+    """zlib-compressed text of a section, stored apart from the outline."""
+
+    __tablename__ = "section_bodies"
+
+    section_id = Column(Integer, ForeignKey("sections.id"), primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+
+
+class Job(Base):
+    """Background generation job, run by the worker pool in jobs.py.
+
+    `state` moves from "queued" to "running" and ends in "succeeded",
+    "failed" or "cancelled"; a failed attempt goes back to "queued" until
+    `max_attempts` is reached, and is not picked up before `run_after`.
+    A running job is requeued when its `heartbeat_at` goes stale.
+    """
+
+    __tablename__ = "jobs"
+    __table_args__ = (Index("ix_jobs_state_run_after", "state", "run_after"),)
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    state = Column(String, nullable=False, default="queued")
+    payload = Column(JSON)
+    result = Column(JSON)
+    error = Column(String)
+    progress_done = Column(Integer, nullable=False, default=0)
+    progress_total = Column(Integer, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    run_after = Column(DateTime)
+    created_at = Column(DateTime)
+    started_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    book_id = Column(Integer, ForeignKey("books.id"))
+
+
+# Full-text index over section titles, descriptions and content. The
+# content is read through a view that inflates the compressed bodies, and
+# triggers on both tables keep the index in sync (see search.py for queries).
+_SECTION_CONTENT = (
+    "(SELECT inflate_text(data) FROM section_bodies WHERE section_id = {}.id)"
+)
+_SEARCH_INDEX_DDL = [
+    "CREATE VIEW IF NOT EXISTS sections_fts_source AS "
+    "SELECT s.id AS id, s.title AS title, s.description AS description, "
+    "inflate_text(b.data) AS content "
+    "FROM sections s LEFT JOIN section_bodies b ON b.section_id = s.id",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS sections_fts USING fts5("
+    "title, description, content, content='sections_fts_source', "
+    "content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS sections_fts_insert AFTER INSERT ON sections "
+    "BEGIN INSERT INTO sections_fts(rowid, title, description, content) "
+    f"VALUES (new.id, new.title, new.description, {_SECTION_CONTENT.format('new')}); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS sections_fts_delete AFTER DELETE ON sections "
+    "BEGIN INSERT INTO sections_fts(sections_fts, rowid, title, description, "
+    "content) VALUES ('delete', old.id, old.title, old.description, "
+    f"{_SECTION_CONTENT.format('old')}); END",
+    "CREATE TRIGGER IF NOT EXISTS sections_fts_update "
+    "AFTER UPDATE OF title, description ON sections "
+    "BEGIN INSERT INTO sections_fts(sections_fts, rowid, title, description, "
+    "content) VALUES ('delete', old.id, old.title, old.description, "
+    f"{_SECTION_CONTENT.format('old')}); "
+    "INSERT INTO sections_fts(rowid, title, description, content) "
+    f"VALUES (new.id, new.title, new.description, {_SECTION_CONTENT.format('new')}); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS section_bodies_fts_insert "
+    "AFTER INSERT ON section_bodies "
+    "BEGIN INSERT INTO sections_fts(sections_fts, rowid, title, description, "
+    "content) SELECT 'delete', id, title, description, NULL FROM sections "
+    "WHERE id = new.section_id; "
+    "INSERT INTO sections_fts(rowid, title, description, content) "
+    "SELECT id, title, description, inflate_text(new.data) FROM sections "
+    "WHERE id = new.section_id; END",
+    "CREATE TRIGGER IF NOT EXISTS section_bodies_fts_update "
+    "AFTER UPDATE ON section_bodies "
+    "BEGIN INSERT INTO sections_fts(sections_fts, rowid, title, description, "
+    "content) SELECT 'delete', id, title, description, inflate_text(old.data) "
+    "FROM sections WHERE id = old.section_id; "
+    "INSERT INTO sections_fts(rowid, title, description, content) "
+    "SELECT id, title, description, inflate_text(new.data) FROM sections "
+    "WHERE id = new.section_id; END",
+    "CREATE TRIGGER IF NOT EXISTS section_bodies_fts_delete "
+    "AFTER DELETE ON section_bodies "
+    "BEGIN INSERT INTO sections_fts(sections_fts, rowid, title, description, "
+    "content) SELECT 'delete', id, title, description, inflate_text(old.data) "
+    "FROM sections WHERE id = old.section_id; "
+    "INSERT INTO sections_fts(rowid, title, description, content) "
+    "SELECT id, title, description, NULL FROM sections "
+    "WHERE id = old.section_id; END",
+]
+
+
+# Outline tables with their parent table and foreign key, top down.
+_OUTLINE_TABLES = (
+    ("chapters", None, "book_id"),
+    ("subchapters", "chapters", "chapter_id"),
+    ("sections", "subchapters", "subchapter_id"),
+)
+# Sections whose inline content is moved to section_bodies per statement.
+_UPGRADE_BATCH_SIZE = 500
+
+
+def _table_columns(connection, table: str) -> set:
+    rows = connection.exec_driver_sql(f"PRAGMA table_info({table})")
+    return {row[1] for row in rows}
+
+
+def _upgrade_schema(connection) -> None:
+    """Bring tables created by earlier versions up to the current models.
+
+    `create_all` does not alter existing tables, so missing columns are
+    added here and filled in: the book of subchapters and sections, and
+    the number, path and sort key of outline rows, numbered by id within
+    their parent. Content stored inline in `sections.content` moves to
+    `section_bodies`, and missing indexes are created. Only rows and
+    objects that are missing are touched, so it is safe to run every time.
+    """
+    for table in Base.metadata.sorted_tables:
+        existing = _table_columns(connection, table.name)
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=connection.dialect)
+                connection.exec_driver_sql(
+                    f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                )
+                logger.info(f"Added column {table.name}.{column.name}")
+
+    sort_key = f"printf('%0{SORT_KEY_WIDTH}d', number)"
+    for table, parent, parent_key in _OUTLINE_TABLES:
+        if parent is not None:
+            connection.exec_driver_sql(
+                f"UPDATE {table} SET book_id = (SELECT book_id FROM {parent} "
+                f"WHERE {parent}.id = {table}.{parent_key}) WHERE book_id IS NULL"
+            )
+        connection.exec_driver_sql(
+            f"UPDATE {table} SET number = (SELECT COUNT(*) FROM {table} AS prior "
+            f"WHERE prior.{parent_key} IS {table}.{parent_key} "
+            f"AND prior.id <= {table}.id) WHERE number IS NULL"
+        )
+        if parent is None:
+            path, key = "CAST(number AS TEXT)", sort_key
+        else:
+            parent_row = f"FROM {parent} WHERE {parent}.id = {table}.{parent_key}"
+            path = f"(SELECT path {parent_row}) || '.' || number"
+            key = f"(SELECT sort_key {parent_row}) || '.' || {sort_key}"
+        connection.exec_driver_sql(
+            f"UPDATE {table} SET path = {path}, sort_key = {key} WHERE path IS NULL"
+        )
+
+    if "content" in _table_columns(connection, "sections"):
+        _move_inline_content(connection)
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def _move_inline_content(connection) -> None:
+    moved = 0
+    while True:
+        rows = connection.exec_driver_sql(
+            "SELECT id, content FROM sections WHERE content IS NOT NULL "
+            f"LIMIT {_UPGRADE_BATCH_SIZE}"
+        ).all()
+        if not rows:
+            break
+        connection.exec_driver_sql(
+            "INSERT OR IGNORE INTO section_bodies (section_id, data) VALUES (?, ?)",
+            [(section_id, deflate_text(content)) for section_id, content in rows],
+        )
+        connection.exec_driver_sql(
+            "UPDATE sections SET content = NULL, content_size = ? WHERE id = ?",
+            [(len(content), section_id) for section_id, content in rows],
+        )
+        moved += len(rows)
+    if moved:
+        logger.info(f"Moved the content of {moved} sections to section_bodies")
+
+
+def _create_search_index(engine) -> None:
+    with engine.begin() as connection:
+        existing = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE name = 'sections_fts'"
+        ).first()
+        for statement in _SEARCH_INDEX_DDL:
+            connection.exec_driver_sql(statement)
+        if existing is None:
+            # Index the sections stored before the index existed
+            connection.exec_driver_sql(
+                "INSERT INTO sections_fts(sections_fts) VALUES ('rebuild')"
+            )
+
+
+def make_path(*numbers: int) -> str:
+    """Outline id of a node, e.g. "1.2.3"."""
+    return ".".join(str(number) for number in numbers)
+
+
+def make_sort_key(*numbers: int) -> str:
+    """Zero-padded path that sorts in outline order, e.g. "0001.0002.0003"."""
+    return ".".join(str(number).zfill(SORT_KEY_WIDTH) for number in numbers)
+
+
+def load_book(session, book_id: int) -> Book:
+    """Load a book with all chapters, subchapters and sections.
+
+    Runs one query per level (four in total) however large the book is;
+    children come back ordered by their sort key.
+    """
+    return session.get(
+        Book,
+        book_id,
+        options=[
+            selectinload(Book.chapters)
+            .selectinload(Chapter.subchapters)
+            .selectinload(Subchapter.sections)
+        ],
+    )
+
+
+def load_chapter(session, book_id: int, path: str) -> Chapter:
+    """Load one chapter by path with its subchapters and sections."""
+    return (
+        session.query(Chapter)
+        .filter(Chapter.book_id == book_id, Chapter.path == path)
+        .options(selectinload(Chapter.subchapters).selectinload(Subchapter.sections))
+        .one_or_none()
+    )
+
+
+def get_section(session, book_id: int, path: str) -> Section:
+    """Look up a section by its outline id, e.g. "1.2.3"."""
+    return (
+        session.query(Section)
+        .filter(Section.book_id == book_id, Section.path == path)
+        .one_or_none()
+    )
 
 
-Base.metadata.create_all(engine)
+def ordered_sections(session, book_id: int):
+    """Query all sections of a book in outline order."""
+    return (
+        session.query(Section)
+        .filter(Section.book_id == book_id)
+        .order_by(Section.sort_key)
+    )
@@ -0,0 +1,254 @@
+import json
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from outline_index import item_number
+
+logger = logging.getLogger(__name__)
+
+# Keys of the child lists in the compact outline schema, by object depth:
+# book -> cs (chapters) -> ss (subchapters) -> scs (sections).
+CHILD_KEYS = ("cs", "ss", "scs")
+
+NodeEvent = Tuple[Optional[str], dict]
+
+
+def chapter_node(chapter: dict) -> dict:
+    return {
+        "id": str(chapter["cn"]),
+        "description": f"{chapter['ct']} - {chapter['cd']} ({chapter['cp']})",
+        "children": [],
+    }
+
+
+def subchapter_node(chapter: dict, subchapter: dict) -> dict:
+    return {
+        "id": f"{chapter['cn']}.{subchapter['scn']}",
+        "description": (
+            f"{subchapter['sct']} - {subchapter['scd']} ({subchapter['scp']})"
+        ),
+        "children": [],
+    }
+
+
+def section_node(chapter: dict, subchapter: dict, section: dict) -> dict:
+    return {
+        "id": f"{chapter['cn']}.{subchapter['scn']}.{section['sn']}",
+        "description": f"{section['st']} - {section['sd']} ({section['sp']})",
+    }
+
+
+def book_node(book: dict) -> dict:
+    return {
+        "id": str(book["bt"]),
+        "description": book.get("ss", ""),
+        "children": [],
+    }
+
+
+def _tree_node(item: dict, node_id: str, title: str, description: str, pages: str):
+    return {
+        "id": node_id,
+        "description": (
+            f"{item.get(title)} - {item.get(description)} ({item.get(pages)})"
+        ),
+    }
+
+
+def chapters_to_tree(chapters: dict) -> List[dict]:
+    """Convert a parsed compact outline into `ui.tree` nodes.
+
+    Unnumbered items are numbered by position, as `import_outline` does.
+    """
+    logger.debug("Converting chapters to tree")
+    chapters_tree = []
+    for c, chapter in enumerate(chapters.get("cs") or [], 1):
+        chapter_id = str(item_number(chapter.get("cn"), c))
+        node = _tree_node(chapter, chapter_id, "ct", "cd", "cp")
+        node["children"] = []
+        for s, subchapter in enumerate(chapter.get("ss") or [], 1):
+            subchapter_id = f"{chapter_id}.{item_number(subchapter.get('scn'), s)}"
+            subnode = _tree_node(subchapter, subchapter_id, "sct", "scd", "scp")
+            subnode["children"] = [
+                _tree_node(
+                    section,
+                    f"{subchapter_id}.{item_number(section.get('sn'), n)}",
+                    "st",
+                    "sd",
+                    "sp",
+                )
+                for n, section in enumerate(subchapter.get("scs") or [], 1)
+            ]
+            node["children"].append(subnode)
+        chapters_tree.append(node)
+    subtitle = chapters.get("ss")
+    root = {
+        "id": str(chapters.get("bt")),
+        "description": subtitle if isinstance(subtitle, str) else "",
+        "children": chapters_tree,
+    }
+    return [root]
+
+
+class _Frame:
+    __slots__ = ("is_object", "depth", "key", "expect_key", "fields")
+
+    def __init__(self, is_object: bool, depth: int) -> None:
+        self.is_object = is_object
+        self.depth = depth
+        self.key: Optional[str] = None
+        self.expect_key = True
+        self.fields: dict = {}
+
+
+class OutlineStreamParser:
+    """Incremental parser for the compact `bt`/`cs`/`ss`/`scs` outline.
+
+    Feed it the completion as it streams in; `feed` returns the tree nodes
+    that became known with that chunk as `(parent_id, node)` pairs, with
+    `parent_id` None for the book node. A book, chapter or subchapter is
+    emitted as soon as its child list starts, sections when their object
+    closes. If a node's fields change after it was emitted, it is emitted
+    again with the same id.
+    """
+
+    def __init__(self) -> None:
+        self._stack: List[_Frame] = []
+        self._string: Optional[List[str]] = None
+        self._escape = False
+        self._scalar: Optional[List[str]] = None
+        self._emitted: Dict[str, str] = {}
+        self._events: List[NodeEvent] = []
+        self.text = ""
+
+    def feed(self, chunk: str) -> List[NodeEvent]:
+        self.text += chunk
+        self._events = []
+        for char in chunk:
+            self._consume(char)
+        return self._events
+
+    def _consume(self, char: str) -> None:
+        if self._string is not None:
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                raw = "".join(self._string)
+                self._string = None
+                try:
+                    # strict=False lets raw newlines and tabs through
+                    value = json.loads(f'"{raw}"', strict=False)
+                except json.JSONDecodeError:
+                    logger.debug(f"Keeping malformed string {raw!r}")
+                    value = raw
+                self._value(value)
+                return
+            self._string.append(char)
+            return
+        if self._scalar is not None:
+            if char not in ",}] \t\r\n":
+                self._scalar.append(char)
+                return
+            self._end_scalar()
+        if char == '"':
+            self._string = []
+        elif char == "{":
+            depth = sum(frame.is_object for frame in self._stack)
+            self._stack.append(_Frame(True, depth))
+        elif char == "[":
+            parent = self._stack[-1] if self._stack else None
+            if parent and parent.is_object and parent.key in CHILD_KEYS:
+                self._emit(parent)
+            self._stack.append(_Frame(False, -1))
+        elif char == "}":
+            if self._stack:
+                frame = self._stack.pop()
+                self._emit(frame)
+        elif char == "]":
+            if self._stack:
+                self._stack.pop()
+        elif char == ",":
+            if self._stack and self._stack[-1].is_object:
+                self._stack[-1].expect_key = True
+        elif char == ":":
+            if self._stack and self._stack[-1].is_object:
+                self._stack[-1].expect_key = False
+        elif not char.isspace():
+            self._scalar = [char]
+
+    def _end_scalar(self) -> None:
+        token = "".join(self._scalar)
+        self._scalar = None
+        try:
+            self._value(json.loads(token))
+        except json.JSONDecodeError:
+            logger.debug(f"Skipping malformed token {token!r}")
+
+    def _value(self, value) -> None:
+        if not self._stack:
+            return
+        frame = self._stack[-1]
+        if frame.is_object and frame.expect_key:
+            frame.key = value
+        elif frame.is_object:
+            frame.fields[frame.key] = value
+
+    def _objects(self) -> List[_Frame]:
+        return [frame for frame in self._stack if frame.is_object]
+
+    def _emit(self, frame: _Frame) -> None:
+        if not frame.is_object or frame.depth > 3:
+            return
+        ancestors = self._objects()
+        if ancestors and ancestors[-1] is frame:
+            ancestors = ancestors[:-1]
+        chain = [f.fields for f in ancestors[1:]] + [frame.fields]
+        try:
+            if frame.depth == 0:
+                node, parent_id = book_node(frame.fields), None
+            elif frame.depth == 1:
+                node, parent_id = chapter_node(frame.fields), self._book_id()
+            elif frame.depth == 2:
+                node = subchapter_node(*chain)
+                parent_id = str(chain[0]["cn"])
+            else:
+                node = section_node(*chain)
+                parent_id = f"{chain[0]['cn']}.{chain[1]['scn']}"
+        except KeyError:
+            # Not enough fields yet; the node is emitted once it closes.
+            return
+        if self._emitted.get(node["id"]) == node["description"]:
+            return
+        self._emitted[node["id"]] = node["description"]
+        self._events.append((parent_id, node))
+
+    def _book_id(self) -> Optional[str]:
+        objects = self._objects()
+        if objects and objects[0].depth == 0 and "bt" in objects[0].fields:
+            return str(objects[0].fields["bt"])
+        return None
+
+
+class OutlineTreeBuilder:
+    """Grow a `ui.tree` node list from `OutlineStreamParser` events."""
+
+    def __init__(self) -> None:
+        self.nodes: List[dict] = []
+        self.index: Dict[str, dict] = {}
+
+    def apply(self, events: List[NodeEvent]) -> bool:
+        """Apply node events; return True if the tree changed."""
+        changed = False
+        for parent_id, node in events:
+            existing = self.index.get(node["id"])
+            if existing is not None:
+                existing["description"] = node["description"]
+            else:
+                parent = self.index.get(parent_id) if parent_id else None
+                siblings = parent["children"] if parent else self.nodes
+                siblings.append(node)
+                self.index[node["id"]] = node
+            changed = True
+        return changed
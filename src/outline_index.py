@@ -0,0 +1,348 @@
+import array
+import logging
+from typing import Dict, Iterator, List, Optional
+
+from model import make_sort_key
+
+logger = logging.getLogger(__name__)
+
+CHAPTER, SUBCHAPTER, SECTION = 1, 2, 3
+# Compact outline keys per level: children, number, title, description, pages.
+COMPACT_KEYS = {
+    CHAPTER: ("ss", "cn", "ct", "cd", "cp"),
+    SUBCHAPTER: ("scs", "scn", "sct", "scd", "scp"),
+    SECTION: (None, "sn", "st", "sd", "sp"),
+}
+# Stands in for a missing number or page count in the integer columns.
+MISSING = -1
+
+
+class OutlineNode:
+    """Read-only view of one row of an `OutlineIndex`."""
+
+    __slots__ = ("outline", "row")
+
+    def __init__(self, outline: "OutlineIndex", row: int) -> None:
+        self.outline = outline
+        self.row = row
+
+    @property
+    def id(self) -> str:
+        return self.outline.ids[self.row]
+
+    @property
+    def level(self) -> int:
+        return self.outline.levels[self.row]
+
+    @property
+    def number(self) -> Optional[int]:
+        return _value(self.outline.numbers[self.row])
+
+    @property
+    def title(self) -> Optional[str]:
+        return self.outline.titles[self.row]
+
+    @property
+    def description(self) -> Optional[str]:
+        return self.outline.descriptions[self.row]
+
+    @property
+    def pages(self) -> Optional[int]:
+        """Page count given in the outline."""
+        return _value(self.outline.pages[self.row])
+
+    @property
+    def total_pages(self) -> int:
+        """Sum of the page counts of the sections below, or its own."""
+        return self.outline.total_pages(self.row)
+
+    @property
+    def parent(self) -> Optional["OutlineNode"]:
+        parent = self.outline.parents[self.row]
+        return None if parent == MISSING else OutlineNode(self.outline, parent)
+
+    @property
+    def children(self) -> List["OutlineNode"]:
+        return [
+            OutlineNode(self.outline, row) for row in self.outline.children(self.row)
+        ]
+
+    def __repr__(self) -> str:
+        return f"OutlineNode({self.id!r}, {self.title!r})"
+
+
+def _value(number: int) -> Optional[int]:
+    return None if number == MISSING else number
+
+
+def _number(value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return MISSING
+
+
+def item_number(value, position: int) -> int:
+    """Number of an outline item, or its position if the model left it out."""
+    number = _number(value)
+    return position if number == MISSING else number
+
+
+def _construct(model, **fields):
+    # Pydantic 2 renamed `construct`
+    return getattr(model, "model_construct", model.construct)(**fields)
+
+
+class OutlineIndex:
+    """Book outline in flat columns, one row per chapter, subchapter and section.
+
+    Rows are kept in reading order, so the rows below a node run up to its
+    `ends` entry: children are found by skipping over sibling ranges and
+    page rollups are differences of a running sum, without a nested tree.
+    Outline ids such as "1.2.3" map to rows through a dict, and the
+    conversions to tree nodes, Pydantic models and database rows each take
+    one pass over the columns.
+    """
+
+    __slots__ = (
+        "title",
+        "subtitle",
+        "ids",
+        "levels",
+        "numbers",
+        "parents",
+        "ends",
+        "titles",
+        "descriptions",
+        "pages",
+        "_rows",
+        "_open",
+        "_page_sums",
+    )
+
+    def __init__(
+        self, title: Optional[str] = None, subtitle: Optional[str] = None
+    ) -> None:
+        self.title = title
+        self.subtitle = subtitle
+        self.ids: List[str] = []
+        self.levels = array.array("b")
+        self.numbers = array.array("i")
+        self.parents = array.array("i")
+        self.ends = array.array("i")
+        self.titles: List[Optional[str]] = []
+        self.descriptions: List[Optional[str]] = []
+        self.pages = array.array("i")
+        self._rows: Dict[str, int] = {}
+        # Rows that new rows can still be added below, one per level
+        self._open: List[int] = []
+        self._page_sums: Optional[array.array] = None
+
+    @classmethod
+    def from_compact(cls, outline: dict) -> "OutlineIndex":
+        """Build from a parsed outline with the `bt`/`cs`/`ss`/`scs` keys."""
+        subtitle = outline.get("ss")
+        index = cls(outline.get("bt"), subtitle if isinstance(subtitle, str) else None)
+        index._add_compact(outline.get("cs") or [], CHAPTER)
+        return index
+
+    def _add_compact(self, items: list, level: int) -> None:
+        children_key, number, title, description, pages = COMPACT_KEYS[level]
+        for position, item in enumerate(items, 1):
+            self.append(
+                level,
+                item_number(item.get(number), position),
+                item.get(title),
+                item.get(description),
+                item.get(pages),
+            )
+            if children_key:
+                self._add_compact(item.get(children_key) or [], level + 1)
+
+    def append(
+        self,
+        level: int,
+        number: int,
+        title: Optional[str] = None,
+        description: Optional[str] = None,
+        pages: Optional[int] = None,
+    ) -> int:
+        """Add a node after the last one, below the last node of `level - 1`.
+
+        Returns:
+            int: Row of the new node.
+
+        Raises:
+            ValueError: If there is no parent for `level`, or `number` is
+                not an integer.
+        """
+        if _number(number) == MISSING:
+            raise ValueError(f"Level {level} node has no number: {number!r}")
+        number = _number(number)
+        del self._open[level - 1 :]
+        if len(self._open) != level - 1:
+            raise ValueError(f"Level {level} node {number} has no parent")
+        row = len(self.ids)
+        parent = self._open[-1] if self._open else MISSING
+        node_id = str(number) if parent == MISSING else f"{self.ids[parent]}.{number}"
+        self.ids.append(node_id)
+        self.levels.append(level)
+        self.numbers.append(number)
+        self.parents.append(parent)
+        self.ends.append(row + 1)
+        self.titles.append(title)
+        self.descriptions.append(description)
+        self.pages.append(_number(pages))
+        for ancestor in self._open:
+            self.ends[ancestor] = row + 1
+        self._open.append(row)
+        # Repeated ids update the row they point to, as the importer does
+        self._rows[node_id] = row
+        self._page_sums = None
+        return row
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, node_id: str) -> bool:
+        return node_id in self._rows
+
+    def __getitem__(self, node_id: str) -> OutlineNode:
+        return OutlineNode(self, self._rows[node_id])
+
+    def get(self, node_id: str) -> Optional[OutlineNode]:
+        row = self._rows.get(node_id)
+        return None if row is None else OutlineNode(self, row)
+
+    def row(self, node_id: str) -> int:
+        return self._rows[node_id]
+
+    def children(self, row: int = MISSING) -> Iterator[int]:
+        """Rows of the direct children of `row`, or of the top level."""
+        child = row + 1
+        end = len(self.ids) if row == MISSING else self.ends[row]
+        while child < end:
+            yield child
+            child = self.ends[child]
+
+    def is_leaf(self, row: int) -> bool:
+        return self.ends[row] == row + 1
+
+    def total_pages(self, row: int = MISSING) -> int:
+        """Pages of the leaves below `row` (or of the whole book), in O(1).
+
+        The running sum over the leaves is built on the first call after a
+        change.
+        """
+        if self._page_sums is None:
+            sums = array.array("q", [0])
+            total = 0
+            for index, pages in enumerate(self.pages):
+                if pages != MISSING and self.ends[index] == index + 1:
+                    total += pages
+                sums.append(total)
+            self._page_sums = sums
+        if row == MISSING:
+            return self._page_sums[-1]
+        return self._page_sums[self.ends[row]] - self._page_sums[row]
+
+    def _label(self, row: int) -> str:
+        # As in outline.chapters_to_tree
+        return (
+            f"{self.titles[row]} - {self.descriptions[row]} "
+            f"({_value(self.pages[row])})"
+        )
+
+    def to_tree(self) -> List[dict]:
+        """`ui.tree` nodes, the same as `outline.chapters_to_tree` gives."""
+        root = {
+            "id": str(self.title),
+            "description": self.subtitle or "",
+            "children": [],
+        }
+        nodes: List[dict] = []
+        for row, level in enumerate(self.levels):
+            node = {"id": self.ids[row], "description": self._label(row)}
+            if level < SECTION:
+                node["children"] = []
+            parent = self.parents[row]
+            (root if parent == MISSING else nodes[parent])["children"].append(node)
+            nodes.append(node)
+        return [root]
+
+    def to_pydantic(self):
+        """The outline as the Pydantic `book_models.Book`.
+
+        Models are built without validation, as the columns are typed
+        already; child lists are filled in as their rows come up.
+        """
+        from book_models import Book, Chapter, Section, Subchapter
+
+        models = {CHAPTER: Chapter, SUBCHAPTER: Subchapter, SECTION: Section}
+        child_fields = {CHAPTER: "subchapters", SUBCHAPTER: "sections"}
+        book_children: list = []
+        children: List[Optional[list]] = []
+        for row, level in enumerate(self.levels):
+            fields = {
+                "id": self.ids[row],
+                "title": self.titles[row],
+                "description": self.descriptions[row],
+                "pages": _value(self.pages[row]),
+            }
+            if level < SECTION:
+                fields["description"] = fields["description"] or ""
+                fields[child_fields[level]] = own = []
+            else:
+                fields["content"] = None
+                own = None
+            model = _construct(models[level], **fields)
+            parent = self.parents[row]
+            (book_children if parent == MISSING else children[parent]).append(model)
+            children.append(own)
+        return _construct(
+            Book,
+            id=str(self.title),
+            title=self.title,
+            description=self.subtitle or "",
+            pages=self.total_pages(),
+            chapters=book_children,
+        )
+
+    def to_rows(
+        self,
+        level: int,
+        book_id: int,
+        parent_key: Optional[str] = None,
+        parent_ids: Optional[Dict[str, int]] = None,
+    ) -> List[dict]:
+        """Column values of the chapter, subchapter or section rows.
+
+        Args:
+            level (int): CHAPTER, SUBCHAPTER or SECTION.
+            book_id (int): Book the rows belong to.
+            parent_key (str, optional): Foreign key column to the parent,
+                e.g. "chapter_id".
+            parent_ids (dict, optional): Database ids of the parents by
+                outline id, for `parent_key`.
+
+        Returns:
+            List[dict]: Rows in reading order, for a bulk insert.
+        """
+        rows = []
+        for row, row_level in enumerate(self.levels):
+            if row_level != level:
+                continue
+            node_id = self.ids[row]
+            values = {
+                "book_id": book_id,
+                "number": _value(self.numbers[row]),
+                "path": node_id,
+                "sort_key": make_sort_key(*node_id.split(".")),
+                "title": self.titles[row],
+                "description": self.descriptions[row],
+                "pages": _value(self.pages[row]),
+            }
+            if parent_key:
+                values[parent_key] = parent_ids[self.ids[self.parents[row]]]
+            rows.append(values)
+        return rows
@@ -0,0 +1,105 @@
+import html
+import logging
+import re
+from dataclasses import dataclass
+from typing import List, Optional
+
+from sqlalchemy import text
+
+from model import Session
+
+logger = logging.getLogger(__name__)
+
+# bm25 weights for the title, description and content columns.
+TITLE_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 5.0
+CONTENT_WEIGHT = 1.0
+# Markers around matched terms in snippets; callers swap them for markup.
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+SNIPPET_TOKENS = 16
+
+
+@dataclass
+class SearchHit:
+    section_id: int
+    book_id: int
+    path: str
+    title: str
+    snippet: str
+    rank: float
+
+
+def to_match_query(query: str) -> str:
+    """Turn free text into an FTS5 query matching all of its words.
+
+    Each word is quoted, so user input such as "C++" or "IaaS/PaaS" cannot
+    break the FTS5 query syntax; a trailing "*" keeps prefix matching.
+    """
+    terms = []
+    for word in re.findall(r"[\w*]+", query):
+        prefix = word.endswith("*")
+        word = word.strip("*")
+        if word:
+            terms.append(f'"{word}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def search_sections(
+    query: str,
+    book_id: Optional[int] = None,
+    chapter: Optional[str] = None,
+    limit: int = 20,
+) -> List[SearchHit]:
+    """Ranked full-text search over section titles, descriptions and content.
+
+    Args:
+        query (str): Words to look for; all of them must match.
+        book_id (int, optional): Only search this book.
+        chapter (str, optional): Only search this chapter path, e.g. "2".
+        limit (int): Maximum number of hits.
+
+    Returns:
+        List[SearchHit]: Best matches first, with a highlighted snippet.
+    """
+    match = to_match_query(query)
+    if not match:
+        return []
+    sql = (
+        "SELECT s.id, s.book_id, s.path, s.title, "
+        "snippet(sections_fts, -1, :start, :end, '…', :tokens) AS snippet, "
+        "bm25(sections_fts, :title_weight, :description_weight, "
+        ":content_weight) AS rank "
+        "FROM sections_fts JOIN sections s ON s.id = sections_fts.rowid "
+        "WHERE sections_fts MATCH :match"
+    )
+    params = {
+        "match": match,
+        "start": MATCH_START,
+        "end": MATCH_END,
+        "tokens": SNIPPET_TOKENS,
+        "title_weight": TITLE_WEIGHT,
+        "description_weight": DESCRIPTION_WEIGHT,
+        "content_weight": CONTENT_WEIGHT,
+        "limit": limit,
+    }
+    if book_id is not None:
+        sql += " AND s.book_id = :book_id"
+        params["book_id"] = book_id
+    if chapter:
+        sql += " AND s.path LIKE :chapter_prefix"
+        params["chapter_prefix"] = f"{chapter}.%"
+    sql += " ORDER BY rank LIMIT :limit"
+    with Session() as session:
+        rows = session.execute(text(sql), params).all()
+    logger.debug(f"Search {match!r} returned {len(rows)} hits")
+    return [SearchHit(*row) for row in rows]
+
+
+def highlight_snippet(snippet: str) -> str:
+    """Render a snippet as HTML with the matched terms in <mark> tags."""
+    return (
+        html.escape(snippet)
+        .replace(MATCH_START, "<mark>")
+        .replace(MATCH_END, "</mark>")
+    )
@@ -0,0 +1,192 @@
+import copy
+import json
+import logging
+from typing import Dict, List, Optional
+
+from nicegui import outbox, ui
+
+logger = logging.getLogger(__name__)
+
+# Applies the ops produced by `diff_tree` to the nodes of a q-tree element in
+# the browser; mirrors `apply_ops` below.
+_PATCH_JS = """
+(() => {
+  const element = window.app.elements[%(id)s];
+  if (!element) return;
+  const key = %(key)s;
+  const children = %(children)s;
+  const nodes = element.props.nodes;
+  const index = {};
+  const register = (list) => {
+    for (const node of list) {
+      index[node[key]] = [node, list];
+      if (node[children]) register(node[children]);
+    }
+  };
+  register(nodes);
+  const siblings = (parent) => {
+    if (parent === null) return nodes;
+    const node = index[parent][0];
+    return node[children] || (node[children] = []);
+  };
+  for (const op of %(ops)s) {
+    if (op.op === "add") {
+      siblings(op.parent).splice(op.index, 0, op.node);
+      register([op.node]);
+      continue;
+    }
+    const [node, list] = index[op.id];
+    if (op.op === "remove") {
+      list.splice(list.indexOf(node), 1);
+      delete index[op.id];
+    } else if (op.op === "move") {
+      list.splice(list.indexOf(node), 1);
+      list.splice(op.index, 0, node);
+    } else if (op.op === "update") {
+      Object.assign(node, op.fields);
+    }
+  }
+})()
+"""
+
+
+def diff_tree(
+    old: List[dict],
+    new: List[dict],
+    prune: bool = True,
+    key: str = "id",
+    children: str = "children",
+) -> List[dict]:
+    """Compute a keyed diff between two `ui.tree` node lists.
+
+    Nodes are matched by `key` (e.g. "1.2.3") within their parent. The result
+    is a list of `remove`, `add`, `move` and `update` ops, removals first.
+    With `prune=False` nodes missing from `new` are kept and nothing is
+    reordered, which is what a partially streamed outline needs.
+    """
+    removes: List[dict] = []
+    changes: List[dict] = []
+    _diff(old, new, None, prune, key, children, removes, changes)
+    return removes + changes
+
+
+def _diff(
+    old: List[dict],
+    new: List[dict],
+    parent: Optional[str],
+    prune: bool,
+    key: str,
+    children: str,
+    removes: List[dict],
+    changes: List[dict],
+) -> None:
+    old_by_key: Dict[str, dict] = {node[key]: node for node in old}
+    current = [node[key] for node in old]
+    if prune:
+        new_keys = {node[key] for node in new}
+        removes.extend(
+            {"op": "remove", "id": node_key}
+            for node_key in current
+            if node_key not in new_keys
+        )
+        current = [node_key for node_key in current if node_key in new_keys]
+    position = -1
+    for node in new:
+        node_key = node[key]
+        old_node = old_by_key.get(node_key)
+        if old_node is None:
+            position += 1
+            current.insert(position, node_key)
+            changes.append(
+                {"op": "add", "parent": parent, "index": position, "node": node}
+            )
+            continue
+        at = current.index(node_key)
+        if prune and at != position + 1:
+            current.pop(at)
+            position += 1
+            current.insert(position, node_key)
+            changes.append({"op": "move", "id": node_key, "index": position})
+        else:
+            position = max(position, at)
+        fields = {
+            name: value
+            for name, value in node.items()
+            if name != children and old_node.get(name) != value
+        }
+        if fields:
+            changes.append({"op": "update", "id": node_key, "fields": fields})
+        if node.get(children) or old_node.get(children):
+            _diff(
+                old_node.get(children) or [],
+                node.get(children) or [],
+                node_key,
+                prune,
+                key,
+                children,
+                removes,
+                changes,
+            )
+
+
+def apply_ops(
+    nodes: List[dict], ops: List[dict], key: str = "id", children: str = "children"
+) -> None:
+    """Apply `diff_tree` ops to a node list in place."""
+    index: Dict[str, tuple] = {}
+
+    def register(siblings: List[dict]) -> None:
+        for node in siblings:
+            index[node[key]] = (node, siblings)
+            register(node.get(children) or [])
+
+    register(nodes)
+    for op in ops:
+        if op["op"] == "add":
+            parent = op["parent"]
+            if parent is None:
+                siblings = nodes
+            else:
+                siblings = index[parent][0].setdefault(children, [])
+            node = copy.deepcopy(op["node"])
+            siblings.insert(op["index"], node)
+            register([node])
+            continue
+        node, siblings = index[op["id"]]
+        if op["op"] == "remove":
+            siblings.remove(node)
+            del index[op["id"]]
+        elif op["op"] == "move":
+            siblings.remove(node)
+            siblings.insert(op["index"], node)
+        elif op["op"] == "update":
+            node.update(copy.deepcopy(op["fields"]))
+
+
+async def patch_tree(tree: ui.tree, nodes: List[dict], prune: bool = True) -> int:
+    """Bring `tree` to `nodes` by sending only the changed nodes.
+
+    The element is not re-created, so expansion and selection survive and the
+    websocket carries the diff instead of the whole node list.
+
+    Returns:
+        int: Number of ops sent to the browser.
+    """
+    key = tree._props["node-key"]
+    children = tree._props["children-key"]
+    ops = diff_tree(tree._props["nodes"], nodes, prune, key, children)
+    if not ops:
+        return 0
+    apply_ops(tree._props["nodes"], ops, key, children)
+    if tree.id in outbox.update_queue.get(tree.client.id, {}):
+        # A full update of the element is already queued and carries the nodes
+        return len(ops)
+    code = _PATCH_JS % {
+        "id": json.dumps(tree.id),
+        "key": json.dumps(key),
+        "children": json.dumps(children),
+        "ops": json.dumps(ops),
+    }
+    await tree.client.run_javascript(code, respond=False)
+    logger.debug(f"Patched tree {tree.id} with {len(ops)} ops")
+    return len(ops)
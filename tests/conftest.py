@@ -0,0 +1,22 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# The modules import each other as top-level modules from src/
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Point model.py at an empty database in a temporary directory."""
+    import model
+
+    monkeypatch.setattr(model, "DATABASE_PATH", str(tmp_path / "content.db"))
+    monkeypatch.setattr(model, "_engine", None)
+    monkeypatch.setattr(model, "_initialized", False)
+    model.Session.configure(bind=None)
+    yield tmp_path / "content.db"
+    if model._engine is not None:
+        model._engine.dispose()
+    model.Session.configure(bind=None)
@@ -0,0 +1,142 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import cache
+import llm
+from cache import CompletionCache
+
+
+@pytest.fixture
+def completion_cache(tmp_path, monkeypatch):
+    completion_cache = CompletionCache(str(tmp_path / "cache.db"))
+    monkeypatch.setattr(cache, "_cache", completion_cache)
+    return completion_cache
+
+
+def _stored_accessed(completion_cache, key):
+    with sqlite3.connect(completion_cache.path) as conn:
+        return conn.execute(
+            "SELECT accessed FROM completions WHERE key = ?", (key,)
+        ).fetchone()[0]
+
+
+def test_hit_does_not_write_until_flushed(completion_cache, monkeypatch):
+    monkeypatch.setattr(cache.time, "time", lambda: 100.0)
+    completion_cache.set("a", "reply")
+    monkeypatch.setattr(cache.time, "time", lambda: 105.0)
+
+    assert completion_cache.get("a") == "reply"
+    assert _stored_accessed(completion_cache, "a") == 100.0
+
+    completion_cache.flush()
+    assert _stored_accessed(completion_cache, "a") == 105.0
+
+
+def test_hits_are_written_in_batches(completion_cache, monkeypatch):
+    monkeypatch.setattr(cache, "ACCESS_FLUSH_SIZE", 3)
+    monkeypatch.setattr(cache.time, "time", lambda: 100.0)
+    for key in "abc":
+        completion_cache.set(key, key)
+    monkeypatch.setattr(cache.time, "time", lambda: 101.0)
+
+    completion_cache.get("a")
+    completion_cache.get("b")
+    assert _stored_accessed(completion_cache, "a") == 100.0
+    completion_cache.get("c")
+    assert [_stored_accessed(completion_cache, key) for key in "abc"] == [101.0] * 3
+
+
+def test_eviction_uses_pending_access_times(completion_cache, monkeypatch):
+    completion_cache.max_bytes = 2
+    monkeypatch.setattr(cache.time, "time", lambda: 100.0)
+    completion_cache.set("old", "1")
+    monkeypatch.setattr(cache.time, "time", lambda: 101.0)
+    completion_cache.set("new", "2")
+    monkeypatch.setattr(cache.time, "time", lambda: 102.0)
+    completion_cache.get("old")
+
+    completion_cache.set("third", "3")
+
+    assert completion_cache.get("old") == "1"
+    assert completion_cache.get("new") is None
+
+
+class _Response(dict):
+    def __init__(self, text):
+        super().__init__()
+        self.choices = [type("Choice", (), {"message": {"content": text}})()]
+
+
+@pytest.fixture
+def replies(monkeypatch):
+    """Answer completions with "reply 1", "reply 2", ... instead of the API."""
+    calls = []
+
+    def request(prompt, *args):
+        calls.append(prompt)
+        return _Response(f"reply {len(calls)}")
+
+    monkeypatch.setattr(llm, "_make_openai_request", request)
+    monkeypatch.setattr(llm, "load_settings", lambda: None)
+    return calls
+
+
+def test_cache_is_off_by_default_when_sampling(completion_cache, replies):
+    assert llm.get_completion("hello", temperature=0.5) == "reply 1"
+    assert llm.get_completion("hello", temperature=0.5) == "reply 2"
+    assert completion_cache.stats()["entries"] == 0
+
+
+def test_cache_is_on_by_default_at_temperature_zero(completion_cache, replies):
+    assert llm.get_completion("hello", temperature=0) == "reply 1"
+    assert llm.get_completion("hello", temperature=0) == "reply 1"
+    assert len(replies) == 1
+
+
+def test_use_cache_false_neither_reads_nor_writes(completion_cache, replies):
+    llm.get_completion("hello", temperature=0, use_cache=False)
+    assert completion_cache.stats()["entries"] == 0
+
+
+def _stream_replies(monkeypatch):
+    """Stream "reply 1", "reply 2", ... instead of calling the API."""
+    calls = []
+
+    async def acreate(**kwargs):
+        calls.append(kwargs)
+        text = f"reply {len(calls)}"
+
+        async def chunks():
+            for token in text.split(" "):
+                delta = {"content": token + " "}
+                yield type("Chunk", (), {"choices": [type("C", (), {"delta": delta})]})
+
+        return chunks()
+
+    monkeypatch.setattr(llm.openai.ChatCompletion, "acreate", acreate)
+    monkeypatch.setattr(llm, "load_settings", lambda: None)
+    return calls
+
+
+def _stream(**kwargs) -> str:
+    async def run():
+        try:
+            return "".join(
+                [token async for token in llm.astream_completion("outline", **kwargs)]
+            )
+        finally:
+            await llm.close_async_client()
+
+    return asyncio.run(run())
+
+
+def test_refresh_replaces_the_cached_stream(completion_cache, monkeypatch):
+    calls = _stream_replies(monkeypatch)
+
+    assert _stream(use_cache=True) == "reply 1 "
+    assert _stream(use_cache=True) == "reply 1 "
+    assert _stream(use_cache=True, refresh=True) == "reply 2 "
+    assert _stream(use_cache=True) == "reply 2 "
+    assert len(calls) == 2
@@ -0,0 +1,46 @@
+import conversation
+from conversation import (
+    IDLE_TIMEOUT,
+    STORAGE_KEY,
+    add_message,
+    add_turn,
+    build_prompt,
+    evict_idle_conversations,
+    get_conversation,
+    get_messages,
+)
+
+
+def test_idle_conversations_are_evicted_from_tracked_storages(monkeypatch):
+    monkeypatch.setattr(conversation, "_storages", {})
+    idle, active = {}, {}
+    get_conversation(idle)["updated"] = 0
+    get_conversation(active)["updated"] = IDLE_TIMEOUT
+
+    assert evict_idle_conversations(now=IDLE_TIMEOUT + 1) == 1
+    assert STORAGE_KEY not in idle
+    assert STORAGE_KEY in active
+    assert list(conversation._storages.values()) == [active]
+
+
+def test_prompt_keeps_latest_turns_within_budget():
+    conv = get_conversation({})
+    for number in range(50):
+        add_turn(conv, f"question {number} " * 20, f"answer {number} " * 20)
+
+    prompt, system_message = build_prompt(conv, "last question", context_tokens=500)
+
+    assert prompt.endswith("User: last question")
+    assert "answer 49" in prompt
+    assert "question 0 " not in prompt
+    assert len(prompt) // 4 < 500
+
+
+def test_messages_keep_their_numbers():
+    conv = get_conversation({})
+    for number in range(5):
+        add_message(conv, "You", f"message {number}")
+    assert get_messages(conv, 3, 10) == [
+        (3, "You", "message 3"),
+        (4, "You", "message 4"),
+    ]
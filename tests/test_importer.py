@@ -0,0 +1,86 @@
+from sqlalchemy import func, select
+
+from importer import import_outline
+from outline_format import loads_tolerant
+from model import Chapter, Section, SectionBody, Subchapter, get_section, session_scope
+from search import search_sections
+
+
+def _outline(chapters: int) -> dict:
+    return {
+        "bt": "Book",
+        "ss": "Subtitle",
+        "cs": [
+            {
+                "cn": chapter,
+                "ct": f"Chapter {chapter}",
+                "cd": "About it",
+                "cp": 2,
+                "ss": [
+                    {
+                        "scn": 1,
+                        "sct": "Part",
+                        "scd": "About it",
+                        "scp": 2,
+                        "scs": [
+                            {"sn": section, "st": "Section", "sd": "Text", "sp": 1}
+                            for section in (1, 2)
+                        ],
+                    }
+                ],
+            }
+            for chapter in range(1, chapters + 1)
+        ],
+    }
+
+
+def _count(session, model) -> int:
+    return session.execute(select(func.count()).select_from(model)).scalar()
+
+
+def _write(book_id: int, path: str, content: str) -> None:
+    with session_scope() as session:
+        get_section(session, book_id, path).content = content
+
+
+def test_import_creates_all_rows(database):
+    result = import_outline(_outline(3))
+    assert result.rows == 1 + 3 + 3 + 6
+    with session_scope() as session:
+        assert _count(session, Chapter) == 3
+        assert _count(session, Section) == 6
+        assert get_section(session, result.book_id, "2.1.2").title == "Section"
+
+
+def test_reimporting_a_shrunk_outline_deletes_the_rest(database):
+    book_id = import_outline(_outline(11)).book_id
+    _write(book_id, "1.1.1", "kept alpaca")
+    _write(book_id, "7.1.2", "dropped walrus")
+
+    result = import_outline(_outline(2), book_id)
+
+    assert result.deleted == 9 + 9 + 18
+    with session_scope() as session:
+        assert _count(session, Chapter) == 2
+        assert _count(session, Subchapter) == 2
+        assert _count(session, Section) == 4
+        assert _count(session, SectionBody) == 1
+        assert get_section(session, book_id, "1.1.1").content == "kept alpaca"
+    assert search_sections("walrus") == []
+    assert [hit.path for hit in search_sections("alpaca")] == ["1.1.1"]
+
+
+def test_unnumbered_items_import_by_position(database):
+    # A truncated answer recovered by the tolerant decoder
+    outline = loads_tolerant(
+        '{"bt": "Book", "cs": [{"ct": "One", "ss": [{"sct": "Intro", "scs": '
+        '[{"st": "A", "sd": "a"}, {"st": "B", "sd": "b"}, {"st": "C", "s'
+    )
+    book_id = import_outline(outline).book_id
+    result = import_outline(outline, book_id)
+
+    assert result.deleted == 0
+    with session_scope() as session:
+        assert _count(session, Section) == 3
+        assert get_section(session, book_id, "1.1.2").title == "B"
+        assert get_section(session, book_id, "1.1.3").title == "C"
@@ -0,0 +1,70 @@
+import asyncio
+import datetime
+import logging
+
+import jobs
+from model import Job, session_scope
+
+
+def _add_running_job(heartbeat_age: float) -> int:
+    with session_scope() as session:
+        job = Job(
+            kind="outline",
+            state=jobs.RUNNING,
+            attempts=1,
+            heartbeat_at=jobs._now() - datetime.timedelta(seconds=heartbeat_age),
+        )
+        session.add(job)
+        session.flush()
+        return job.id
+
+
+def test_requeue_leaves_jobs_with_a_fresh_heartbeat(database):
+    live = _add_running_job(heartbeat_age=1)
+    stale = _add_running_job(heartbeat_age=jobs.LEASE_TIMEOUT + 1)
+
+    assert jobs.requeue_interrupted_jobs() == 1
+    assert jobs.get_job(live).state == jobs.RUNNING
+    assert jobs.get_job(stale).state == jobs.QUEUED
+    assert jobs.get_job(stale).attempts == 0
+
+
+def test_stopping_the_pool_requeues_its_running_jobs(database, monkeypatch):
+    started = asyncio.Event()
+
+    async def wait_forever(ctx):
+        started.set()
+        await asyncio.Event().wait()
+
+    monkeypatch.setitem(jobs._handlers, "wait", wait_forever)
+
+    async def run():
+        pool = jobs.WorkerPool(size=1, poll_interval=0.01)
+        pool.start()
+        job_id = jobs.enqueue_job("wait")
+        await asyncio.wait_for(started.wait(), 5)
+        assert jobs.get_job(job_id).state == jobs.RUNNING
+        await pool.stop()
+        return job_id
+
+    status = jobs.get_job(asyncio.run(run()))
+    assert status.state == jobs.QUEUED
+    assert status.attempts == 0
+
+
+def test_failing_async_listener_is_logged(caplog):
+    async def listener(status, event):
+        raise RuntimeError("broken listener")
+
+    status = jobs.JobStatus(1, "outline", jobs.RUNNING, None, 0, 0, 1, None, None)
+
+    async def run():
+        jobs._call(listener, status, None)
+        assert len(jobs._listener_tasks) == 1
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+    with caplog.at_level(logging.ERROR, logger="jobs"):
+        asyncio.run(run())
+    assert not jobs._listener_tasks
+    assert "Listener of job 1 failed" in caplog.text
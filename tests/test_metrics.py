@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+import llm
+from metrics import LLM_RETRIES, Counter, _Metric, _registry
+
+
+def test_metric_requires_samples():
+    class Unsampled(_Metric):
+        type = "untyped"
+
+    with pytest.raises(TypeError):
+        Unsampled("unsampled", "No samples.")
+
+
+def test_counter_renders_labelled_values():
+    counter = Counter("test_events_total", "Events.", ("kind",))
+    try:
+        counter.inc(kind="a")
+        counter.inc(2, kind="a")
+        assert 'test_events_total{kind="a"} 3' in counter.render()
+    finally:
+        _registry.remove(counter)
+
+
+@pytest.fixture
+def flaky_api(monkeypatch):
+    """Fail the first two requests with a rate limit, then answer."""
+    calls = []
+
+    async def acreate(**kwargs):
+        calls.append(kwargs)
+        if len(calls) <= 2:
+            raise llm.openai.error.RateLimitError("slow down")
+        return llm.openai.openai_object.OpenAIObject.construct_from(
+            {"choices": [{"message": {"content": "reply"}}]}
+        )
+
+    monkeypatch.setattr(llm.openai.ChatCompletion, "acreate", acreate)
+    monkeypatch.setattr(llm, "load_settings", lambda: None)
+    monkeypatch.setattr(llm, "RETRY_DELAY", 0)
+    return calls
+
+
+def test_retried_requests_are_counted_per_model(flaky_api):
+    before = LLM_RETRIES.value(model="retry-model")
+
+    reply = asyncio.run(llm.aget_completion("hi", model="retry-model"))
+
+    assert reply == "reply"
+    assert len(flaky_api) == 3
+    assert LLM_RETRIES.value(model="retry-model") == before + 2
+
+
+def test_retries_give_up_after_max_retries(flaky_api, monkeypatch):
+    monkeypatch.setattr(llm, "MAX_RETRIES", 1)
+
+    with pytest.raises(llm.openai.error.RateLimitError):
+        asyncio.run(llm.aget_completion("hi", model="retry-model"))
+    assert len(flaky_api) == 2
@@ -0,0 +1,65 @@
+import sqlite3
+
+import model
+from model import get_section, load_book, load_chapter, session_scope
+from search import search_sections
+
+# Tables as the first version of model.py created them
+BASELINE_SCHEMA = """
+CREATE TABLE books (id INTEGER PRIMARY KEY, title VARCHAR, subtitle VARCHAR,
+    description VARCHAR, short_description VARCHAR);
+CREATE TABLE chapters (id INTEGER PRIMARY KEY, title VARCHAR, subtitle VARCHAR,
+    description VARCHAR, short_description VARCHAR,
+    book_id INTEGER REFERENCES books (id));
+CREATE TABLE subchapters (id INTEGER PRIMARY KEY, title VARCHAR,
+    subtitle VARCHAR, description VARCHAR, short_description VARCHAR,
+    chapter_id INTEGER REFERENCES chapters (id));
+CREATE TABLE sections (id INTEGER PRIMARY KEY, title VARCHAR, subtitle VARCHAR,
+    description VARCHAR, short_description VARCHAR, content VARCHAR,
+    subchapter_id INTEGER REFERENCES subchapters (id));
+INSERT INTO books (id, title) VALUES (1, 'Book'), (2, 'Other');
+INSERT INTO chapters (id, title, book_id) VALUES
+    (1, 'One', 1), (2, 'Two', 1), (3, 'Elsewhere', 2);
+INSERT INTO subchapters (id, title, chapter_id) VALUES
+    (1, 'One A', 1), (2, 'Two A', 2), (3, 'Two B', 2);
+INSERT INTO sections (id, title, content, subchapter_id) VALUES
+    (1, 'First', 'about penguins', 1), (2, 'Second', NULL, 3),
+    (3, 'Third', 'about otters', 3);
+"""
+
+
+def _create_baseline(path) -> None:
+    with sqlite3.connect(path) as conn:
+        conn.executescript(BASELINE_SCHEMA)
+
+
+def test_baseline_database_is_upgraded(database):
+    _create_baseline(database)
+
+    with session_scope() as session:
+        book = load_book(session, 1)
+        assert [chapter.path for chapter in book.chapters] == ["1", "2"]
+        assert [sub.path for sub in book.chapters[1].subchapters] == ["2.1", "2.2"]
+        section = get_section(session, 1, "2.2.2")
+        assert section.title == "Third"
+        assert section.sort_key == "0002.0002.0002"
+        assert section.content == "about otters"
+        assert section.content_size == len("about otters")
+        assert get_section(session, 1, "2.2.1").content is None
+        assert load_chapter(session, 2, "1").title == "Elsewhere"
+    assert [hit.path for hit in search_sections("penguins")] == ["1.1.1"]
+
+
+def test_upgrade_is_idempotent(database):
+    _create_baseline(database)
+    model.init_db()
+    model._initialized = False
+    model.init_db()
+
+    with session_scope() as session:
+        assert get_section(session, 1, "1.1.1").content == "about penguins"
+    with sqlite3.connect(database) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM section_bodies").fetchone() == (2,)
+        assert conn.execute(
+            "SELECT COUNT(*) FROM sections WHERE content IS NOT NULL"
+        ).fetchone() == (0,)
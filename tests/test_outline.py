@@ -0,0 +1,56 @@
+from outline import OutlineStreamParser, OutlineTreeBuilder, chapters_to_tree
+from outline_index import OutlineIndex
+
+OUTLINE = (
+    '{"bt": "Book", "ss": "Sub", "cs": [{"cn": 1, "ct": "One", "cd": "First", '
+    '"cp": 2, "ss": [{"scn": 1, "sct": "Intro", "scd": "Start", "scp": 2, '
+    '"scs": [{"sn": 1, "st": "Hello", "sd": "Greeting", "sp": 1}, '
+    '{"sn": 2, "st": "Bye", "sd": "Farewell", "sp": 1}]}]}]}'
+)
+
+
+def _tree(chunks):
+    parser = OutlineStreamParser()
+    builder = OutlineTreeBuilder()
+    for chunk in chunks:
+        builder.apply(parser.feed(chunk))
+    return builder.nodes
+
+
+def test_streamed_tree_does_not_depend_on_chunking():
+    whole = _tree([OUTLINE])
+    assert _tree(OUTLINE) == whole
+    chapter = whole[0]["children"][0]
+    assert chapter["id"] == "1"
+    assert [node["id"] for node in chapter["children"][0]["children"]] == [
+        "1.1.1",
+        "1.1.2",
+    ]
+
+
+def test_control_characters_in_strings_are_kept():
+    events = OutlineStreamParser().feed('{"bt":"A\nB","cs":[]}')
+    assert events == [(None, {"id": "A\nB", "description": "", "children": []})]
+
+
+def test_invalid_escape_keeps_raw_text():
+    events = OutlineStreamParser().feed('{"bt":"A\\qB","cs":[]}')
+    assert events[0][1]["id"] == "A\\qB"
+
+
+def test_chapters_to_tree_matches_the_outline_index():
+    outline = {
+        "bt": "Book",
+        "ss": "Sub",
+        "cs": [
+            {
+                "ct": "One",
+                "cd": "First",
+                "ss": [{"sct": "Intro", "scs": [{"st": "A"}]}],
+            },
+            {"cn": "3", "ct": "Three", "cp": 4},
+        ],
+    }
+    tree = chapters_to_tree(outline)
+    assert tree == OutlineIndex.from_compact(outline).to_tree()
+    assert [node["id"] for node in tree[0]["children"]] == ["1", "3"]
@@ -0,0 +1,97 @@
+import pytest
+
+from outline_format import (
+    FORMATS,
+    OutlineFormat,
+    compact_keys,
+    full_keys,
+    get_format,
+    loads_tolerant,
+)
+
+OUTLINE = {
+    "bt": "Book",
+    "ss": "Subtitle",
+    "cs": [
+        {
+            "cn": 1,
+            "ct": "One",
+            "cd": "First",
+            "cp": 3,
+            "ss": [
+                {
+                    "scn": 1,
+                    "sct": "Intro",
+                    "scd": "Start",
+                    "scp": 3,
+                    "scs": [
+                        {"sn": 1, "st": "A", "sd": "a", "sp": 1},
+                        {"sn": 2, "st": "B", "sd": "b", "sp": 2},
+                    ],
+                }
+            ],
+        },
+        {"cn": 2, "ct": "Two", "cd": "Second", "cp": 4, "ss": []},
+    ],
+}
+
+
+def test_loads_tolerant_accepts_fences_trailing_commas_and_chatter():
+    text = 'Here you go:\n```json\n{"a": [1, 2,], "b": {"c": 3,},}\n```\nEnjoy!'
+    assert loads_tolerant(text) == {"a": [1, 2], "b": {"c": 3}}
+
+
+def test_loads_tolerant_keeps_the_complete_members_of_a_truncated_answer():
+    text = '{"bt": "Book", "cs": [{"cn": 1, "ct": "One"}, {"cn": 2, "ct": "Tw'
+    assert loads_tolerant(text) == {
+        "bt": "Book",
+        "cs": [{"cn": 1, "ct": "One"}, {"cn": 2}],
+    }
+
+
+def test_loads_tolerant_drops_a_partial_object_at_the_previous_comma():
+    text = '{"cs": [{"cn": 1}, {'
+    assert loads_tolerant(text) == {"cs": [{"cn": 1}]}
+
+
+def test_loads_tolerant_raises_without_any_value():
+    with pytest.raises(ValueError):
+        loads_tolerant("no outline here")
+
+
+def test_full_and_compact_keys_round_trip():
+    full = full_keys(OUTLINE)
+    assert full["subtitle"] == "Subtitle"
+    assert full["chapters"][0]["subchapters"][0]["sections"][1]["section_title"] == "B"
+    assert compact_keys(full) == OUTLINE
+
+
+@pytest.mark.parametrize("name", sorted(FORMATS))
+def test_formats_round_trip(name):
+    outline_format = FORMATS[name]
+    assert outline_format.decode(outline_format.encode(OUTLINE)) == OUTLINE
+
+
+@pytest.mark.parametrize("name", ["compact-json", "lines"])
+def test_stream_parser_emits_every_node(name):
+    outline_format = FORMATS[name]
+    parser = outline_format.stream_parser()
+    text = outline_format.encode(OUTLINE)
+    ids = set()
+    for start in range(0, len(text), 7):
+        ids.update(node["id"] for _, node in parser.feed(text[start : start + 7]))
+    assert {"Book", "1", "1.1", "1.1.1", "1.1.2", "2"} <= ids
+
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(ValueError):
+        get_format("yaml")
+
+
+def test_a_format_without_decode_cannot_be_created():
+    class EncodeOnly(OutlineFormat):
+        def encode(self, outline: dict) -> str:
+            return ""
+
+    with pytest.raises(TypeError):
+        EncodeOnly()
@@ -0,0 +1,71 @@
+import pytest
+
+from outline_index import CHAPTER, SECTION, SUBCHAPTER, OutlineIndex
+
+OUTLINE = {
+    "bt": "Book",
+    "ss": "Subtitle",
+    "cs": [
+        {
+            "cn": 1,
+            "ct": "One",
+            "cd": "First",
+            "cp": 3,
+            "ss": [
+                {
+                    "scn": 1,
+                    "sct": "Intro",
+                    "scd": "Start",
+                    "scp": 3,
+                    "scs": [
+                        {"sn": 1, "st": "A", "sd": "a", "sp": 1},
+                        {"sn": 2, "st": "B", "sd": "b", "sp": 2},
+                    ],
+                }
+            ],
+        },
+        {"cn": 2, "ct": "Two", "cd": "Second", "cp": 4, "ss": []},
+    ],
+}
+
+
+def test_rows_and_page_rollups():
+    index = OutlineIndex.from_compact(OUTLINE)
+    assert index.ids == ["1", "1.1", "1.1.1", "1.1.2", "2"]
+    assert index["1"].total_pages == 3
+    assert index["2"].total_pages == 4
+    assert index.total_pages() == 7
+    assert [child.id for child in index["1.1"].children] == ["1.1.1", "1.1.2"]
+
+
+def test_tree_nests_nodes_by_id():
+    (book,) = OutlineIndex.from_compact(OUTLINE).to_tree()
+    assert book["id"] == "Book"
+    chapter = book["children"][0]
+    assert chapter["description"] == "One - First (3)"
+    assert [node["id"] for node in chapter["children"][0]["children"]] == [
+        "1.1.1",
+        "1.1.2",
+    ]
+
+
+def test_missing_numbers_are_taken_from_the_position():
+    outline = {
+        "bt": "Book",
+        "cs": [
+            {"ct": "One", "ss": [{"sct": "Intro", "scs": [{"st": "A"}, {"sn": "x"}]}]},
+            {"cn": "2", "ct": "Two"},
+        ],
+    }
+    index = OutlineIndex.from_compact(outline)
+    assert index.ids == ["1", "1.1", "1.1.1", "1.1.2", "2"]
+    rows = index.to_rows(SECTION, 1, "subchapter_id", {"1.1": 10})
+    assert [row["path"] for row in rows] == ["1.1.1", "1.1.2"]
+    assert [row["number"] for row in rows] == [1, 2]
+
+
+def test_append_rejects_a_node_without_number():
+    index = OutlineIndex()
+    index.append(CHAPTER, 1)
+    with pytest.raises(ValueError):
+        index.append(SUBCHAPTER, None)
@@ -0,0 +1,45 @@
+import copy
+import random
+
+import pytest
+
+from tree_patch import apply_ops, diff_tree
+
+
+def _random_tree(rng: random.Random, prefix: str = "", depth: int = 0) -> list:
+    numbers = rng.sample(range(1, 8), rng.randint(0, 4))
+    nodes = []
+    for number in numbers:
+        node_id = f"{prefix}{number}"
+        node = {"id": node_id, "description": rng.choice(["a", "b", "c"])}
+        if depth < 2:
+            node["children"] = _random_tree(rng, node_id + ".", depth + 1)
+        nodes.append(node)
+    return nodes
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_applying_the_diff_gives_the_new_tree(seed):
+    rng = random.Random(seed)
+    old, new = _random_tree(rng), _random_tree(rng)
+    patched = copy.deepcopy(old)
+
+    apply_ops(patched, diff_tree(old, new))
+
+    assert patched == new
+    assert diff_tree(patched, new) == []
+
+
+def test_diff_of_identical_trees_is_empty():
+    tree = _random_tree(random.Random(1))
+    assert diff_tree(tree, copy.deepcopy(tree)) == []
+
+
+def test_without_prune_missing_nodes_are_kept():
+    old = [{"id": "1", "description": "one", "children": []}]
+    new = [{"id": "2", "description": "two", "children": []}]
+    patched = copy.deepcopy(old)
+
+    apply_ops(patched, diff_tree(old, new, prune=False))
+
+    assert sorted(node["id"] for node in patched) == ["1", "2"]